@@ -42,6 +42,70 @@ class Settings(BaseSettings):
     CLICKHOUSE_DB: str = os.getenv("CLICKHOUSE_DB", "stock_db")
     CLICKHOUSE_USER: str = os.getenv("CLICKHOUSE_USER", "default")
     CLICKHOUSE_PASSWORD: str = os.getenv("CLICKHOUSE_PASSWORD", "")
+    # Connection pool: mỗi query checkout một connection, chờ tối đa POOL_TIMEOUT nếu pool đã đầy
+    CLICKHOUSE_POOL_MIN_SIZE: int = int(os.getenv("CLICKHOUSE_POOL_MIN_SIZE", "2"))
+    CLICKHOUSE_POOL_MAX_SIZE: int = int(os.getenv("CLICKHOUSE_POOL_MAX_SIZE", "16"))
+    CLICKHOUSE_POOL_TIMEOUT_SECONDS: float = float(os.getenv("CLICKHOUSE_POOL_TIMEOUT_SECONDS", "10"))
+    # Connection idle lâu hơn ngưỡng này được ping trước khi dùng lại
+    CLICKHOUSE_POOL_PING_INTERVAL_SECONDS: float = float(os.getenv("CLICKHOUSE_POOL_PING_INTERVAL_SECONDS", "30"))
+    # Số thread tối đa chạy query ClickHouse cho các async route
+    CLICKHOUSE_MAX_WORKERS: int = int(os.getenv("CLICKHOUSE_MAX_WORKERS", "8"))
+    # Timeout (giây) cho một lần chạy trong executor; query quá hạn bị KILL trên server (0 = không giới hạn)
+    CLICKHOUSE_QUERY_TIMEOUT_SECONDS: float = float(os.getenv("CLICKHOUSE_QUERY_TIMEOUT_SECONDS", "30"))
+    
+    # Latest-price cache (giá mới nhất dùng chung cho toàn process)
+    # TTL: quá thời gian này thì giá bị coi là hết hạn và phải query lại đồng bộ
+    # REFRESH_AHEAD: giá cũ hơn ngưỡng này sẽ được refresh nền trước khi hết hạn
+    PRICE_CACHE_TTL_SECONDS: float = float(os.getenv("PRICE_CACHE_TTL_SECONDS", "15"))
+    PRICE_CACHE_REFRESH_AHEAD_SECONDS: float = float(os.getenv("PRICE_CACHE_REFRESH_AHEAD_SECONDS", "5"))
+    PRICE_CACHE_MAX_SYMBOLS: int = int(os.getenv("PRICE_CACHE_MAX_SYMBOLS", "2000"))
+    
+    # Cache user cho get_current_user (giây / số users tối đa)
+    USER_CACHE_TTL_SECONDS: float = float(os.getenv("USER_CACHE_TTL_SECONDS", "30"))
+    USER_CACHE_MAX_ENTRIES: int = int(os.getenv("USER_CACHE_MAX_ENTRIES", "10000"))
+    
+    # Nén response (bytes): response nhỏ hơn ngưỡng này không nén
+    RESPONSE_COMPRESSION_MIN_SIZE: int = int(os.getenv("RESPONSE_COMPRESSION_MIN_SIZE", "1024"))
+    
+    # Số orders tối đa trong một request POST /api/portfolio/orders/batch
+    ORDER_BATCH_MAX_SIZE: int = int(os.getenv("ORDER_BATCH_MAX_SIZE", "100"))
+    
+    # Engine khớp LIMIT orders chạy nền (chỉ bật ở một process): chu kỳ khớp / chu kỳ load lại sổ lệnh từ DB (giây)
+    MATCHING_ENGINE_ENABLED: bool = os.getenv("MATCHING_ENGINE_ENABLED", "True").lower() == "true"
+    MATCHING_ENGINE_INTERVAL_SECONDS: float = float(os.getenv("MATCHING_ENGINE_INTERVAL_SECONDS", "1"))
+    MATCHING_ENGINE_RESYNC_SECONDS: float = float(os.getenv("MATCHING_ENGINE_RESYNC_SECONDS", "30"))
+    
+    # Fill QUEUED MARKET orders hàng loạt lúc mở phiên (9:00, 13:00): số orders mỗi transaction
+    ORDER_RELEASE_ENABLED: bool = os.getenv("ORDER_RELEASE_ENABLED", "True").lower() == "true"
+    ORDER_RELEASE_CHUNK_SIZE: int = int(os.getenv("ORDER_RELEASE_CHUNK_SIZE", "500"))
+    # Số lần chạy tối đa mỗi phiên khi còn order fill lỗi (vd ClickHouse lỗi nên không có giá), cách nhau 30 giây
+    ORDER_RELEASE_MAX_ATTEMPTS: int = int(os.getenv("ORDER_RELEASE_MAX_ATTEMPTS", "10"))
+    
+    # Fill ATO/ATC orders theo giá khớp định kỳ từ stock_db.ticks: chạy sau giờ khớp (9:15 / 14:45) bao nhiêu giây
+    AUCTION_FILL_ENABLED: bool = os.getenv("AUCTION_FILL_ENABLED", "True").lower() == "true"
+    AUCTION_FILL_DELAY_SECONDS: float = float(os.getenv("AUCTION_FILL_DELAY_SECONDS", "60"))
+    
+    # Sổ cái portfolio: tự tạo snapshot khi số entries sau snapshot mới nhất đạt ngưỡng này
+    LEDGER_SNAPSHOT_EVERY: int = int(os.getenv("LEDGER_SNAPSHOT_EVERY", "50"))
+    
+    # Equity curve: định giá mọi portfolio và ghi một điểm / user mỗi chu kỳ trong giờ giao dịch (giây)
+    EQUITY_SNAPSHOT_ENABLED: bool = os.getenv("EQUITY_SNAPSHOT_ENABLED", "True").lower() == "true"
+    EQUITY_SNAPSHOT_INTERVAL_SECONDS: float = float(os.getenv("EQUITY_SNAPSHOT_INTERVAL_SECONDS", "60"))
+    
+    # Leaderboard: định giá lại mọi portfolio và cập nhật ranking mỗi chu kỳ (giây)
+    LEADERBOARD_ENABLED: bool = os.getenv("LEADERBOARD_ENABLED", "True").lower() == "true"
+    LEADERBOARD_REFRESH_SECONDS: float = float(os.getenv("LEADERBOARD_REFRESH_SECONDS", "60"))
+    
+    # Thống kê admin: flush buffer sự kiện vào bảng tổng hợp (giây) và tính lại toàn bộ từ bảng gốc (giây)
+    ADMIN_STATS_ENABLED: bool = os.getenv("ADMIN_STATS_ENABLED", "True").lower() == "true"
+    ADMIN_STATS_FLUSH_SECONDS: float = float(os.getenv("ADMIN_STATS_FLUSH_SECONDS", "5"))
+    ADMIN_STATS_RECONCILE_SECONDS: float = float(os.getenv("ADMIN_STATS_RECONCILE_SECONDS", "3600"))
+    
+    # Sync virtual_orders sang ClickHouse cho analytics: chu kỳ (giây), số dòng / INSERT, bỏ qua thay đổi quá mới (giây)
+    ORDER_ANALYTICS_SYNC_ENABLED: bool = os.getenv("ORDER_ANALYTICS_SYNC_ENABLED", "True").lower() == "true"
+    ORDER_ANALYTICS_SYNC_INTERVAL_SECONDS: float = float(os.getenv("ORDER_ANALYTICS_SYNC_INTERVAL_SECONDS", "10"))
+    ORDER_ANALYTICS_SYNC_BATCH_SIZE: int = int(os.getenv("ORDER_ANALYTICS_SYNC_BATCH_SIZE", "5000"))
+    ORDER_ANALYTICS_SYNC_SETTLE_SECONDS: float = float(os.getenv("ORDER_ANALYTICS_SYNC_SETTLE_SECONDS", "30"))
     
     # JWT
     JWT_SECRET_KEY: str = os.getenv("JWT_SECRET_KEY", "your-secret-key-change-in-production")
@@ -51,6 +115,11 @@ class Settings(BaseSettings):
     # WebSocket
     WEBSOCKET_HOST: str = os.getenv("WEBSOCKET_HOST", "0.0.0.0")
     WEBSOCKET_PORT: int = int(os.getenv("WEBSOCKET_PORT", "8765"))
+    # Fan-out OHLC: số message chờ gửi tối đa / connection, xử lý client chậm khi đầy (coalesce / drop / disconnect),
+    # thời gian tối đa cho một lần gửi (giây) trước khi đóng connection
+    WEBSOCKET_SEND_QUEUE_SIZE: int = int(os.getenv("WEBSOCKET_SEND_QUEUE_SIZE", "32"))
+    WEBSOCKET_SLOW_CONSUMER_POLICY: str = os.getenv("WEBSOCKET_SLOW_CONSUMER_POLICY", "coalesce").lower()
+    WEBSOCKET_SEND_TIMEOUT_SECONDS: float = float(os.getenv("WEBSOCKET_SEND_TIMEOUT_SECONDS", "10"))
     
     # LLM API (Optional)
     OPENAI_API_KEY: Optional[str] = os.getenv("OPENAI_API_KEY")
@@ -61,6 +130,11 @@ class Settings(BaseSettings):
         """PostgreSQL connection URL"""
         return f"postgresql://{self.POSTGRES_USER}:{self.POSTGRES_PASSWORD}@{self.POSTGRES_HOST}:{self.POSTGRES_PORT}/{self.POSTGRES_DB}"
     
+    @property
+    def postgres_async_url(self) -> str:
+        """PostgreSQL connection URL cho async engine (asyncpg)"""
+        return f"postgresql+asyncpg://{self.POSTGRES_USER}:{self.POSTGRES_PASSWORD}@{self.POSTGRES_HOST}:{self.POSTGRES_PORT}/{self.POSTGRES_DB}"
+    
     class Config:
         env_file = ".env"
         case_sensitive = True
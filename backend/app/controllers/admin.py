@@ -3,13 +3,19 @@ Admin Controllers - Quản lý bài học và users
 """
 
 from fastapi import APIRouter, Depends, HTTPException, status, Query
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 from typing import List, Optional
-from app.database import get_db
+from datetime import datetime, timedelta, timezone
+from app.database import get_db, get_clickhouse
 from app.schemas.lesson import LessonResponse, LessonCreate, LessonUpdate
 from app.services.lesson_service import LessonService
 from app.repositories.lesson_repository import LessonRepository
 from app.repositories.user_repository import UserRepository
+from app.repositories.clickhouse_repository import ClickHouseRepository
+from app.services.user_cache_service import user_cache
+from app.services.leaderboard_service import leaderboard
+from app.services.admin_stats_service import admin_stats
 from app.controllers.auth import get_current_user
 from app.models.user import User
 from pydantic import BaseModel
@@ -41,14 +47,20 @@ class AdminStatsResponse(BaseModel):
 
 # === Helper: Check Admin ===
 
-async def get_admin_user(current_user: User = Depends(get_current_user)) -> User:
-    """Check if current user is admin"""
-    if current_user.role != 'ADMIN':
+def get_admin_user(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)) -> User:
+    """
+    Check if current user is admin
+    Role được đọc lại từ DB thay vì user_cache: cache chỉ invalidate trong process đã đổi role,
+    worker khác có thể còn giữ role cũ đến hết TTL
+    """
+    user = UserRepository.get_by_id(db, current_user.id)
+    if user is None or user.role != 'ADMIN':
+        user_cache.invalidate(user_id=current_user.id)
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Chỉ Admin mới có quyền truy cập"
         )
-    return current_user
+    return user
 
 
 # === Lesson Management ===
@@ -206,6 +218,7 @@ async def admin_update_user_experience(
     # Set absolute value (not increment)
     user.experience_points = max(0, points)
     db.commit()
+    user_cache.invalidate(user_id=user.id)
     
     return {
         "id": user.id,
@@ -244,6 +257,7 @@ async def admin_update_user_role(
     
     user.role = role
     db.commit()
+    user_cache.invalidate(user_id=user.id)
     
     return {
         "id": user.id,
@@ -260,19 +274,18 @@ async def admin_get_stats(
     admin: User = Depends(get_admin_user),
     db: Session = Depends(get_db)
 ):
-    """[Admin] Lấy thống kê tổng quan"""
-    from app.models.lesson import Lesson, LessonProgress
+    """[Admin] Lấy thống kê tổng quan (users / completions từ bảng tổng hợp, xem AdminStatsService)"""
+    from app.models.lesson import Lesson
     
-    total_users = db.query(User).count()
+    counters = await run_in_threadpool(admin_stats.overview, db)
     total_lessons = db.query(Lesson).count()
     active_lessons = db.query(Lesson).filter(Lesson.is_active == True).count()
-    total_completions = db.query(LessonProgress).filter(LessonProgress.status == "COMPLETED").count()
     
     return AdminStatsResponse(
-        total_users=total_users,
+        total_users=int(counters["total_users"]),
         total_lessons=total_lessons,
         active_lessons=active_lessons,
-        total_completions=total_completions
+        total_completions=int(counters["total_completions"])
     )
 
 
@@ -281,40 +294,8 @@ async def admin_get_lesson_stats(
     admin: User = Depends(get_admin_user),
     db: Session = Depends(get_db)
 ):
-    """[Admin] Lấy thống kê theo bài học"""
-    from app.models.lesson import Lesson, LessonProgress
-    from sqlalchemy import func, case
-    
-    # Get completion stats per lesson
-    lesson_stats = db.query(
-        Lesson.id,
-        Lesson.title,
-        Lesson.difficulty_level,
-        func.count(LessonProgress.id).label("total_attempts"),
-        func.sum(
-            case(
-                (LessonProgress.status == "COMPLETED", 1),
-                else_=0
-            )
-        ).label("completions"),
-        func.avg(LessonProgress.quiz_score).label("avg_quiz_score")
-    ).outerjoin(
-        LessonProgress, Lesson.id == LessonProgress.lesson_id
-    ).group_by(
-        Lesson.id, Lesson.title, Lesson.difficulty_level
-    ).all()
-    
-    return [
-        {
-            "id": stat.id,
-            "title": stat.title,
-            "difficulty_level": stat.difficulty_level,
-            "total_attempts": stat.total_attempts or 0,
-            "completions": int(stat.completions or 0),
-            "avg_quiz_score": round(float(stat.avg_quiz_score or 0), 2)
-        }
-        for stat in lesson_stats
-    ]
+    """[Admin] Lấy thống kê theo bài học (từ bảng tổng hợp lesson_stats)"""
+    return await run_in_threadpool(admin_stats.lesson_stats, db)
 
 
 @router.get("/stats/trading")
@@ -322,70 +303,27 @@ async def admin_get_trading_stats(
     admin: User = Depends(get_admin_user),
     db: Session = Depends(get_db)
 ):
-    """[Admin] Lấy thống kê giao dịch"""
-    from app.models.portfolio import VirtualOrder, Portfolio
-    from sqlalchemy import func
-    from datetime import datetime, timedelta
-    
-    # Total orders
-    total_orders = db.query(VirtualOrder).count()
-    filled_orders = db.query(VirtualOrder).filter(VirtualOrder.status == "FILLED").count()
-    
-    # Total trading value (sum of filled_price * filled_quantity)
-    total_value_result = db.query(
-        func.sum(VirtualOrder.filled_price * VirtualOrder.filled_quantity)
-    ).filter(VirtualOrder.status == "FILLED").scalar()
-    total_trading_value = float(total_value_result or 0)
-    
-    # New users this month
-    first_of_month = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    new_users_month = db.query(User).filter(User.created_at >= first_of_month).count()
-    
-    # Active traders (users with at least 1 order)
-    active_traders = db.query(func.count(func.distinct(VirtualOrder.user_id))).scalar() or 0
+    """[Admin] Lấy thống kê giao dịch (từ bảng tổng hợp stat_counters; active_traders cập nhật khi reconcile)"""
+    counters = await run_in_threadpool(admin_stats.overview, db)
     
     return {
-        "total_orders": total_orders,
-        "filled_orders": filled_orders,
-        "total_trading_value": total_trading_value,
-        "new_users_month": new_users_month,
-        "active_traders": active_traders
+        "total_orders": int(counters["total_orders"]),
+        "filled_orders": int(counters["filled_orders"]),
+        "total_trading_value": float(counters["total_trading_value"]),
+        "new_users_month": int(counters[admin_stats.month_key()]),
+        "active_traders": int(counters["active_traders"])
     }
 
 
 @router.get("/stats/leaderboard")
 async def admin_get_leaderboard(
     admin: User = Depends(get_admin_user),
-    db: Session = Depends(get_db),
+    ch_client = Depends(get_clickhouse),
     limit: int = Query(10, ge=1, le=50)
 ):
-    """[Admin] Lấy bảng xếp hạng top traders theo lợi nhuận"""
-    from app.models.portfolio import Portfolio
-    from sqlalchemy import desc
-    
-    # Get top portfolios by total_value (profit = total_value - initial 10M)
-    INITIAL_BALANCE = 10000000  # 10M VND
-    
-    top_portfolios = db.query(
-        Portfolio.user_id,
-        Portfolio.total_value,
-        Portfolio.cash_balance,
-        User.username
-    ).join(User, Portfolio.user_id == User.id).order_by(
-        desc(Portfolio.total_value)
-    ).limit(limit).all()
-    
-    return [
-        {
-            "rank": idx + 1,
-            "user_id": p.user_id,
-            "username": p.username,
-            "total_value": float(p.total_value),
-            "profit": float(p.total_value) - INITIAL_BALANCE,
-            "profit_percent": round((float(p.total_value) - INITIAL_BALANCE) / INITIAL_BALANCE * 100, 2)
-        }
-        for idx, p in enumerate(top_portfolios)
-    ]
+    """[Admin] Lấy bảng xếp hạng top traders theo lợi nhuận (giá trị mark-to-market, định giá lại theo chu kỳ)"""
+    await run_in_threadpool(leaderboard.ensure_fresh, ch_client)
+    return leaderboard.top(limit)
 
 
 @router.get("/stats/popular-stocks")
@@ -394,43 +332,53 @@ async def admin_get_popular_stocks(
     db: Session = Depends(get_db),
     limit: int = Query(10, ge=1, le=50)
 ):
-    """[Admin] Lấy danh sách mã cổ phiếu được giao dịch nhiều nhất"""
-    from app.models.portfolio import VirtualOrder
-    from sqlalchemy import func, desc, case
-    
-    # Get most traded stocks
-    popular_stocks = db.query(
-        VirtualOrder.symbol,
-        func.count(VirtualOrder.id).label("total_orders"),
-        func.sum(VirtualOrder.filled_quantity).label("total_volume"),
-        func.sum(
-            case(
-                (VirtualOrder.side == "BUY", 1),
-                else_=0
-            )
-        ).label("buy_orders"),
-        func.sum(
-            case(
-                (VirtualOrder.side == "SELL", 1),
-                else_=0
-            )
-        ).label("sell_orders")
-    ).filter(
-        VirtualOrder.status == "FILLED"
-    ).group_by(
-        VirtualOrder.symbol
-    ).order_by(
-        desc("total_orders")
-    ).limit(limit).all()
-    
-    return [
-        {
-            "symbol": stock.symbol,
-            "total_orders": stock.total_orders,
-            "total_volume": int(stock.total_volume or 0),
-            "buy_orders": int(stock.buy_orders or 0),
-            "sell_orders": int(stock.sell_orders or 0)
-        }
-        for stock in popular_stocks
-    ]
+    """[Admin] Lấy danh sách mã cổ phiếu được giao dịch nhiều nhất (từ bảng tổng hợp symbol_trade_stats)"""
+    return await run_in_threadpool(admin_stats.top_symbols, db, limit)
 
+
+# === Analytics (bản sao virtual_orders trên ClickHouse, xem OrderAnalyticsSyncService) ===
+
+def _analytics_range(start: Optional[datetime], end: Optional[datetime]):
+    """Khoảng [start, end) mặc định: 30 ngày gần nhất"""
+    end = end or datetime.now(timezone.utc)
+    return start or end - timedelta(days=30), end
+
+
+@router.get("/analytics/popular-stocks")
+async def admin_get_popular_stocks_analytics(
+    admin: User = Depends(get_admin_user),
+    ch_client = Depends(get_clickhouse),
+    start: Optional[datetime] = Query(None, description="Từ thời điểm fill (mặc định: 30 ngày trước)"),
+    end: Optional[datetime] = Query(None, description="Đến thời điểm fill (mặc định: hiện tại)"),
+    limit: int = Query(10, ge=1, le=100)
+):
+    """[Admin] Mã cổ phiếu có nhiều orders FILLED nhất trong khoảng thời gian, kèm giá trị giao dịch (VNĐ)"""
+    start, end = _analytics_range(start, end)
+    repo = ClickHouseRepository(ch_client)
+    return await ch_client.run(repo.get_order_symbol_stats, start, end, limit)
+
+
+@router.get("/analytics/trading-value")
+async def admin_get_trading_value_analytics(
+    admin: User = Depends(get_admin_user),
+    ch_client = Depends(get_clickhouse),
+    start: Optional[datetime] = Query(None, description="Từ thời điểm fill (mặc định: 30 ngày trước)"),
+    end: Optional[datetime] = Query(None, description="Đến thời điểm fill (mặc định: hiện tại)")
+):
+    """[Admin] Giá trị giao dịch (VNĐ), số orders FILLED và số traders theo ngày"""
+    start, end = _analytics_range(start, end)
+    repo = ClickHouseRepository(ch_client)
+    return await ch_client.run(repo.get_order_daily_value, start, end)
+
+
+@router.get("/analytics/activity-by-hour")
+async def admin_get_activity_by_hour_analytics(
+    admin: User = Depends(get_admin_user),
+    ch_client = Depends(get_clickhouse),
+    start: Optional[datetime] = Query(None, description="Từ thời điểm đặt order (mặc định: 30 ngày trước)"),
+    end: Optional[datetime] = Query(None, description="Đến thời điểm đặt order (mặc định: hiện tại)")
+):
+    """[Admin] Số orders đặt / FILLED / hủy theo giờ trong ngày (giờ Việt Nam)"""
+    start, end = _analytics_range(start, end)
+    repo = ClickHouseRepository(ch_client)
+    return await ch_client.run(repo.get_order_activity_by_hour, start, end)
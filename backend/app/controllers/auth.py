@@ -4,11 +4,13 @@ Authentication Controllers
 
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from app.database import get_db
+from app.database import get_db, get_async_db
 from app.schemas.user import UserCreate, UserResponse, Token, UserLogin
-from app.repositories.user_repository import UserRepository
+from app.repositories.user_repository import UserRepository, AsyncUserRepository
 from app.services.auth_service import AuthService
+from app.services.user_cache_service import user_cache
 from datetime import timedelta
 from app.config import settings
 
@@ -17,11 +19,8 @@ router = APIRouter(prefix="/api/auth", tags=["Authentication"])
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/login")
 
 
-def get_current_user(
-    token: str = Depends(oauth2_scheme),
-    db: Session = Depends(get_db)
-):
-    """Dependency để lấy current user từ JWT token"""
+def _get_token_username(token: str) -> str:
+    """Verify JWT token, trả về username (raise 401 nếu token không hợp lệ)"""
     if not token:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -36,13 +35,47 @@ def get_current_user(
             detail="Invalid or expired token. Please login again at /api/auth/login",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    return token_data.username
+
+
+def get_current_user(
+    token: str = Depends(oauth2_scheme),
+    db: Session = Depends(get_db)
+):
+    """Dependency để lấy current user từ JWT token"""
+    username = _get_token_username(token)
+    # User trả về từ cache không gắn với session: route cần sửa user phải load lại từ db
+    user = user_cache.get(username)
+    if user is not None:
+        return user
     
-    user = UserRepository.get_by_username(db, username=token_data.username)
+    user = UserRepository.get_by_username(db, username=username)
     if user is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="User not found",
         )
+    user_cache.put(user)
+    return user
+
+
+async def get_current_user_async(
+    token: str = Depends(oauth2_scheme),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Dependency để lấy current user từ JWT token (async session, dùng cho route đã chuyển sang async)"""
+    username = _get_token_username(token)
+    user = user_cache.get(username)
+    if user is not None:
+        return user
+    
+    user = await AsyncUserRepository.get_by_username(db, username=username)
+    if user is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="User not found",
+        )
+    user_cache.put(user)
     return user
 
 
@@ -111,7 +144,7 @@ async def login(
 
 
 @router.get("/me", response_model=UserResponse)
-async def get_current_user_info(current_user = Depends(get_current_user)):
+async def get_current_user_info(current_user = Depends(get_current_user_async)):
     """Lấy thông tin user hiện tại"""
     return current_user
 
@@ -127,7 +160,9 @@ async def exchange_stars_to_money(
     db: Session = Depends(get_db)
 ):
     """Quy đổi sao ra tiền"""
-    from app.models.portfolio import Portfolio
+    from decimal import Decimal
+    from app.repositories.portfolio_repository import PortfolioRepository
+    from app.services.ledger_service import LedgerService
     
     if stars <= 0:
         raise HTTPException(
@@ -135,30 +170,40 @@ async def exchange_stars_to_money(
             detail="Số sao phải lớn hơn 0"
         )
     
-    if stars > current_user.experience_points:
+    # current_user có thể đến từ cache (không gắn session, số sao có thể cũ): load lại từ db để sửa
+    user = UserRepository.get_by_id(db, current_user.id)
+    if user is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="User not found",
+        )
+    
+    if stars > user.experience_points:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"Bạn chỉ có {current_user.experience_points} sao"
+            detail=f"Bạn chỉ có {user.experience_points} sao"
         )
     
     # Tính tiền quy đổi
     money = stars * STAR_TO_VND_RATE
     
     # Trừ sao
-    current_user.experience_points -= stars
+    user.experience_points -= stars
     
-    # Cộng tiền vào portfolio
-    portfolio = db.query(Portfolio).filter(Portfolio.user_id == current_user.id).first()
+    # Cộng tiền vào portfolio (một câu UPDATE, không mất cập nhật khi order FILLED cùng lúc)
+    # và ghi sổ cái trong cùng transaction để lịch sử cash khớp cash_balance
+    portfolio = PortfolioRepository.adjust_cash(db, user.id, cash_delta=Decimal(money))
     if portfolio:
-        portfolio.cash_balance += money
+        LedgerService.record_cash(db, user.id, Decimal(money), "STARS")
     
     db.commit()
+    user_cache.invalidate(user_id=user.id)
     
     return {
         "success": True,
         "stars_exchanged": stars,
         "money_received": money,
-        "remaining_stars": current_user.experience_points,
+        "remaining_stars": user.experience_points,
         "new_balance": float(portfolio.cash_balance) if portfolio else 0,
         "message": f"Đã quy đổi {stars} sao thành {money:,.0f} VND"
     }
@@ -4,7 +4,7 @@ from app.database import get_db
 from app.models.user import User
 from app.models.settings import HomepageSettings
 from app.schemas.settings import HomepageSettingsResponse, HomepageSettingsUpdate
-from app.controllers.auth import get_current_user
+from app.controllers.admin import get_admin_user
 
 router = APIRouter(prefix="/api/homepage", tags=["Homepage"])
 
@@ -70,14 +70,10 @@ async def get_homepage_settings(db: Session = Depends(get_db)):
 @router.put("/admin", response_model=HomepageSettingsResponse)
 async def update_homepage_settings(
     settings_update: HomepageSettingsUpdate,
-    current_user: User = Depends(get_current_user),
+    current_user: User = Depends(get_admin_user),
     db: Session = Depends(get_db)
 ):
     """Admin endpoint to update homepage settings"""
-    # Check for admin role
-    if current_user.role != 'ADMIN':
-        raise HTTPException(status_code=403, detail="Chỉ Admin mới có quyền này")
-
     settings = db.query(HomepageSettings).first()
     
     # Prepare update data, converting list to JSON string
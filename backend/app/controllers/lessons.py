@@ -3,17 +3,18 @@ Lesson Controllers
 """
 
 from fastapi import APIRouter, Depends, HTTPException, status, Query
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from typing import List, Optional
-from app.database import get_db
+from app.database import get_db, get_async_db
 from app.schemas.lesson import (
     LessonResponse, LessonProgressResponse, LessonProgressCreate,
     LessonCreate, LessonUpdate, QuizSubmission, QuizResult,
     LessonWithProgressResponse
 )
-from app.repositories.lesson_repository import LessonRepository
+from app.repositories.lesson_repository import AsyncLessonRepository
 from app.services.lesson_service import LessonService
-from app.controllers.auth import get_current_user
+from app.controllers.auth import get_current_user, get_current_user_async
 from app.models.user import User
 
 router = APIRouter(prefix="/api/lessons", tags=["Lessons"])
@@ -26,20 +27,20 @@ async def get_lessons(
     skip: int = Query(0, ge=0),
     limit: int = Query(100, ge=1, le=1000),
     active_only: bool = Query(True),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Lấy danh sách lessons"""
-    lessons = LessonRepository.get_all(db, skip=skip, limit=limit, active_only=active_only)
+    lessons = await AsyncLessonRepository.get_all(db, skip=skip, limit=limit, active_only=active_only)
     return lessons
 
 
 @router.get("/{lesson_id}", response_model=LessonResponse)
 async def get_lesson(
     lesson_id: int,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Lấy chi tiết lesson"""
-    lesson = LessonRepository.get_by_id(db, lesson_id)
+    lesson = await AsyncLessonRepository.get_by_id(db, lesson_id)
     if not lesson:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -53,11 +54,11 @@ async def get_lesson(
 @router.get("/{lesson_id}/progress", response_model=LessonProgressResponse)
 async def get_lesson_progress(
     lesson_id: int,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Lấy progress của user cho lesson"""
-    progress = LessonRepository.get_progress(db, current_user.id, lesson_id)
+    progress = await AsyncLessonRepository.get_progress(db, current_user.id, lesson_id)
     if not progress:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -144,11 +145,11 @@ async def submit_quiz(
 
 @router.get("/progress/all", response_model=List[LessonProgressResponse])
 async def get_all_progress(
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Lấy tất cả progress của user"""
-    progress_list = LessonRepository.get_all_progress(db, current_user.id)
+    progress_list = await AsyncLessonRepository.get_all_progress(db, current_user.id)
     return progress_list
 
 
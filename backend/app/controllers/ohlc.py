@@ -2,25 +2,33 @@
 OHLC Data Controllers
 """
 
-from fastapi import APIRouter, Depends, Query, HTTPException
+from fastapi import APIRouter, Depends, Query, HTTPException, Request
+from fastapi.responses import StreamingResponse
 from datetime import datetime, timedelta
 from typing import Optional
-from app.database import get_clickhouse
+from app.database import get_clickhouse, ClickHouseExecutor
 from app.repositories.clickhouse_repository import ClickHouseRepository
+from app.services.response_format_service import ResponseFormatService
+from app.services.ohlc_export_service import OhlcExportService
 
 router = APIRouter(prefix="/api/ohlc", tags=["OHLC Data"])
 
 
 @router.get("/historical")
 async def get_ohlc_historical(
+    request: Request,
     symbol: str = Query(..., description="Mã chứng khoán"),
     start_time: Optional[datetime] = Query(None, description="Thời gian bắt đầu"),
     end_time: Optional[datetime] = Query(None, description="Thời gian kết thúc"),
-    interval: str = Query("1m", description="Interval: 1m, 5m, 1h, 1d"),
+    interval: str = Query("1m", description="Interval: 1m, 5m, 15m, 1h, 4h, 1d, 1w..."),
     limit: int = Query(100, ge=1, le=10000, description="Giới hạn số lượng records"),
-    ch_client = Depends(get_clickhouse)
+    format: str = Query("rows", pattern="^(rows|columnar)$", description="rows: list object mỗi nến, columnar: các mảng song song, time là epoch giây giờ Việt Nam"),
+    ch_client: ClickHouseExecutor = Depends(get_clickhouse)
 ):
-    """Lấy dữ liệu OHLC lịch sử từ ClickHouse"""
+    """
+    Lấy dữ liệu OHLC lịch sử từ ClickHouse
+    Header Accept: application/json (mặc định), application/msgpack, application/vnd.apache.arrow.stream
+    """
     # Default: 7 ngày gần nhất
     if not end_time:
         end_time = datetime.now()
@@ -28,61 +36,141 @@ async def get_ohlc_historical(
         start_time = end_time - timedelta(days=7)
     
     # Validate interval
-    valid_intervals = ["1m", "5m", "1h", "1d"]
-    if interval not in valid_intervals:
+    if ClickHouseRepository.parse_interval(interval) is None:
         raise HTTPException(
             status_code=400,
-            detail=f"Invalid interval. Must be one of: {valid_intervals}"
+            detail="Invalid interval. Must be <number><unit> with unit m, h, d or w (e.g. 1m, 15m, 4h, 1d, 1w)"
         )
     
+    # Arrow luôn là dạng cột
+    media_type = ResponseFormatService.negotiate(request)
+    columnar = format == "columnar" or media_type == ResponseFormatService.ARROW
+    
     repo = ClickHouseRepository(ch_client)
-    data = repo.get_ohlc_historical(
+    data = await ch_client.run(
+        repo.get_ohlc_historical,
         symbol=symbol,
         start_time=start_time,
         end_time=end_time,
         interval=interval,
-        limit=limit
+        limit=limit,
+        columnar=columnar
     )
     
-    return {
+    payload = {
         "symbol": symbol,
         "interval": interval,
         "start_time": start_time.isoformat(),
         "end_time": end_time.isoformat(),
-        "count": len(data),
+        "count": len(data["time"]) if columnar else len(data),
         "data": data
     }
+    if columnar:
+        payload["format"] = "columnar"
+    return ResponseFormatService.render(media_type, payload, table_key="data")
 
 
 @router.get("/latest")
 async def get_latest_ohlc(
+    request: Request,
     symbol: str = Query(..., description="Mã chứng khoán"),
-    interval: str = Query("1m", description="Interval: 1m, 5m, 1h, 1d"),
+    interval: str = Query("1m", description="Interval: 1m, 5m, 15m, 1h, 4h, 1d, 1w..."),
     limit: int = Query(100, ge=1, le=1000, description="Giới hạn số lượng records"),
-    ch_client = Depends(get_clickhouse)
+    format: str = Query("rows", pattern="^(rows|columnar)$", description="rows: list object mỗi nến, columnar: các mảng song song, time là epoch giây giờ Việt Nam"),
+    ch_client: ClickHouseExecutor = Depends(get_clickhouse)
 ):
     """Lấy OHLC data mới nhất"""
+    if ClickHouseRepository.parse_interval(interval) is None:
+        raise HTTPException(
+            status_code=400,
+            detail="Invalid interval. Must be <number><unit> with unit m, h, d or w (e.g. 1m, 15m, 4h, 1d, 1w)"
+        )
+    
+    media_type = ResponseFormatService.negotiate(request)
+    columnar = format == "columnar" or media_type == ResponseFormatService.ARROW
+    
     repo = ClickHouseRepository(ch_client)
-    data = repo.get_latest_ohlc(symbol=symbol, interval=interval, limit=limit)
+    data = await ch_client.run(
+        repo.get_latest_ohlc, symbol=symbol, interval=interval, limit=limit, columnar=columnar
+    )
     
-    return {
+    payload = {
         "symbol": symbol,
         "interval": interval,
-        "count": len(data),
+        "count": len(data["time"]) if columnar else len(data),
         "data": data
     }
+    if columnar:
+        payload["format"] = "columnar"
+    return ResponseFormatService.render(media_type, payload, table_key="data")
+
+
+@router.get("/export")
+async def export_ohlc(
+    request: Request,
+    symbol: str = Query(..., description="Mã chứng khoán"),
+    start_time: datetime = Query(..., description="Thời gian bắt đầu"),
+    end_time: Optional[datetime] = Query(None, description="Thời gian kết thúc (mặc định: hiện tại)"),
+    interval: str = Query("1m", description="Interval: 1m, 5m, 15m, 1h, 4h, 1d, 1w..."),
+    format: Optional[str] = Query(None, pattern="^(ndjson|arrow)$", description="ndjson hoặc arrow (mặc định theo header Accept, fallback ndjson)"),
+    page_size: int = Query(5000, ge=100, le=50000, description="Số nến mỗi lần query ClickHouse"),
+    after: Optional[int] = Query(None, description="Cursor: unix timestamp (giây) của nến cuối đã nhận, để tiếp tục export"),
+    ch_client: ClickHouseExecutor = Depends(get_clickhouse)
+):
+    """
+    Stream toàn bộ nến OHLC của một khoảng thời gian dài (không giới hạn số lượng), time tăng dần
+    Dữ liệu được đọc từ ClickHouse theo từng page keyset và gửi ngay nên bộ nhớ server không phụ thuộc độ dài khoảng thời gian
+    """
+    if not end_time:
+        end_time = datetime.now()
+    if ClickHouseRepository.parse_interval(interval) is None:
+        raise HTTPException(
+            status_code=400,
+            detail="Invalid interval. Must be <number><unit> with unit m, h, d or w (e.g. 1m, 15m, 4h, 1d, 1w)"
+        )
+    
+    headers = {}
+    if format is None:
+        format = "arrow" if ResponseFormatService.negotiate(request) == ResponseFormatService.ARROW else "ndjson"
+        headers.update(ResponseFormatService.VARY_HEADERS)
+    if format == "arrow" and ResponseFormatService.ARROW not in ResponseFormatService.available_formats():
+        raise HTTPException(status_code=400, detail="Arrow export is not available (pyarrow is not installed)")
+    
+    export_args = dict(
+        ch_client=ch_client,
+        symbol=symbol,
+        start_time=start_time,
+        end_time=end_time,
+        interval=interval,
+        page_size=page_size,
+        after=after
+    )
+    safe_symbol = "".join(c for c in symbol if c.isalnum())
+    filename = f"{safe_symbol}_{interval}_{start_time:%Y%m%d}_{end_time:%Y%m%d}"
+    if format == "arrow":
+        return StreamingResponse(
+            OhlcExportService.stream_arrow(**export_args),
+            media_type=ResponseFormatService.ARROW,
+            headers={**headers, "Content-Disposition": f'attachment; filename="{filename}.arrows"'}
+        )
+    return StreamingResponse(
+        OhlcExportService.stream_ndjson(**export_args),
+        media_type="application/x-ndjson",
+        headers={**headers, "Content-Disposition": f'attachment; filename="{filename}.ndjson"'}
+    )
 
 
 @router.get("/{symbol}/price")
 async def get_current_price(
+    request: Request,
     symbol: str,
-    ch_client = Depends(get_clickhouse)
+    ch_client: ClickHouseExecutor = Depends(get_clickhouse)
 ):
     """Lấy giá hiện tại của cổ phiếu (bao gồm open của phiên hôm nay)"""
     repo = ClickHouseRepository(ch_client)
     
     # Lấy candle mới nhất
-    data = repo.get_latest_ohlc(symbol=symbol, interval="1m", limit=1)
+    data = await ch_client.run(repo.get_latest_ohlc, symbol=symbol, interval="1m", limit=1)
     
     if not data:
         raise HTTPException(status_code=404, detail=f"No price data found for {symbol}")
@@ -91,7 +179,8 @@ async def get_current_price(
     
     # Lấy giá mở cửa của phiên hôm nay (candle đầu tiên sau 9:00)
     today = datetime.now().replace(hour=9, minute=0, second=0, microsecond=0)
-    today_data = repo.get_ohlc_historical(
+    today_data = await ch_client.run(
+        repo.get_ohlc_historical,
         symbol=symbol,
         start_time=today,
         end_time=datetime.now(),
@@ -101,7 +190,7 @@ async def get_current_price(
     
     opening_price = today_data[0]["open"] if today_data else latest.get("open", latest.get("close"))
     
-    return {
+    return ResponseFormatService.render(ResponseFormatService.negotiate(request, tabular=False), {
         "symbol": symbol,
         "price": latest.get("close"),
         "open": opening_price,
@@ -110,5 +199,5 @@ async def get_current_price(
         "close": latest.get("close"),
         "volume": latest.get("volume"),
         "time": latest.get("time")
-    }
+    })
 
@@ -2,20 +2,31 @@
 Portfolio Controllers
 """
 
-from fastapi import APIRouter, Depends, HTTPException, status, Query
+import base64
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Response
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from typing import List, Optional
-from datetime import datetime
-from app.database import get_db, get_clickhouse
+from typing import List, Optional, Tuple
+from datetime import datetime, timedelta, timezone
+from app.config import settings
+from app.database import get_db, get_async_db, get_clickhouse
 from app.schemas.portfolio import (
     PortfolioResponse, VirtualOrderCreate, VirtualOrderResponse,
-    VirtualPositionResponse, PortfolioSummary
+    VirtualPositionResponse, PortfolioSummary,
+    VirtualOrderBatchCreate, VirtualOrderBatchResponse, VirtualOrderBatchResult, EquityPoint
 )
+from app.repositories.equity_repository import AsyncEquitySnapshotRepository
 from app.repositories.portfolio_repository import (
-    PortfolioRepository, VirtualOrderRepository, VirtualPositionRepository
+    PortfolioRepository, VirtualOrderRepository, VirtualPositionRepository,
+    AsyncPortfolioRepository, AsyncVirtualOrderRepository
 )
 from app.services.trading_service import TradingService
-from app.controllers.auth import get_current_user
+from app.services.ledger_service import LedgerService
+from app.services.leaderboard_service import leaderboard
+from app.services.order_release_service import order_release_scheduler
+from app.services.position_reconciliation_service import PositionReconciliationService
+from app.controllers.auth import get_current_user, get_current_user_async
 from app.models.user import User
 
 router = APIRouter(prefix="/api/portfolio", tags=["Portfolio"])
@@ -23,11 +34,11 @@ router = APIRouter(prefix="/api/portfolio", tags=["Portfolio"])
 
 @router.get("", response_model=PortfolioResponse)
 async def get_portfolio(
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Lấy portfolio của user"""
-    portfolio = PortfolioRepository.get_or_create_portfolio(db, current_user.id)
+    portfolio = await AsyncPortfolioRepository.get_or_create_portfolio(db, current_user.id)
     return portfolio
 
 
@@ -38,10 +49,53 @@ async def get_portfolio_summary(
     ch_client = Depends(get_clickhouse)
 ):
     """Lấy portfolio summary với positions và giá real-time"""
-    summary = TradingService.get_portfolio_summary(db, current_user.id, ch_client)
+    # Các hàm có query ClickHouse chạy trong threadpool để không block event loop
+    summary = await run_in_threadpool(TradingService.get_portfolio_summary, db, current_user.id, ch_client)
     return summary
 
 
+@router.get("/equity-curve", response_model=List[EquityPoint])
+async def get_equity_curve(
+    start: Optional[datetime] = Query(None, description="Từ thời điểm (mặc định: 30 ngày trước)"),
+    end: Optional[datetime] = Query(None, description="Đến thời điểm (mặc định: hiện tại)"),
+    max_points: int = Query(1000, ge=10, le=10000, description="Số điểm tối đa (lấy mẫu đều nếu nhiều hơn)"),
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Equity curve của portfolio để vẽ chart: giá trị mark-to-market (cash, positions, lãi/lỗ chưa thực hiện)
+    ghi mỗi phút trong giờ giao dịch bởi scheduler (EQUITY_SNAPSHOT_INTERVAL_SECONDS)
+    """
+    if start is None:
+        start = datetime.now(timezone.utc) - timedelta(days=30)
+    points = await AsyncEquitySnapshotRepository.get_curve(db, current_user.id, start, end)
+    if len(points) > max_points:
+        # Lấy mẫu đều tối đa max_points - 1 điểm trước điểm cuối, rồi luôn thêm điểm cuối cùng (không trùng)
+        step = -(-(len(points) - 1) // (max_points - 1))
+        points = points[:-1:step] + [points[-1]]
+    return points
+
+
+@router.get("/leaderboard")
+async def get_leaderboard(
+    limit: int = Query(10, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    current_user: User = Depends(get_current_user_async),
+    ch_client = Depends(get_clickhouse)
+):
+    """
+    Bảng xếp hạng portfolios theo giá trị mark-to-market và hạng của user hiện tại
+    (ranking giữ trong bộ nhớ, định giá lại mọi portfolio mỗi LEADERBOARD_REFRESH_SECONDS)
+    """
+    await run_in_threadpool(leaderboard.ensure_fresh, ch_client)
+    return {
+        "top": leaderboard.top(limit, offset),
+        "me": leaderboard.rank_of(current_user.id),
+        "total": leaderboard.stats()["users"],
+        "refreshed_at": leaderboard.refreshed_at
+    }
+
+
 @router.get("/positions", response_model=List[VirtualPositionResponse])
 async def get_positions(
     current_user: User = Depends(get_current_user),
@@ -56,46 +110,30 @@ async def get_positions(
     """
     # Tự động check và fill QUEUED MARKET orders nếu đang trong giờ giao dịch
     # (Ngoài giờ giao dịch không có giá real-time, nên không fill được)
-    TradingService.check_and_fill_queued_market_orders(db, user_id=current_user.id, ch_client=ch_client)
+    # Scheduler đang chạy thì QUEUED orders đã được fill hàng loạt lúc mở phiên
+    if not order_release_scheduler.is_running:
+        await run_in_threadpool(
+            TradingService.check_and_fill_queued_market_orders, db, user_id=current_user.id, ch_client=ch_client
+        )
     # Tự động check và fill LIMIT orders khi giá đạt mức giới hạn
-    TradingService.check_and_fill_limit_orders(db, user_id=current_user.id, ch_client=ch_client)
+    await run_in_threadpool(
+        TradingService.check_and_fill_limit_orders, db, user_id=current_user.id, ch_client=ch_client
+    )
     
     # Validate positions: chỉ lấy positions có order FILLED tương ứng
-    from sqlalchemy import func
-    from app.models.portfolio import VirtualOrder
-    
-    all_positions = VirtualPositionRepository.get_all_by_user(db, current_user.id)
-    valid_positions = []
-    
-    for position in all_positions:
-        # Tính expected quantity từ orders FILLED
-        buy_quantity = db.query(func.sum(VirtualOrder.quantity)).filter(
-            VirtualOrder.user_id == current_user.id,
-            VirtualOrder.symbol == position.symbol,
-            VirtualOrder.side == "BUY",
-            VirtualOrder.status == "FILLED"
-        ).scalar() or 0
-        
-        sell_quantity = db.query(func.sum(VirtualOrder.quantity)).filter(
-            VirtualOrder.user_id == current_user.id,
-            VirtualOrder.symbol == position.symbol,
-            VirtualOrder.side == "SELL",
-            VirtualOrder.status == "FILLED"
-        ).scalar() or 0
-        
-        expected_quantity = buy_quantity - sell_quantity
-        
-        # Chỉ trả về position nếu quantity khớp với orders FILLED
-        if position.quantity == expected_quantity and expected_quantity > 0:
-            valid_positions.append(position)
-        else:
-            # Log warning nếu có position không hợp lệ
-            print(f"⚠️  Invalid position detected: User {current_user.id}, {position.symbol}, "
-                  f"quantity={position.quantity}, expected={expected_quantity}")
-    
-    # Update với giá real-time
+    # (tổng orders FILLED của tất cả symbols được tính trong một query)
+    valid_positions, discrepancies = PositionReconciliationService.reconcile_user(db, current_user.id)
+    for item in discrepancies:
+        # Log warning nếu có position không hợp lệ
+        print(f"⚠️  Invalid position detected: User {current_user.id}, {item.symbol}, "
+              f"quantity={item.actual_quantity}, expected={item.expected_quantity}")
+    
+    # Update với giá real-time (một query cho tất cả positions)
+    prices = await run_in_threadpool(
+        TradingService.get_current_prices, ch_client, [position.symbol for position in valid_positions]
+    )
     for position in valid_positions:
-        current_price = TradingService.get_current_price(ch_client, position.symbol)
+        current_price = prices.get(position.symbol)
         if current_price:
             VirtualPositionRepository.update_position_price(db, position, current_price)
     
@@ -117,7 +155,9 @@ async def reset_portfolio_balance(
     portfolio = PortfolioRepository.get_or_create_portfolio(db, current_user.id)
     
     # Set cash balance và total value
+    previous_balance = portfolio.cash_balance
     PortfolioRepository.set_cash_balance(db, portfolio, Decimal(str(initial_balance)))
+    LedgerService.record_cash(db, current_user.id, portfolio.cash_balance - previous_balance, "RESET")
     
     return {
         "message": "Portfolio balance reset successfully",
@@ -141,6 +181,7 @@ async def add_portfolio_balance(
     
     # Thêm amount vào balance hiện tại
     PortfolioRepository.update_cash_balance(db, portfolio, Decimal(str(amount)))
+    LedgerService.record_cash(db, current_user.id, Decimal(str(amount)), "DEPOSIT")
     
     # Update total value
     portfolio.total_value = portfolio.cash_balance
@@ -155,38 +196,64 @@ async def add_portfolio_balance(
     }
 
 
+def _encode_order_cursor(order) -> str:
+    """Cursor của trang tiếp theo = (created_at, id) của order cuối trang"""
+    raw = f"{order.created_at.isoformat()}|{order.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def _decode_order_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        created_at, order_id = base64.urlsafe_b64decode(cursor.encode()).decode().rsplit("|", 1)
+        return datetime.fromisoformat(created_at), int(order_id)
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
+        )
+
+
 @router.get("/orders", response_model=List[VirtualOrderResponse])
 async def get_orders(
-    skip: int = Query(0, ge=0),
+    response: Response,
+    cursor: Optional[str] = Query(None, description="Cursor từ header X-Next-Cursor của trang trước"),
     limit: int = Query(100, ge=1, le=1000),
+    skip: int = Query(0, ge=0, deprecated=True, description="Dùng cursor thay skip (OFFSET chậm dần khi lịch sử dài)"),
     status_filter: Optional[str] = Query(None, description="Filter by status: PENDING, QUEUED, FILLED, CANCELLED, REJECTED"),
     trading_mode_filter: Optional[str] = Query(None, description="Filter by trading mode: REALTIME, PRACTICE"),
     order_type_filter: Optional[str] = Query(None, description="Filter by order type: MARKET, LIMIT, ATO, ATC"),
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
 ):
-    """Lấy lịch sử orders của user"""
-    orders = VirtualOrderRepository.get_by_user(db, current_user.id, skip=skip, limit=limit)
-    
-    if status_filter:
-        orders = [o for o in orders if o.status == status_filter.upper()]
-    
-    if trading_mode_filter:
-        orders = [o for o in orders if o.trading_mode == trading_mode_filter.upper()]
-    
-    if order_type_filter:
-        orders = [o for o in orders if o.order_type == order_type_filter.upper()]
+    """
+    Lấy lịch sử orders của user, mới nhất trước
     
+    Filters được áp dụng trong SQL nên mỗi trang luôn đủ `limit` orders (trừ trang cuối).
+    Phân trang keyset: header `X-Next-Cursor` của response là cursor cho trang tiếp theo (không có header = hết).
+    """
+    before = _decode_order_cursor(cursor) if cursor else None
+    orders = await AsyncVirtualOrderRepository.get_by_user(
+        db,
+        current_user.id,
+        skip=0 if before else skip,
+        limit=limit,
+        status=status_filter.upper() if status_filter else None,
+        trading_mode=trading_mode_filter.upper() if trading_mode_filter else None,
+        order_type=order_type_filter.upper() if order_type_filter else None,
+        before=before
+    )
+    if len(orders) == limit:
+        response.headers["X-Next-Cursor"] = _encode_order_cursor(orders[-1])
     return orders
 
 
 @router.get("/orders/pending-ato-atc", response_model=List[VirtualOrderResponse])
 async def get_pending_ato_atc_orders(
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Lấy danh sách pending ATO/ATC orders của user"""
-    orders = VirtualOrderRepository.get_pending_ato_atc_orders(db, user_id=current_user.id)
+    orders = await AsyncVirtualOrderRepository.get_pending_ato_atc_orders(db, user_id=current_user.id)
     return orders
 
 
@@ -206,7 +273,9 @@ async def create_order(
     - PRACTICE mode: Không kiểm tra giờ giao dịch, fill ngay
     """
     try:
-        order, error = TradingService.create_order(db, current_user.id, order_data, ch_client)
+        order, error = await run_in_threadpool(
+            TradingService.create_order, db, current_user.id, order_data, ch_client
+        )
         if error and order is None:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
@@ -226,6 +295,50 @@ async def create_order(
         )
 
 
+@router.post("/orders/batch", response_model=VirtualOrderBatchResponse)
+async def create_orders_batch(
+    batch: VirtualOrderBatchCreate,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+    ch_client = Depends(get_clickhouse)
+):
+    """
+    Tạo nhiều orders trong một request (rebalance portfolio, thang LIMIT orders)
+    
+    - Mỗi order xử lý như POST /orders, theo thứ tự trong danh sách
+    - Giá lấy một lần cho mỗi symbol, validate một lượt trên cùng tiền khả dụng/cổ phiếu, ghi trong một transaction
+    - Trả về kết quả từng order (order hoặc error); atomic=true: một order lỗi thì không tạo order nào
+    """
+    if len(batch.orders) > settings.ORDER_BATCH_MAX_SIZE:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Batch too large: {len(batch.orders)} orders (max {settings.ORDER_BATCH_MAX_SIZE})"
+        )
+    try:
+        results = await run_in_threadpool(
+            TradingService.create_orders_batch, db, current_user.id, batch.orders, ch_client, batch.atomic
+        )
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Internal server error: {str(e)}"
+        )
+    
+    items = [
+        VirtualOrderBatchResult(
+            index=index,
+            order=VirtualOrderResponse.model_validate(order) if order is not None else None,
+            error=message if order is None else None,
+            message=message if order is not None else None
+        )
+        for index, (order, message) in enumerate(results)
+    ]
+    created = sum(1 for item in items if item.order is not None)
+    return VirtualOrderBatchResponse(created=created, failed=len(items) - created, results=items)
+
+
 @router.delete("/orders/{order_id}", response_model=VirtualOrderResponse)
 async def cancel_order(
     order_id: int,
@@ -245,11 +358,11 @@ async def cancel_order(
 @router.get("/orders/{order_id}", response_model=VirtualOrderResponse)
 async def get_order(
     order_id: int,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Lấy chi tiết order"""
-    order = VirtualOrderRepository.get_by_id(db, order_id)
+    order = await AsyncVirtualOrderRepository.get_by_id(db, order_id)
     if not order or order.user_id != current_user.id:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -266,7 +379,7 @@ async def fill_order(
     db: Session = Depends(get_db),
     ch_client = Depends(get_clickhouse)
 ):
-    """Fill order với giá cụ thể (dùng cho ATO/ATC)"""
+    """Fill order với giá cụ thể (ATO/ATC được fill tự động theo giá khớp định kỳ, endpoint này để fill thủ công)"""
     from decimal import Decimal
     
     order = VirtualOrderRepository.get_by_id(db, order_id)
@@ -276,7 +389,9 @@ async def fill_order(
             detail="Order not found"
         )
     
-    filled_order, error = TradingService.fill_order(db, order_id, Decimal(str(fill_price)), ch_client)
+    filled_order, error = await run_in_threadpool(
+        TradingService.fill_order, db, order_id, Decimal(str(fill_price)), ch_client
+    )
     if error:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -297,7 +412,8 @@ async def update_portfolio_value(
     Cập nhật portfolio value
     
     - Real-time mode (as_of_date=None): Cập nhật với giá hiện tại
-    - Simulation mode (as_of_date có giá trị): Tính toán tại thời điểm cụ thể, không cập nhật DB
+    - Simulation mode (as_of_date có giá trị): Cash/positions tại thời điểm đó (từ sổ cái) với giá
+      tại thời điểm đó, không cập nhật DB
     """
     as_of_datetime = None
     if as_of_date:
@@ -312,7 +428,8 @@ async def update_portfolio_value(
                     detail="Invalid date format. Use 'YYYY-MM-DD HH:MM:SS' or 'YYYY-MM-DD'"
                 )
     
-    result = TradingService.update_portfolio_value(
+    result = await run_in_threadpool(
+        TradingService.update_portfolio_value,
         db, 
         current_user.id, 
         ch_client, 
@@ -364,7 +481,8 @@ async def check_limit_orders(
                     detail="Invalid date format. Use 'YYYY-MM-DD HH:MM:SS' or 'YYYY-MM-DD'"
                 )
     
-    result = TradingService.check_and_fill_limit_orders(
+    result = await run_in_threadpool(
+        TradingService.check_and_fill_limit_orders,
         db,
         user_id=current_user.id,
         ch_client=ch_client,
@@ -388,7 +506,8 @@ async def check_queued_orders(
     - Ngoài giờ giao dịch không có giá real-time, nên không thể fill
     - MARKET orders sẽ được fill với giá hiện tại khi vào giờ giao dịch
     """
-    result = TradingService.check_and_fill_queued_market_orders(
+    result = await run_in_threadpool(
+        TradingService.check_and_fill_queued_market_orders,
         db,
         user_id=current_user.id,
         ch_client=ch_client
@@ -408,55 +527,20 @@ async def cleanup_invalid_positions(
     Positions chỉ được tạo khi orders FILLED. Nếu có positions không hợp lệ,
     có thể do dữ liệu cũ từ trước khi sửa logic.
     """
-    from sqlalchemy import func
-    from app.models.portfolio import VirtualOrder, VirtualPosition
+    _, discrepancies = PositionReconciliationService.reconcile_user(db, current_user.id)
     
-    all_positions = VirtualPositionRepository.get_all_by_user(db, current_user.id)
-    invalid_positions = []
-    
-    for position in all_positions:
-        # Tính expected quantity từ orders FILLED
-        buy_quantity = db.query(func.sum(VirtualOrder.quantity)).filter(
-            VirtualOrder.user_id == current_user.id,
-            VirtualOrder.symbol == position.symbol,
-            VirtualOrder.side == "BUY",
-            VirtualOrder.status == "FILLED"
-        ).scalar() or 0
-        
-        sell_quantity = db.query(func.sum(VirtualOrder.quantity)).filter(
-            VirtualOrder.user_id == current_user.id,
-            VirtualOrder.symbol == position.symbol,
-            VirtualOrder.side == "SELL",
-            VirtualOrder.status == "FILLED"
-        ).scalar() or 0
-        
-        expected_quantity = buy_quantity - sell_quantity
-        
-        # Nếu quantity không khớp hoặc expected = 0 nhưng position vẫn tồn tại
-        if position.quantity != expected_quantity or (expected_quantity == 0 and position.quantity > 0):
-            invalid_positions.append({
-                "position": position,
-                "expected": expected_quantity,
-                "actual": position.quantity
-            })
-    
-    # Xóa invalid positions
-    deleted_count = 0
-    for item in invalid_positions:
-        position = item["position"]
-        db.delete(position)
-        deleted_count += 1
-    
-    db.commit()
+    # Xóa invalid positions (một câu DELETE)
+    invalid_positions = [item for item in discrepancies if item.position_id is not None]
+    deleted_count = PositionReconciliationService.delete_invalid_positions(db, invalid_positions)
     
     return {
         "message": f"Đã xóa {deleted_count} positions không hợp lệ",
         "deleted_count": deleted_count,
         "details": [
             {
-                "symbol": item["position"].symbol,
-                "actual_quantity": item["actual"],
-                "expected_quantity": item["expected"]
+                "symbol": item.symbol,
+                "actual_quantity": item.actual_quantity,
+                "expected_quantity": item.expected_quantity
             }
             for item in invalid_positions
         ]
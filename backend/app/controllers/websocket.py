@@ -4,11 +4,14 @@ WebSocket Controllers - Real-time OHLC Updates
 
 import json
 import asyncio
-from typing import Dict, Set
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Set, Tuple
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends, Query, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from sqlalchemy.orm import Session
 from datetime import datetime, timedelta
+from app.config import settings
 from app.database import get_clickhouse, get_db
 from app.repositories.clickhouse_repository import ClickHouseRepository
 from app.services.auth_service import AuthService
@@ -19,63 +22,233 @@ logger = logging.getLogger(__name__)
 
 router = APIRouter(tags=["WebSocket"])
 
-# Store active WebSocket connections
+class ClientConnection:
+    """
+    Một WebSocket client: các symbols đã subscribe, hàng đợi gửi và writer task riêng
+    Mọi message (kể cả connected / pong) đi qua hàng đợi giới hạn, chỉ writer task gửi trên socket.
+    """
+    
+    def __init__(self, websocket: WebSocket, symbols: List[str], user_id: Optional[int] = None):
+        self.websocket = websocket
+        self.symbols = symbols
+        self.user_id = user_id
+        self.queue: Deque[Tuple[float, Optional[str], str]] = deque()  # (thời điểm broadcast, symbol, JSON)
+        self.wakeup = asyncio.Event()
+        self.writer: Optional[asyncio.Task] = None
+        self.closed = False
+        self.close_code: Optional[int] = None
+        self.sent = 0
+        self.dropped = 0
+
+
 class ConnectionManager:
-    """Quản lý WebSocket connections"""
+    """
+    Quản lý WebSocket connections và fan-out updates theo symbol
     
-    def __init__(self):
-        # {symbol: {websocket1, websocket2, ...}}
-        self.active_connections: Dict[str, Set[WebSocket]] = {}
-        # {websocket: user_id}
-        self.websocket_users: Dict[WebSocket, int] = {}
+    - Mỗi connection có hàng đợi gửi giới hạn (send_queue_size) và một writer task: broadcast chỉ thêm message
+      vào hàng đợi của các subscribers, không await socket nào, nên một client chậm không làm trễ các client khác
+    - Message được encode JSON một lần cho mỗi broadcast, writer gửi text đã encode
+    - Hàng đợi đầy (client đọc chậm hơn tốc độ update), theo slow_consumer_policy:
+      - coalesce: bỏ update cũ nhất cùng symbol còn trong hàng đợi (client vẫn nhận nến mới nhất),
+        không có thì bỏ update cũ nhất của symbol khác; message điều khiển (connected / pong) không bao giờ
+        bị bỏ khỏi hàng đợi, hàng đợi chỉ còn message điều khiển thì bỏ message mới
+      - drop: bỏ update mới
+      - disconnect: đóng connection với code 1013 (client reconnect)
+    - Một lần gửi quá send_timeout_seconds (socket bị nghẽn): đóng connection với code 1013
+    - Broadcast lag: thời gian từ lúc broadcast đến lúc writer gửi xong, xem stats()
+    """
     
-    async def connect(self, websocket: WebSocket, symbol: str, user_id: int = None):
-        """Kết nối WebSocket và subscribe vào symbol"""
-        await websocket.accept()
+    POLICIES = ("coalesce", "drop", "disconnect")
+    CLOSE_TRY_AGAIN_LATER = 1013
+    
+    def __init__(self, send_queue_size: int = 32, slow_consumer_policy: str = "coalesce", send_timeout_seconds: float = 10):
+        if slow_consumer_policy not in self.POLICIES:
+            raise ValueError(f"slow_consumer_policy must be one of {', '.join(self.POLICIES)}")
+        self.send_queue_size = max(1, send_queue_size)
+        self.slow_consumer_policy = slow_consumer_policy
+        self.send_timeout_seconds = send_timeout_seconds
         
-        if symbol not in self.active_connections:
-            self.active_connections[symbol] = set()
+        # {symbol: {connection1, connection2, ...}}
+        self.active_connections: Dict[str, Set[ClientConnection]] = {}
+        self.connections: Set[ClientConnection] = set()
         
-        self.active_connections[symbol].add(websocket)
-        if user_id:
-            self.websocket_users[websocket] = user_id
+        # Metrics
+        self.broadcasts = 0
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.slow_disconnects = 0
+        self.last_fanout_ms = 0.0
+        self._lag_samples: Deque[float] = deque(maxlen=1000)  # giây, các lần gửi broadcast gần nhất
+    
+    async def connect(self, websocket: WebSocket, symbols: List[str], user_id: int = None) -> ClientConnection:
+        """Accept WebSocket (một lần) và subscribe vào các symbols"""
+        await websocket.accept()
         
-        logger.info(f"WebSocket connected: symbol={symbol}, user_id={user_id}, total={len(self.active_connections[symbol])}")
+        connection = ClientConnection(websocket, symbols, user_id)
+        self.connections.add(connection)
+        for symbol in symbols:
+            self.active_connections.setdefault(symbol, set()).add(connection)
+        connection.writer = asyncio.create_task(self._write_loop(connection))
+        
+        logger.info(f"WebSocket connected: symbols={','.join(symbols)}, user_id={user_id}, total={len(self.connections)}")
+        return connection
     
-    def disconnect(self, websocket: WebSocket, symbol: str):
-        """Ngắt kết nối WebSocket"""
-        if symbol in self.active_connections:
-            self.active_connections[symbol].discard(websocket)
-            if len(self.active_connections[symbol]) == 0:
-                del self.active_connections[symbol]
+    def disconnect(self, connection: ClientConnection, close_code: Optional[int] = None):
+        """
+        Bỏ connection khỏi mọi symbol và dừng writer (gọi nhiều lần không sao)
+        close_code: writer đóng socket với code này (server chủ động ngắt client chậm)
+        """
+        if connection.closed:
+            return
+        connection.closed = True
+        connection.close_code = close_code
+        connection.queue.clear()
+        connection.wakeup.set()
         
-        if websocket in self.websocket_users:
-            del self.websocket_users[websocket]
+        self.connections.discard(connection)
+        for symbol in connection.symbols:
+            subscribers = self.active_connections.get(symbol)
+            if subscribers is not None:
+                subscribers.discard(connection)
+                if not subscribers:
+                    del self.active_connections[symbol]
         
-        logger.info(f"WebSocket disconnected: symbol={symbol}")
+        logger.info(f"WebSocket disconnected: symbols={','.join(connection.symbols)}")
     
-    async def broadcast_to_symbol(self, symbol: str, message: dict):
-        """Gửi message đến tất cả clients đang subscribe symbol"""
-        if symbol not in self.active_connections:
+    @staticmethod
+    def encode(message: dict) -> str:
+        """JSON giống WebSocket.send_json của Starlette"""
+        return json.dumps(message, separators=(",", ":"), ensure_ascii=False)
+    
+    def send(self, connection: ClientConnection, message: dict):
+        """Gửi message điều khiển riêng cho một connection (connected, pong) qua hàng đợi giới hạn"""
+        if connection.closed:
             return
+        self._enqueue(connection, (time.monotonic(), None, self.encode(message)))
+    
+    def _enqueue(self, connection: ClientConnection, item: Tuple[float, Optional[str], str]):
+        """Thêm message vào hàng đợi (symbol None: message điều khiển), hàng đợi đầy thì theo slow_consumer_policy"""
+        queue = connection.queue
+        if len(queue) >= self.send_queue_size:
+            if self.slow_consumer_policy == "disconnect":
+                self.slow_disconnects += 1
+                self.disconnect(connection, close_code=self.CLOSE_TRY_AGAIN_LATER)
+                return
+            if self.slow_consumer_policy == "drop":
+                connection.dropped += 1
+                self.dropped += 1
+                return
+            # coalesce: update mới thay update cũ nhất cùng symbol, không có thì bỏ update cũ nhất
+            # (chỉ bỏ update có symbol, message điều khiển luôn được gửi)
+            symbol = item[1]
+            oldest_update = None
+            for i, queued in enumerate(queue):
+                if queued[1] is None:
+                    continue
+                if queued[1] == symbol:
+                    del queue[i]
+                    self.coalesced += 1
+                    break
+                if oldest_update is None:
+                    oldest_update = i
+            else:
+                connection.dropped += 1
+                self.dropped += 1
+                if oldest_update is None:
+                    return
+                del queue[oldest_update]
+        queue.append(item)
+        connection.wakeup.set()
+    
+    def broadcast_to_symbol(self, symbol: str, message: dict) -> int:
+        """
+        Đưa message vào hàng đợi của tất cả clients đang subscribe symbol (không chờ gửi)
+        Returns: Số subscribers
+        """
+        subscribers = self.active_connections.get(symbol)
+        if not subscribers:
+            return 0
+        
+        started = time.perf_counter()
+        item = (time.monotonic(), symbol, self.encode(message))
+        # Copy: policy disconnect có thể xóa connection khỏi set
+        for connection in list(subscribers):
+            self._enqueue(connection, item)
+        self.broadcasts += 1
+        self.last_fanout_ms = (time.perf_counter() - started) * 1000
+        return len(subscribers)
+    
+    async def _write_loop(self, connection: ClientConnection):
+        """Writer task của một connection: gửi lần lượt các message trong hàng đợi"""
+        websocket = connection.websocket
+        try:
+            while not connection.closed:
+                if not connection.queue:
+                    connection.wakeup.clear()
+                    await connection.wakeup.wait()
+                    continue
+                enqueued_at, symbol, text = connection.queue.popleft()
+                await asyncio.wait_for(websocket.send_text(text), self.send_timeout_seconds)
+                connection.sent += 1
+                self.sent += 1
+                if symbol is not None:
+                    self._lag_samples.append(time.monotonic() - enqueued_at)
+        except asyncio.TimeoutError:
+            logger.warning(
+                f"WebSocket send timed out after {self.send_timeout_seconds}s, "
+                f"closing slow consumer: symbols={','.join(connection.symbols)}"
+            )
+            self.slow_disconnects += 1
+            self.disconnect(connection, close_code=self.CLOSE_TRY_AGAIN_LATER)
+        except Exception as e:
+            logger.error(f"Error sending to WebSocket: {e}")
+            self.disconnect(connection)
         
-        disconnected = set()
-        for websocket in self.active_connections[symbol]:
+        if connection.close_code is not None:
             try:
-                await websocket.send_json(message)
-            except Exception as e:
-                logger.error(f"Error sending to WebSocket: {e}")
-                disconnected.add(websocket)
+                await asyncio.wait_for(websocket.close(code=connection.close_code), self.send_timeout_seconds)
+            except Exception:
+                pass
+    
+    def stats(self) -> Dict:
+        """Metrics fan-out (để monitor): connections, hàng đợi, message bị bỏ / gộp, broadcast lag (ms)"""
+        lags = sorted(self._lag_samples)
+        
+        def percentile(p: float) -> Optional[float]:
+            if not lags:
+                return None
+            return round(lags[min(len(lags) - 1, int(p * len(lags)))] * 1000, 2)
         
-        # Remove disconnected connections
-        for ws in disconnected:
-            self.disconnect(ws, symbol)
+        queued = [len(connection.queue) for connection in self.connections]
+        return {
+            "connections": len(self.connections),
+            "symbols": len(self.active_connections),
+            "subscriptions": sum(len(subscribers) for subscribers in self.active_connections.values()),
+            "slow_consumer_policy": self.slow_consumer_policy,
+            "send_queue_size": self.send_queue_size,
+            "queued": sum(queued),
+            "max_queued": max(queued, default=0),
+            "broadcasts": self.broadcasts,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "slow_disconnects": self.slow_disconnects,
+            "last_fanout_ms": round(self.last_fanout_ms, 3),
+            "lag_ms": {"p50": percentile(0.5), "p99": percentile(0.99), "max": percentile(1.0)}
+        }
 
 # Global connection manager
-manager = ConnectionManager()
+manager = ConnectionManager(
+    send_queue_size=settings.WEBSOCKET_SEND_QUEUE_SIZE,
+    slow_consumer_policy=settings.WEBSOCKET_SLOW_CONSUMER_POLICY,
+    send_timeout_seconds=settings.WEBSOCKET_SEND_TIMEOUT_SECONDS
+)
 
-# Store last candle data để detect updates (cả timestamp và hash của data)
-last_candle_data: Dict[str, Dict] = {}  # {symbol: {"time": datetime, "hash": str}}
+# Nến đã push gần nhất của mỗi symbol để detect updates: {symbol: (time, open, high, low, close, volume)}
+last_candle_data: Dict[str, Tuple] = {}
+
+CANDLE_FIELDS = ("time", "open", "high", "low", "close", "volume")
 
 # Background task để monitor và push updates
 async def monitor_ohlc_updates(ch_client, symbols: Set[str], interval_seconds: int = 5):
@@ -83,96 +256,47 @@ async def monitor_ohlc_updates(ch_client, symbols: Set[str], interval_seconds: i
     Background task để monitor OHLC updates và push qua WebSocket
     
     Logic:
-    - Detect candle mới (timestamp mới)
-    - Detect update trong cùng phút (timestamp giống nhưng data thay đổi)
+    - Một query lấy nến mới nhất của tất cả symbols đang có subscribers
+    - Push khi có candle mới (time lớn hơn) hoặc candle cùng phút có giá / volume thay đổi
+      (so sánh tuple các giá trị với lần push trước)
     
     Args:
         ch_client: ClickHouse client
         symbols: Set các symbols cần monitor
         interval_seconds: Khoảng thời gian check (giây)
     """
+    # Bỏ symbols không còn ai xem: subscriber mới sau này nhận ngay nến hiện tại
+    for symbol in set(last_candle_data) - symbols:
+        del last_candle_data[symbol]
     if not symbols:
         return
     
     repo = ClickHouseRepository(ch_client)
     
     try:
-        for symbol in symbols:
-            try:
-                # Lấy OHLC mới nhất
-                latest_data = repo.get_latest_ohlc(symbol, interval="1m", limit=1)
-                
-                if latest_data and len(latest_data) > 0:
-                    latest_candle = latest_data[0]
-                    candle_time = latest_candle["time"]
-                    
-                    # Tạo hash của candle data để detect update trong cùng phút
-                    import hashlib
-                    candle_hash = hashlib.md5(
-                        f"{latest_candle.get('open')}_{latest_candle.get('high')}_{latest_candle.get('low')}_{latest_candle.get('close')}_{latest_candle.get('volume')}".encode()
-                    ).hexdigest()
-                    
-                    # Parse candle_time để so sánh
-                    if isinstance(candle_time, str):
-                        try:
-                            # Thử parse ISO format trước
-                            if 'T' in candle_time:
-                                candle_datetime = datetime.fromisoformat(candle_time.replace('Z', '+00:00'))
-                            else:
-                                candle_datetime = datetime.strptime(candle_time, '%Y-%m-%d %H:%M:%S')
-                        except Exception as parse_error:
-                            logger.warning(f"Error parsing candle_time {candle_time}: {parse_error}")
-                            # Nếu parse fail, skip candle này
-                            continue
-                    else:
-                        candle_datetime = candle_time
-                    
-                    # Đảm bảo datetime là naive (không có timezone) để so sánh dễ dàng
-                    if candle_datetime.tzinfo is not None:
-                        candle_datetime = candle_datetime.replace(tzinfo=None)
-                    
-                    # Kiểm tra xem có update không:
-                    # 1. Candle mới (timestamp mới)
-                    # 2. Cùng timestamp nhưng data thay đổi (update trong cùng phút)
-                    should_push = False
-                    
-                    if symbol not in last_candle_data:
-                        # Lần đầu tiên, luôn push
-                        should_push = True
-                    else:
-                        last_data = last_candle_data[symbol]
-                        last_time = last_data.get("time")
-                        last_hash = last_data.get("hash")
-                        
-                        # Candle mới (timestamp mới)
-                        if candle_datetime > last_time:
-                            should_push = True
-                        # Cùng timestamp nhưng data thay đổi (update trong cùng phút)
-                        elif candle_datetime == last_time and candle_hash != last_hash:
-                            should_push = True
-                    
-                    if should_push:
-                        # Cập nhật last_candle_data
-                        last_candle_data[symbol] = {
-                            "time": candle_datetime,
-                            "hash": candle_hash
-                        }
-                        
-                        # Push update đến tất cả clients subscribe symbol này
-                        await manager.broadcast_to_symbol(symbol, {
-                            "type": "ohlc_update",
-                            "symbol": symbol,
-                            "data": latest_candle,
-                            "timestamp": datetime.now().isoformat()
-                        })
-                        
-                        logger.debug(f"Pushed OHLC update: {symbol} at {candle_time} (hash: {candle_hash[:8]})")
-            
-            except Exception as e:
-                logger.error(f"Error monitoring {symbol}: {e}")
-    
+        latest_candles = await ch_client.run(repo.get_latest_candles, list(symbols), interval="1m")
     except Exception as e:
         logger.error(f"Error in monitor_ohlc_updates: {e}")
+        return
+    
+    for symbol, latest_candle in latest_candles.items():
+        # time là ISO string cùng format nên so sánh chuỗi đúng thứ tự thời gian
+        snapshot = tuple(latest_candle.get(field) for field in CANDLE_FIELDS)
+        last_snapshot = last_candle_data.get(symbol)
+        if last_snapshot is not None and (snapshot[0] < last_snapshot[0] or snapshot == last_snapshot):
+            continue
+        
+        last_candle_data[symbol] = snapshot
+        
+        # Push update đến tất cả clients subscribe symbol này
+        manager.broadcast_to_symbol(symbol, {
+            "type": "ohlc_update",
+            "symbol": symbol,
+            "data": latest_candle,
+            "timestamp": datetime.now().isoformat()
+        })
+        
+        logger.debug(f"Pushed OHLC update: {symbol} at {latest_candle['time']}")
 
 
 async def authenticate_websocket(websocket: WebSocket, token: str = None) -> int:
@@ -228,11 +352,11 @@ async def websocket_ohlc(
             logger.info(f"Authenticated WebSocket connection: user_id={user_id}, symbol={symbol}")
     
     # Kết nối
-    await manager.connect(websocket, symbol, user_id)
+    connection = await manager.connect(websocket, [symbol], user_id)
     
     try:
         # Gửi welcome message
-        await websocket.send_json({
+        manager.send(connection, {
             "type": "connected",
             "symbol": symbol,
             "interval": interval,
@@ -249,10 +373,10 @@ async def websocket_ohlc(
                 try:
                     message = json.loads(data)
                     if message.get("type") == "ping":
-                        await websocket.send_json({"type": "pong"})
+                        manager.send(connection, {"type": "pong"})
                 except json.JSONDecodeError:
                     pass
-                    
+            
             except WebSocketDisconnect:
                 break
             except Exception as e:
@@ -264,7 +388,7 @@ async def websocket_ohlc(
     except Exception as e:
         logger.error(f"WebSocket error: {e}")
     finally:
-        manager.disconnect(websocket, symbol)
+        manager.disconnect(connection)
 
 
 @router.websocket("/ws/ohlc")
@@ -283,14 +407,14 @@ async def websocket_ohlc_multiple(
     if token:
         user_id = await authenticate_websocket(websocket, token)
     
-    symbol_list = [s.strip().upper() for s in symbols.split(",")]
+    # Bỏ trùng / rỗng, giữ thứ tự
+    symbol_list = list(dict.fromkeys(s.strip().upper() for s in symbols.split(",") if s.strip()))
     
-    # Kết nối với tất cả symbols
-    for symbol in symbol_list:
-        await manager.connect(websocket, symbol, user_id)
+    # Accept một lần, subscribe tất cả symbols
+    connection = await manager.connect(websocket, symbol_list, user_id)
     
     try:
-        await websocket.send_json({
+        manager.send(connection, {
             "type": "connected",
             "symbols": symbol_list,
             "message": f"Connected to {len(symbol_list)} symbols"
@@ -303,7 +427,7 @@ async def websocket_ohlc_multiple(
                 try:
                     message = json.loads(data)
                     if message.get("type") == "ping":
-                        await websocket.send_json({"type": "pong"})
+                        manager.send(connection, {"type": "pong"})
                 except json.JSONDecodeError:
                     pass
             except WebSocketDisconnect:
@@ -315,8 +439,7 @@ async def websocket_ohlc_multiple(
         logger.error(f"WebSocket error: {e}")
     finally:
         # Disconnect từ tất cả symbols
-        for symbol in symbol_list:
-            manager.disconnect(websocket, symbol)
+        manager.disconnect(connection)
 
 
 # Background task để start monitoring (sẽ được start trong main.py)
@@ -16,10 +16,20 @@ else:
     if fallback_path.exists():
         load_dotenv(dotenv_path=fallback_path)
 
+import asyncio
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from clickhouse_driver import Client as CHClient
+from clickhouse_driver import errors as ch_errors
 from app.config import settings
 
 # ============================================================
@@ -48,20 +58,315 @@ def get_db():
         db.close()
 
 
+# Async engine (asyncpg) cho các route đã chuyển sang Async*Repository
+# expire_on_commit=False: object vẫn đọc được sau commit mà không cần lazy load (không dùng được trong async)
+async_engine = create_async_engine(
+    settings.postgres_async_url,
+    pool_pre_ping=True,
+    pool_size=10,
+    max_overflow=20,
+    echo=settings.DEBUG
+)
+
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+
+
+async def get_async_db():
+    """Dependency để lấy async database session"""
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
 # ============================================================
 # ClickHouse
 # ============================================================
 
-ch_client = CHClient(
-    host=settings.CLICKHOUSE_HOST,
-    port=settings.CLICKHOUSE_PORT,
-    database=settings.CLICKHOUSE_DB,
-    user=settings.CLICKHOUSE_USER,
-    password=settings.CLICKHOUSE_PASSWORD
+def create_clickhouse_client() -> CHClient:
+    """Tạo ClickHouse client mới (dùng cho background workers cần connection riêng)"""
+    return CHClient(
+        host=settings.CLICKHOUSE_HOST,
+        port=settings.CLICKHOUSE_PORT,
+        database=settings.CLICKHOUSE_DB,
+        user=settings.CLICKHOUSE_USER,
+        password=settings.CLICKHOUSE_PASSWORD
+    )
+
+
+class ClickHouseTimeoutError(Exception):
+    """Query ClickHouse chạy quá CLICKHOUSE_QUERY_TIMEOUT_SECONDS"""
+    pass
+
+
+class ClickHousePoolTimeoutError(ClickHouseTimeoutError):
+    """Không lấy được connection từ pool trong CLICKHOUSE_POOL_TIMEOUT_SECONDS"""
+    pass
+
+
+class ClickHouseConnectionPool:
+    """
+    Pool các ClickHouse client (clickhouse_driver.Client không dùng đồng thời được)
+    
+    - Mỗi lần checkout một client chỉ được một thread dùng, trả lại pool sau khi xong
+    - Tối đa max_size connections; hết connection thì chờ tối đa checkout_timeout giây
+    - Client idle lâu hơn ping_interval được ping trước khi dùng, chết thì tạo lại
+    - Client lỗi mạng trong lúc dùng bị bỏ (không trả lại pool), lần sau tạo connection mới
+    """
+    
+    # Lỗi cho thấy connection đã hỏng
+    _CONNECTION_ERRORS = (ch_errors.NetworkError, ch_errors.SocketTimeoutError, EOFError, OSError)
+    
+    def __init__(
+        self,
+        factory: Callable[[], CHClient],
+        min_size: int = 1,
+        max_size: int = 10,
+        checkout_timeout: float = 10,
+        ping_interval: float = 30
+    ):
+        self.factory = factory
+        self.min_size = min(min_size, max_size)
+        self.max_size = max_size
+        self.checkout_timeout = checkout_timeout
+        self.ping_interval = ping_interval
+        
+        self._idle = deque()  # (client, thời điểm trả về pool)
+        self._size = 0  # Tổng số client đã tạo (đang dùng + idle)
+        self._in_use = 0
+        self._cond = threading.Condition()
+        
+        # Metrics
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self.checkout_timeouts = 0
+        self.reconnects = 0
+        self.discarded = 0
+    
+    def warm_up(self):
+        """Tạo sẵn min_size connections (gọi lúc startup)"""
+        clients = []
+        try:
+            for _ in range(self.min_size - self._size):
+                clients.append(self._acquire())
+                clients[-1].connection.force_connect()
+        finally:
+            for client in clients:
+                self._release(client)
+    
+    @contextmanager
+    def connection(self):
+        """Checkout một client: with pool.connection() as client: client.execute(...)"""
+        client = self._acquire()
+        broken = False
+        try:
+            yield client
+        except self._CONNECTION_ERRORS:
+            broken = True
+            raise
+        finally:
+            self._release(client, broken)
+    
+    def _acquire(self) -> CHClient:
+        started = time.monotonic()
+        deadline = started + self.checkout_timeout
+        client, last_used, waited = None, None, False
+        
+        with self._cond:
+            while True:
+                if self._idle:
+                    # LIFO: dùng lại connection vừa trả, connection ít dùng sẽ nằm dưới đáy
+                    client, last_used = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.checkout_timeouts += 1
+                    raise ClickHousePoolTimeoutError(
+                        f"No ClickHouse connection available after {self.checkout_timeout}s "
+                        f"(pool size {self.max_size})"
+                    )
+                waited = True
+                self._cond.wait(remaining)
+            
+            self._in_use += 1
+            self.checkouts += 1
+            if waited:
+                wait_time = time.monotonic() - started
+                self.waits += 1
+                self.wait_time_total += wait_time
+                self.wait_time_max = max(self.wait_time_max, wait_time)
+        
+        # Tạo / kiểm tra connection ngoài lock
+        try:
+            if client is None:
+                client = self.factory()
+            elif time.monotonic() - last_used > self.ping_interval and not self._is_alive(client):
+                client.disconnect()
+                client = self.factory()
+                self.reconnects += 1
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        return client
+    
+    @staticmethod
+    def _is_alive(client: CHClient) -> bool:
+        """Liveness probe: client chưa connect coi như sống (sẽ connect khi execute)"""
+        try:
+            return not client.connection.connected or client.connection.ping()
+        except Exception:
+            return False
+    
+    def _release(self, client: CHClient, broken: bool = False):
+        if broken:
+            try:
+                client.disconnect()
+            except Exception:
+                pass
+        
+        with self._cond:
+            self._in_use -= 1
+            if broken:
+                self._size -= 1
+                self.discarded += 1
+            else:
+                self._idle.append((client, time.monotonic()))
+            self._cond.notify()
+    
+    def stats(self) -> Dict:
+        """Metrics của pool (để monitor / health check)"""
+        with self._cond:
+            return {
+                "size": self._size,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "wait_time_avg_ms": round(self.wait_time_total / self.waits * 1000, 2) if self.waits else 0.0,
+                "wait_time_max_ms": round(self.wait_time_max * 1000, 2),
+                "checkout_timeouts": self.checkout_timeouts,
+                "reconnects": self.reconnects,
+                "discarded": self.discarded
+            }
+    
+    def close(self):
+        """Đóng tất cả connections đang idle"""
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+        for client, _ in idle:
+            try:
+                client.disconnect()
+            except Exception:
+                pass
+
+
+class ClickHouseExecutor:
+    """
+    Lớp truy cập ClickHouse an toàn cho async route
+    
+    - execute(): giống Client.execute, mỗi lần gọi checkout một connection từ pool nên code sync
+      như ClickHouseRepository dùng được đồng thời ở mọi thread
+    - run(): chạy một hàm sync (vd method của ClickHouseRepository) trên thread pool giới hạn
+      CLICKHOUSE_MAX_WORKERS, event loop không bị block. Nếu quá timeout hoặc task bị cancel,
+      các query đang chạy của lần gọi đó bị KILL trên ClickHouse server.
+    """
+    
+    def __init__(self, pool: ClickHouseConnectionPool, max_workers: int, query_timeout: Optional[float] = None):
+        self.pool = pool
+        self.query_timeout = query_timeout or None
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="clickhouse")
+        self._local = threading.local()
+        self._control_client: Optional[CHClient] = None
+        self._control_lock = threading.Lock()
+    
+    def execute(self, query, params=None, **kwargs):
+        """Chạy query bằng một connection của pool (cùng tham số với Client.execute)"""
+        query_id = kwargs.pop("query_id", None) or uuid.uuid4().hex
+        running_query_ids = getattr(self._local, "query_ids", None)
+        if running_query_ids is not None:
+            running_query_ids.append(query_id)
+        
+        if self.query_timeout:
+            # Server cũng tự dừng query quá hạn (phòng khi KILL không tới được)
+            query_settings = dict(kwargs.pop("settings", None) or {})
+            query_settings.setdefault("max_execution_time", int(self.query_timeout) + 1)
+            kwargs["settings"] = query_settings
+        
+        with self.pool.connection() as client:
+            return client.execute(query, params, query_id=query_id, **kwargs)
+    
+    async def run(self, fn: Callable, *args, timeout: Optional[float] = None, **kwargs):
+        """
+        Chạy fn(*args, **kwargs) trên thread pool ClickHouse và await kết quả
+        Raises: ClickHouseTimeoutError nếu quá timeout (mặc định CLICKHOUSE_QUERY_TIMEOUT_SECONDS)
+        """
+        query_ids: List[str] = []
+        
+        def call():
+            self._local.query_ids = query_ids
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self._local.query_ids = None
+        
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._executor, call)
+        try:
+            return await asyncio.wait_for(future, timeout or self.query_timeout)
+        except asyncio.TimeoutError:
+            loop.run_in_executor(None, self._kill_queries, list(query_ids))
+            raise ClickHouseTimeoutError(f"ClickHouse query timed out after {timeout or self.query_timeout}s")
+        except asyncio.CancelledError:
+            # Request bị hủy (client ngắt kết nối, shutdown): không để query chạy tiếp trên server
+            loop.run_in_executor(None, self._kill_queries, list(query_ids))
+            raise
+    
+    def _kill_queries(self, query_ids: List[str]):
+        """KILL các query theo query_id bằng một connection điều khiển riêng"""
+        if not query_ids:
+            return
+        ids = ", ".join(f"'{query_id}'" for query_id in query_ids)
+        with self._control_lock:
+            try:
+                if self._control_client is None:
+                    self._control_client = create_clickhouse_client()
+                self._control_client.execute(f"KILL QUERY WHERE query_id IN ({ids}) ASYNC")
+            except Exception as e:
+                print(f"Error killing ClickHouse queries {query_ids}: {e}")
+                self._control_client = None
+    
+    def shutdown(self):
+        """Dừng thread pool và đóng connections (gọi khi app shutdown)"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self.pool.close()
+
+
+ch_pool = ClickHouseConnectionPool(
+    factory=create_clickhouse_client,
+    min_size=settings.CLICKHOUSE_POOL_MIN_SIZE,
+    max_size=settings.CLICKHOUSE_POOL_MAX_SIZE,
+    checkout_timeout=settings.CLICKHOUSE_POOL_TIMEOUT_SECONDS,
+    ping_interval=settings.CLICKHOUSE_POOL_PING_INTERVAL_SECONDS
+)
+
+ch_client = ClickHouseExecutor(
+    pool=ch_pool,
+    max_workers=settings.CLICKHOUSE_MAX_WORKERS,
+    query_timeout=settings.CLICKHOUSE_QUERY_TIMEOUT_SECONDS
 )
 
 
-def get_clickhouse():
-    """Dependency để lấy ClickHouse client"""
+def get_clickhouse() -> ClickHouseExecutor:
+    """Dependency để lấy ClickHouse executor (dùng .execute như Client, hoặc await .run(...) trong async route)"""
     return ch_client
 
@@ -0,0 +1,4 @@
+"""
+Jobs Package
+Các tác vụ chạy nền / chạy định kỳ (có thể chạy tay bằng python -m app.jobs.<tên job>)
+"""
@@ -0,0 +1,41 @@
+"""
+Backfill OHLC rollups (5m / 1h / 1d) từ nến 1m đã có trong stock_db.ohlc
+
+Chạy:
+    python -m app.jobs.backfill_ohlc_rollups --start 2024-01-01 --end 2025-12-31
+    python -m app.jobs.backfill_ohlc_rollups --start 2025-12-01 --interval 1d
+"""
+
+import argparse
+from datetime import date, datetime
+from app.database import ch_client
+from app.services.ohlc_rollup_service import OhlcRollupService
+
+
+def parse_date(value: str) -> date:
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill OHLC rollups từ nến 1m")
+    parser.add_argument("--start", type=parse_date, required=True, help="Ngày bắt đầu (YYYY-MM-DD)")
+    parser.add_argument("--end", type=parse_date, default=date.today(), help="Ngày kết thúc (YYYY-MM-DD), mặc định hôm nay")
+    parser.add_argument(
+        "--interval",
+        action="append",
+        dest="intervals",
+        help="Interval cần backfill (5m, 1h, 1d). Có thể truyền nhiều lần. Mặc định: tất cả"
+    )
+    args = parser.parse_args()
+
+    print("🚀 Ensuring rollup table and materialized views...")
+    OhlcRollupService.ensure_schema(ch_client)
+
+    print(f"🚀 Backfilling rollups from {args.start} to {args.end}...")
+    processed = OhlcRollupService.backfill(ch_client, args.start, args.end, intervals=args.intervals)
+    for interval, partitions in processed.items():
+        print(f"   {interval}: {partitions} partitions")
+
+
+if __name__ == "__main__":
+    main()
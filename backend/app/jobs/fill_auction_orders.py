@@ -0,0 +1,43 @@
+"""
+Fill ATO/ATC orders đang PENDING theo giá khớp định kỳ trong stock_db.ticks (chạy thủ công hoặc bù cho
+ngày scheduler trong app không chạy)
+
+Chạy:
+    python -m app.jobs.fill_auction_orders --session ATO
+    python -m app.jobs.fill_auction_orders --session ATC --date 2025-12-01
+"""
+
+import argparse
+from datetime import date, datetime
+from app.database import ch_client
+from app.services.auction_fill_service import auction_fill_scheduler
+
+
+def parse_date(value: str) -> date:
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fill ATO/ATC orders theo giá khớp định kỳ")
+    parser.add_argument("--session", choices=["ATO", "ATC"], required=True, help="Phiên khớp lệnh định kỳ")
+    parser.add_argument("--date", type=parse_date, default=None, help="Ngày giao dịch (YYYY-MM-DD), mặc định hôm nay")
+    args = parser.parse_args()
+    
+    try:
+        report = auction_fill_scheduler.fill_auction_now(ch_client, args.session, args.date)
+        print(
+            f"✅ {report['session']} {report['date']}: filled {report['filled']}/{report['checked']} orders "
+            f"in {report['duration_seconds']}s"
+        )
+        for item in report["symbols"]:
+            print(f"   {item['symbol']} @ {item['price']}: {item['filled']}/{item['orders']} orders, {item['duration_ms']} ms")
+        if report["missing_price_symbols"]:
+            print(f"⚠️  No {report['session']} ticks for: {', '.join(report['missing_price_symbols'])}")
+        for error in report["errors"]:
+            print(f"   ⚠️  {error}")
+    finally:
+        ch_client.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,24 @@
+"""
+Tính lại toàn bộ thống kê admin dashboard từ bảng gốc và ghi đè bảng tổng hợp (chạy thủ công / cron, bình
+thường scheduler trong app tự reconcile mỗi ADMIN_STATS_RECONCILE_SECONDS)
+
+Chạy:
+    python -m app.jobs.reconcile_admin_stats
+"""
+
+from app.services.admin_stats_service import admin_stats
+
+
+def main():
+    report = admin_stats.reconcile_now(force=True)
+    if report is None:
+        print("⚠️  Another worker is reconciling admin stats, skipped")
+        return
+    print(
+        f"✅ Reconciled {len(report['counters'])} counters, {report['symbols']} symbols, "
+        f"{report['lessons']} lessons in {report['duration_ms']}ms"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""
+Kiểm tra toàn vẹn positions của tất cả users (chạy hằng đêm)
+
+So sánh quantity của mọi position với tổng orders FILLED trong một query và in ra các chỗ lệch.
+
+Chạy:
+    python -m app.jobs.reconcile_positions
+    python -m app.jobs.reconcile_positions --fix        # Xóa các positions lệch
+    python -m app.jobs.reconcile_positions --user-id 42
+"""
+
+import argparse
+import sys
+from app.database import SessionLocal
+from app.services.position_reconciliation_service import PositionReconciliationService
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Đối chiếu positions với orders FILLED")
+    parser.add_argument("--user-id", type=int, default=None, help="Chỉ kiểm tra một user (mặc định: tất cả)")
+    parser.add_argument("--fix", action="store_true", help="Xóa các positions có quantity lệch")
+    args = parser.parse_args()
+    
+    db = SessionLocal()
+    try:
+        discrepancies = PositionReconciliationService.find_all_discrepancies(db, user_id=args.user_id)
+        if not discrepancies:
+            print("✅ All positions match their FILLED orders")
+            return 0
+        
+        users = {item.user_id for item in discrepancies}
+        print(f"⚠️  {len(discrepancies)} discrepancies across {len(users)} users")
+        for item in discrepancies:
+            position = f"position {item.position_id}" if item.position_id is not None else "missing position"
+            print(
+                f"   user {item.user_id} {item.symbol}: quantity={item.actual_quantity}, "
+                f"expected={item.expected_quantity} ({position})"
+            )
+        
+        if args.fix:
+            deleted = PositionReconciliationService.delete_invalid_positions(db, discrepancies)
+            print(f"🧹 Deleted {deleted} invalid positions")
+            return 0
+        return 1
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,23 @@
+"""
+Định giá tất cả portfolios và ghi một điểm equity curve cho mỗi user (chạy thủ công / cron, bình thường
+scheduler trong app tự ghi mỗi phút trong giờ giao dịch)
+
+Chạy:
+    python -m app.jobs.record_equity_curve
+"""
+
+from app.database import ch_client
+from app.services.equity_curve_service import equity_curve_recorder
+
+
+def main():
+    report = equity_curve_recorder.record_now(ch_client)
+    print(
+        f"✅ Recorded {report['written']}/{report['users']} portfolios at {report['recorded_at']} "
+        f"in {report['duration_seconds']}s"
+    )
+    ch_client.shutdown()
+
+
+if __name__ == "__main__":
+    main()
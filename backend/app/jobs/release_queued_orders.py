@@ -0,0 +1,26 @@
+"""
+Fill hàng loạt QUEUED REALTIME MARKET orders với giá hiện tại (chạy thủ công, bình thường scheduler
+trong app tự chạy lúc 9:00 và 13:00)
+
+Chạy:
+    python -m app.jobs.release_queued_orders
+"""
+
+from app.database import ch_client
+from app.services.order_release_service import order_release_scheduler
+
+
+def main():
+    report = order_release_scheduler.release_now(ch_client)
+    print(
+        f"✅ Filled {report['filled']}/{report['checked']} QUEUED orders ({report['symbols']} symbols, "
+        f"{report['chunks']} chunks) in {report['duration_seconds']}s - {report['orders_per_second']} orders/s, "
+        f"unblocked {report['unblocked_cash']} VNĐ"
+    )
+    for error in report["errors"]:
+        print(f"   ⚠️  {error}")
+    ch_client.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+"""
+Snapshot sổ cái portfolio cho mọi user có entries mới (chạy hằng đêm)
+
+Snapshot giữ cho việc dựng portfolio tại thời điểm bất kỳ chỉ phải replay ít entries.
+
+Chạy:
+    python -m app.jobs.snapshot_ledgers
+    python -m app.jobs.snapshot_ledgers --user-id 42
+"""
+
+import argparse
+from app.database import SessionLocal
+from app.services.ledger_service import LedgerService
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Snapshot sổ cái portfolio")
+    parser.add_argument("--user-id", type=int, default=None, help="Chỉ snapshot một user (mặc định: tất cả)")
+    args = parser.parse_args()
+    
+    db = SessionLocal()
+    try:
+        if args.user_id is not None:
+            LedgerService.bootstrap_user(db, args.user_id)
+            snapshot = LedgerService.snapshot(db, args.user_id)
+            print(f"✅ Snapshot user {args.user_id}: {snapshot}")
+            return
+        
+        user_ids = LedgerService.snapshot_all(db)
+        print(f"✅ Snapshotted {len(user_ids)} users")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
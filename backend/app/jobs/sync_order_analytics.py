@@ -0,0 +1,28 @@
+"""
+Sync virtual_orders từ Postgres sang ClickHouse (chạy thủ công / cron, bình thường scheduler trong app tự sync
+mỗi ORDER_ANALYTICS_SYNC_INTERVAL_SECONDS)
+
+Chạy:
+    python -m app.jobs.sync_order_analytics          # các thay đổi sau watermark
+    python -m app.jobs.sync_order_analytics --full   # sync lại toàn bộ
+"""
+
+import sys
+from app.database import ch_client
+from app.services.order_analytics_sync_service import OrderAnalyticsSyncService, order_analytics_sync
+
+
+def main():
+    OrderAnalyticsSyncService.ensure_schema(ch_client)
+    if "--full" in sys.argv[1:]:
+        order_analytics_sync.reset()
+    report = order_analytics_sync.sync_now(ch_client)
+    print(
+        f"✅ Synced {report['synced']} orders in {report['batches']} batches "
+        f"({report['duration_ms']}ms), watermark {report['watermark']}"
+    )
+    ch_client.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -19,16 +19,29 @@ else:
 
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.exceptions import RequestValidationError
 from fastapi.responses import JSONResponse
 from app.config import settings
 from app.controllers import auth_router, symbols_router, ohlc_router, lessons_router, portfolio_router, admin_router
 from app.controllers.homepage import router as homepage_router
-from app.controllers.websocket import router as websocket_router, start_ohlc_monitoring
+from app.controllers.websocket import router as websocket_router, start_ohlc_monitoring, manager as websocket_manager
 from app.controllers.ai_coach import router as ai_coach_router
-from app.database import Base, engine, ch_client
+from app.database import Base, engine, ch_client, ch_pool, ClickHouseTimeoutError
+from app.services.ohlc_rollup_service import OhlcRollupService
+from app.services.matching_engine_service import matching_engine
+from app.services.order_release_service import order_release_scheduler
+from app.services.auction_fill_service import auction_fill_scheduler
+from app.services.equity_curve_service import equity_curve_recorder
+from app.services.leaderboard_service import leaderboard
+from app.services.admin_stats_service import admin_stats
+from app.services.order_analytics_sync_service import OrderAnalyticsSyncService, order_analytics_sync
 import logging
 import asyncio
+try:
+    from brotli_asgi import BrotliMiddleware
+except ImportError:
+    BrotliMiddleware = None
 from contextlib import asynccontextmanager
 
 # Configure logging
@@ -39,11 +52,46 @@ logger = logging.getLogger(__name__)
 async def lifespan(app: FastAPI):
     # Startup
     logger.info("Starting up...")
-    start_ohlc_monitoring(ch_client)
     Base.metadata.create_all(bind=engine)
+    try:
+        ch_pool.warm_up()
+    except Exception as e:
+        logger.error(f"Could not open ClickHouse connections: {e}")
+    try:
+        # Bảng rollup 5m/1h/1d + materialized views (dữ liệu cũ: python -m app.jobs.backfill_ohlc_rollups)
+        OhlcRollupService.ensure_schema(ch_client)
+    except Exception as e:
+        logger.error(f"Could not ensure OHLC rollup schema: {e}")
+    try:
+        # Bản sao virtual_orders cho analytics (sync theo watermark)
+        OrderAnalyticsSyncService.ensure_schema(ch_client)
+    except Exception as e:
+        logger.error(f"Could not ensure order analytics schema: {e}")
+    # Background tasks: push OHLC qua websocket, engine khớp LIMIT orders, fill QUEUED orders lúc mở phiên,
+    # fill ATO/ATC orders sau phiên khớp định kỳ, ghi equity curve, định giá lại leaderboard, flush thống kê admin,
+    # sync orders sang ClickHouse
+    background_tasks = [asyncio.create_task(start_ohlc_monitoring(ch_client))]
+    if settings.MATCHING_ENGINE_ENABLED:
+        background_tasks.append(asyncio.create_task(matching_engine.run(ch_client)))
+    if settings.ORDER_RELEASE_ENABLED:
+        background_tasks.append(asyncio.create_task(order_release_scheduler.run(ch_client)))
+    if settings.AUCTION_FILL_ENABLED:
+        background_tasks.append(asyncio.create_task(auction_fill_scheduler.run(ch_client)))
+    if settings.EQUITY_SNAPSHOT_ENABLED:
+        background_tasks.append(asyncio.create_task(equity_curve_recorder.run(ch_client)))
+    if settings.LEADERBOARD_ENABLED:
+        background_tasks.append(asyncio.create_task(leaderboard.run(ch_client)))
+    if settings.ADMIN_STATS_ENABLED:
+        background_tasks.append(asyncio.create_task(admin_stats.run()))
+    if settings.ORDER_ANALYTICS_SYNC_ENABLED:
+        background_tasks.append(asyncio.create_task(order_analytics_sync.run(ch_client)))
     yield
     # Shutdown
     logger.info("Shutting down...")
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    ch_client.shutdown()
 
 app = FastAPI(
     title=settings.APP_NAME,
@@ -58,8 +106,15 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],  # Cursor phân trang của GET /api/portfolio/orders
 )
 
+# Nén response lớn (vd 10k nến JSON): brotli nếu client hỗ trợ, fallback gzip
+if BrotliMiddleware is not None:
+    app.add_middleware(BrotliMiddleware, minimum_size=settings.RESPONSE_COMPRESSION_MIN_SIZE, gzip_fallback=True)
+else:
+    app.add_middleware(GZipMiddleware, minimum_size=settings.RESPONSE_COMPRESSION_MIN_SIZE)
+
 # Exception Handlers
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request, exc):
@@ -67,6 +122,13 @@ async def validation_exception_handler(request, exc):
         status_code=422,
         content={"detail": exc.errors(), "body": exc.body},
     )
+
+@app.exception_handler(ClickHouseTimeoutError)
+async def clickhouse_timeout_handler(request, exc):
+    return JSONResponse(
+        status_code=504,
+        content={"detail": str(exc)},
+    )
 app.include_router(auth_router)
 app.include_router(symbols_router)
 app.include_router(ohlc_router)
@@ -94,6 +156,69 @@ async def health_check():
     return {"status": "healthy"}
 
 
+@app.get("/api/health/clickhouse")
+async def clickhouse_health_check():
+    """Health check ClickHouse: chạy SELECT 1 qua pool và trả về metrics của pool"""
+    try:
+        await ch_client.run(ch_client.execute, "SELECT 1", timeout=5)
+        status_code, status = 200, "healthy"
+    except Exception as e:
+        logger.error(f"ClickHouse health check failed: {e}")
+        status_code, status = 503, "unhealthy"
+    return JSONResponse(
+        status_code=status_code,
+        content={"status": status, "pool": ch_pool.stats()},
+    )
+
+
+@app.get("/api/health/matching-engine")
+async def matching_engine_health_check():
+    """Trạng thái engine khớp lệnh: số symbols/orders trong sổ lệnh, số orders đã khớp, thời gian vòng gần nhất"""
+    return matching_engine.stats()
+
+
+@app.get("/api/health/order-release")
+async def order_release_health_check():
+    """Trạng thái scheduler fill QUEUED orders lúc mở phiên và báo cáo lần chạy gần nhất (orders/giây, tiền đã unblock)"""
+    return order_release_scheduler.stats()
+
+
+@app.get("/api/health/auction-fill")
+async def auction_fill_health_check():
+    """Báo cáo fill ATO/ATC gần nhất của từng phiên: số orders, thời gian settle batch / từng symbol, độ trễ"""
+    return auction_fill_scheduler.stats()
+
+
+@app.get("/api/health/equity-curve")
+async def equity_curve_health_check():
+    """Lần ghi equity curve gần nhất: số portfolios đã định giá, thời gian một pass"""
+    return equity_curve_recorder.stats()
+
+
+@app.get("/api/health/leaderboard")
+async def leaderboard_health_check():
+    """Leaderboard: số portfolios trong ranking, thời điểm và thời gian định giá lại gần nhất"""
+    return leaderboard.stats()
+
+
+@app.get("/api/health/admin-stats")
+async def admin_stats_health_check():
+    """Thống kê admin: số key chờ flush, số lần flush lỗi, thời điểm reconcile gần nhất"""
+    return admin_stats.stats()
+
+
+@app.get("/api/health/order-analytics-sync")
+async def order_analytics_sync_health_check():
+    """Sync orders sang ClickHouse: watermark, số dòng đã sync, số lần lỗi"""
+    return order_analytics_sync.stats()
+
+
+@app.get("/api/health/websocket")
+async def websocket_health_check():
+    """WebSocket fan-out: connections, message chờ gửi / bị bỏ / gộp, broadcast lag (ms)"""
+    return websocket_manager.stats()
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000, reload=settings.DEBUG)
@@ -6,6 +6,9 @@ Import tất cả models để SQLAlchemy có thể detect
 from app.models.user import User
 from app.models.lesson import Lesson, LessonProgress
 from app.models.portfolio import Portfolio, VirtualOrder, VirtualPosition
+from app.models.ledger import LedgerEntry, PortfolioSnapshot
+from app.models.equity import EquitySnapshot
+from app.models.stats import StatCounter, SymbolTradeStat, LessonStat
 
 __all__ = [
     "User",
@@ -14,4 +17,10 @@ __all__ = [
     "Portfolio",
     "VirtualOrder",
     "VirtualPosition",
+    "LedgerEntry",
+    "PortfolioSnapshot",
+    "EquitySnapshot",
+    "StatCounter",
+    "SymbolTradeStat",
+    "LessonStat",
 ]
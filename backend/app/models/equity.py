@@ -0,0 +1,30 @@
+"""
+Equity Curve Models - Giá trị portfolio theo thời gian (mark-to-market)
+"""
+
+from sqlalchemy import Column, Integer, Numeric, DateTime, ForeignKey, UniqueConstraint
+from app.database import Base
+
+
+class EquitySnapshot(Base):
+    """
+    Một điểm của equity curve: giá trị portfolio của user tại recorded_at (làm tròn theo phút)
+    Giá trị tính bằng VND (giá ClickHouse nghìn VNĐ đã nhân 1000)
+    """
+    __tablename__ = "equity_snapshots"
+    
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    recorded_at = Column(DateTime(timezone=True), nullable=False)
+    cash_balance = Column(Numeric(15, 2), nullable=False)
+    positions_value = Column(Numeric(15, 2), nullable=False)
+    unrealized_pnl = Column(Numeric(15, 2), nullable=False)
+    total_value = Column(Numeric(15, 2), nullable=False)
+    
+    # Constraints (unique cũng là index cho query curve theo user + khoảng thời gian)
+    __table_args__ = (
+        UniqueConstraint("user_id", "recorded_at", name="uq_equity_snapshots_user_recorded"),
+    )
+    
+    def __repr__(self):
+        return f"<EquitySnapshot(user_id={self.user_id}, recorded_at={self.recorded_at}, total={self.total_value})>"
@@ -0,0 +1,59 @@
+"""
+Ledger Models - Sổ cái append-only của portfolio (fills + dòng tiền) và snapshots định kỳ
+"""
+
+from sqlalchemy import Column, Integer, String, Numeric, DateTime, ForeignKey, JSON, func, CheckConstraint, Index
+from app.database import Base
+
+
+class LedgerEntry(Base):
+    """
+    Một bút toán trong sổ cái (chỉ insert, không update/delete)
+    - FILL: order được khớp (quantity có dấu: BUY dương, SELL âm)
+    - CASH: nạp/reset tiền (chỉ có cash_delta)
+    """
+    __tablename__ = "ledger_entries"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    entry_type = Column(String(10), nullable=False)  # FILL, CASH
+    order_id = Column(Integer, ForeignKey("virtual_orders.id", ondelete="SET NULL"), nullable=True)
+    symbol = Column(String(10), nullable=True)
+    quantity = Column(Integer, default=0, nullable=False)  # Thay đổi quantity của position
+    price = Column(Numeric(10, 2), nullable=True)  # Giá khớp (nghìn VNĐ)
+    cash_delta = Column(Numeric(15, 2), default=0.00, nullable=False)  # Thay đổi cash (VND)
+    note = Column(String(50), nullable=True)  # OPENING, DEPOSIT, RESET, ...
+    occurred_at = Column(DateTime(timezone=True), nullable=False)  # Thời điểm hiệu lực (execution_time cho PRACTICE)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    
+    # Constraints
+    __table_args__ = (
+        CheckConstraint("entry_type IN ('FILL', 'CASH')", name="check_ledger_entry_type"),
+        Index("ix_ledger_entries_user_occurred", "user_id", "occurred_at"),
+    )
+    
+    def __repr__(self):
+        return f"<LedgerEntry(id={self.id}, user_id={self.user_id}, type={self.entry_type}, symbol={self.symbol}, quantity={self.quantity}, cash_delta={self.cash_delta})>"
+
+
+class PortfolioSnapshot(Base):
+    """
+    Trạng thái portfolio của một user tại thời điểm as_of (tính từ mọi entry có occurred_at <= as_of)
+    positions: {symbol: {"quantity": int, "avg_price": "decimal string"}}
+    """
+    __tablename__ = "portfolio_snapshots"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    as_of = Column(DateTime(timezone=True), nullable=False)
+    cash_balance = Column(Numeric(15, 2), nullable=False)
+    positions = Column(JSON, nullable=False, default=dict)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    
+    # Constraints
+    __table_args__ = (
+        Index("ix_portfolio_snapshots_user_as_of", "user_id", "as_of"),
+    )
+    
+    def __repr__(self):
+        return f"<PortfolioSnapshot(user_id={self.user_id}, as_of={self.as_of}, cash={self.cash_balance})>"
@@ -2,7 +2,7 @@
 Portfolio Models
 """
 
-from sqlalchemy import Column, Integer, String, Numeric, DateTime, ForeignKey, func, CheckConstraint
+from sqlalchemy import Column, Integer, String, Numeric, DateTime, ForeignKey, func, CheckConstraint, Index
 from sqlalchemy.orm import relationship
 from app.database import Base
 
@@ -49,6 +49,8 @@ class VirtualOrder(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
     filled_at = Column(DateTime(timezone=True), nullable=True)
     cancelled_at = Column(DateTime(timezone=True), nullable=True)
+    # Thời điểm thay đổi cuối (watermark khi sync sang ClickHouse, xem OrderAnalyticsSyncService)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False)
     
     # Relationships
     user = relationship("User", back_populates="orders")
@@ -59,6 +61,13 @@ class VirtualOrder(Base):
         CheckConstraint("order_type IN ('MARKET', 'LIMIT', 'ATO', 'ATC')", name="check_order_type"),
         CheckConstraint("status IN ('PENDING', 'QUEUED', 'FILLED', 'CANCELLED', 'REJECTED')", name="check_status"),
         CheckConstraint("trading_mode IN ('REALTIME', 'PRACTICE')", name="check_trading_mode"),
+        # Lịch sử orders: lọc trong SQL + phân trang keyset theo (created_at, id)
+        Index("ix_virtual_orders_user_status_created", "user_id", "status", "created_at", "id"),
+        Index("ix_virtual_orders_user_created", "user_id", "created_at", "id"),
+        # Orders chờ khớp theo loại (engine, scheduler)
+        Index("ix_virtual_orders_type_status", "order_type", "status"),
+        # Sync sang ClickHouse theo watermark (updated_at, id)
+        Index("ix_virtual_orders_updated", "updated_at", "id"),
     )
     
     def __repr__(self):
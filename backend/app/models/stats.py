@@ -0,0 +1,49 @@
+"""
+Statistics Models - Bảng tổng hợp cho admin dashboard (cập nhật theo sự kiện, reconcile định kỳ)
+"""
+
+from sqlalchemy import Column, Integer, BigInteger, String, Numeric, DateTime, ForeignKey, func
+from app.database import Base
+
+
+class StatCounter(Base):
+    """
+    Counter tổng theo tên: total_users, total_orders, filled_orders, total_trading_value, total_completions,
+    active_traders, new_users:YYYY-MM
+    """
+    __tablename__ = "stat_counters"
+    
+    name = Column(String(64), primary_key=True)
+    value = Column(Numeric(20, 2), default=0, nullable=False)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+    
+    def __repr__(self):
+        return f"<StatCounter(name={self.name}, value={self.value})>"
+
+
+class SymbolTradeStat(Base):
+    """Thống kê orders FILLED theo symbol"""
+    __tablename__ = "symbol_trade_stats"
+    
+    symbol = Column(String(10), primary_key=True)
+    filled_orders = Column(Integer, default=0, nullable=False)
+    total_volume = Column(BigInteger, default=0, nullable=False)
+    buy_orders = Column(Integer, default=0, nullable=False)
+    sell_orders = Column(Integer, default=0, nullable=False)
+    
+    def __repr__(self):
+        return f"<SymbolTradeStat(symbol={self.symbol}, filled_orders={self.filled_orders})>"
+
+
+class LessonStat(Base):
+    """Thống kê tiến độ theo bài học (avg quiz score = quiz_score_sum / quiz_score_count)"""
+    __tablename__ = "lesson_stats"
+    
+    lesson_id = Column(Integer, ForeignKey("lessons.id", ondelete="CASCADE"), primary_key=True)
+    total_attempts = Column(Integer, default=0, nullable=False)
+    completions = Column(Integer, default=0, nullable=False)
+    quiz_score_sum = Column(BigInteger, default=0, nullable=False)
+    quiz_score_count = Column(Integer, default=0, nullable=False)
+    
+    def __repr__(self):
+        return f"<LessonStat(lesson_id={self.lesson_id}, attempts={self.total_attempts}, completions={self.completions})>"
@@ -2,12 +2,16 @@
 Repositories Package
 """
 
-from app.repositories.user_repository import UserRepository
+from app.repositories.user_repository import UserRepository, AsyncUserRepository
 from app.repositories.clickhouse_repository import ClickHouseRepository
-from app.repositories.lesson_repository import LessonRepository
+from app.repositories.lesson_repository import LessonRepository, AsyncLessonRepository
 from app.repositories.portfolio_repository import (
-    PortfolioRepository, VirtualOrderRepository, VirtualPositionRepository
+    PortfolioRepository, VirtualOrderRepository, VirtualPositionRepository,
+    AsyncPortfolioRepository, AsyncVirtualOrderRepository, AsyncVirtualPositionRepository
 )
+from app.repositories.ledger_repository import LedgerRepository, PortfolioSnapshotRepository
+from app.repositories.equity_repository import EquitySnapshotRepository, AsyncEquitySnapshotRepository
+from app.repositories.stats_repository import StatsRepository
 
 __all__ = [
     "UserRepository",
@@ -16,4 +20,14 @@ __all__ = [
     "PortfolioRepository",
     "VirtualOrderRepository",
     "VirtualPositionRepository",
+    "LedgerRepository",
+    "PortfolioSnapshotRepository",
+    "EquitySnapshotRepository",
+    "StatsRepository",
+    "AsyncUserRepository",
+    "AsyncLessonRepository",
+    "AsyncPortfolioRepository",
+    "AsyncVirtualOrderRepository",
+    "AsyncVirtualPositionRepository",
+    "AsyncEquitySnapshotRepository",
 ]
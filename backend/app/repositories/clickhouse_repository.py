@@ -2,17 +2,91 @@
 ClickHouse Repository - Data Access Layer
 """
 
+import re
+import time
+import numpy as np
 from clickhouse_driver import Client
-from typing import List, Dict, Optional
-from datetime import datetime, timedelta
+from typing import List, Dict, Optional, Tuple
+from datetime import date, datetime, timedelta
 
 
 class ClickHouseRepository:
     """ClickHouse repository"""
     
+    # Bảng gốc chứa nến 1m (collectors chỉ ghi interval='1m')
+    OHLC_TABLE = "stock_db.ohlc"
+    # Bảng rollup 5m/1h/1d được materialized view cập nhật từ nến 1m (xem OhlcRollupService)
+    ROLLUP_TABLE = "stock_db.ohlc_rollup"
+    # interval -> hàm ClickHouse để lấy đầu bucket
+    ROLLUP_INTERVALS = {
+        "5m": "toStartOfFiveMinutes",
+        "1h": "toStartOfHour",
+        "1d": "toStartOfDay",
+    }
+    # Thời điểm từ đó bảng rollup có đủ nến của từng interval (ghi bởi OhlcRollupService)
+    ROLLUP_COVERAGE_TABLE = "stock_db.ohlc_rollup_coverage"
+    ROLLUP_COVERAGE_TTL_SECONDS = 60
+    # Bảng ticks (collector dnse gắn session ATO/ATC cho tick khớp lệnh định kỳ)
+    TICKS_TABLE = "stock_db.ticks"
+    # Bản sao virtual_orders của Postgres cho analytics (sync theo watermark, xem OrderAnalyticsSyncService)
+    ORDERS_TABLE = "stock_db.virtual_orders"
+    # Múi giờ để gom theo ngày / giờ giao dịch
+    MARKET_TIMEZONE = "Asia/Ho_Chi_Minh"
+    # Thứ tự cột khi lấy OHLC dạng columnar (epoch_time=True)
+    COLUMNAR_FIELDS = [
+        "time", "open", "high", "low", "close", "volume", "total_gross_trade_amount", "vwap"
+    ]
+    
+    # Cache coverage dùng chung cho mọi instance: (thời điểm load, {interval: covered_from})
+    _rollup_coverage: Tuple[float, Dict[str, datetime]] = (0.0, {})
+    
     def __init__(self, client: Client):
         self.client = client
     
+    @classmethod
+    def _ohlc_table(cls, interval: str) -> str:
+        """Bảng chứa nến của interval: rollup cho 5m/1h/1d, bảng gốc cho 1m"""
+        if interval in cls.ROLLUP_INTERVALS:
+            return cls.ROLLUP_TABLE
+        return cls.OHLC_TABLE
+    
+    def get_rollup_coverage(self, refresh: bool = False) -> Dict[str, datetime]:
+        """
+        {interval: covered_from}: bảng rollup có đủ nến của interval từ covered_from trở đi
+        (materialized view chỉ ghi nến 1m insert sau khi tạo view, phần trước đó cần backfill)
+        Cache ROLLUP_COVERAGE_TTL_SECONDS giây; lỗi (chưa tạo bảng) -> {} (mọi interval resample từ 1m)
+        """
+        loaded_at, coverage = ClickHouseRepository._rollup_coverage
+        if not refresh and time.monotonic() - loaded_at < self.ROLLUP_COVERAGE_TTL_SECONDS:
+            return coverage
+        try:
+            result = self.client.execute(
+                f"""
+                SELECT interval, argMax(covered_from, updated_at)
+                FROM {self.ROLLUP_COVERAGE_TABLE}
+                GROUP BY interval
+                """
+            )
+            coverage = {row[0]: row[1] for row in result}
+        except Exception as e:
+            print(f"Error getting rollup coverage: {e}")
+            coverage = {}
+        ClickHouseRepository._rollup_coverage = (time.monotonic(), coverage)
+        return coverage
+    
+    def set_rollup_coverage(self, interval: str, covered_from: datetime):
+        """Ghi thời điểm từ đó rollup của interval có đủ nến (bản ghi mới nhất theo updated_at được dùng)"""
+        self.client.execute(
+            f"INSERT INTO {self.ROLLUP_COVERAGE_TABLE} (interval, covered_from, updated_at) VALUES",
+            [(interval, covered_from, datetime.now())]
+        )
+        ClickHouseRepository._rollup_coverage = (0.0, {})
+    
+    def rollup_covers(self, interval: str, start_time: datetime) -> bool:
+        """Bảng rollup có đủ nến của interval từ start_time không (không thì phải resample từ nến 1m)"""
+        covered_from = self.get_rollup_coverage().get(interval)
+        return covered_from is not None and start_time.replace(tzinfo=None) >= covered_from
+    
     def get_symbols(self, limit: Optional[int] = None) -> List[str]:
         """
         Lấy danh sách symbols từ ClickHouse
@@ -76,27 +150,76 @@ class ClickHouseRepository:
         
         return None
     
-    def get_ohlc_historical(
+    @classmethod
+    def parse_interval(cls, interval: str) -> Optional[Tuple[int, str]]:
+        """
+        Parse interval dạng <số><đơn vị> (vd: 3m, 15m, 4h, 1d, 1w)
+        Returns: (số lượng, đơn vị) hoặc None nếu không hợp lệ
+        """
+        match = re.fullmatch(r"(\d{1,4})([mhdw])", interval or "")
+        if not match or int(match.group(1)) == 0:
+            return None
+        return int(match.group(1)), match.group(2)
+    
+    @classmethod
+    def _resample_bucket_expression(cls, interval: str, time_column: str) -> str:
+        """
+        Biểu thức ClickHouse tính đầu bucket của interval cho cột thời gian
+        
+        - Interval theo phút/giờ: bucket được neo vào đầu phiên (9:00 sáng, 13:00 chiều) của
+          TradingHoursService nên không bucket nào vắt qua giờ nghỉ trưa 11:30-13:00
+          (vd 4h -> một nến 9:00-11:30 và một nến 13:00-15:00)
+        - Interval theo ngày/tuần: bucket theo lịch (toStartOfInterval)
+        """
+        amount, unit = cls.parse_interval(interval)
+        if unit == "d":
+            return f"toStartOfInterval({time_column}, INTERVAL {amount} DAY)"
+        if unit == "w":
+            return f"toStartOfInterval({time_column}, INTERVAL {amount} WEEK)"
+        
+        # Import tại chỗ để repository không phụ thuộc services khi load module
+        from app.services.trading_hours_service import TradingHoursService
+        
+        def seconds_of(t) -> int:
+            return t.hour * 3600 + t.minute * 60 + t.second
+        
+        morning_start = seconds_of(TradingHoursService.MORNING_START)
+        afternoon_start = seconds_of(TradingHoursService.AFTERNOON_START)
+        step_seconds = amount * (3600 if unit == "h" else 60)
+        
+        session_start = (
+            f"addSeconds(toStartOfDay({time_column}), "
+            f"if(toSecond({time_column}) + toMinute({time_column}) * 60 + toHour({time_column}) * 3600 < {afternoon_start}, "
+            f"{morning_start}, {afternoon_start}))"
+        )
+        return (
+            f"addSeconds({session_start}, "
+            f"intDiv(greatest(dateDiff('second', {session_start}, {time_column}), 0), {step_seconds}) * {step_seconds})"
+        )
+    
+    def _build_ohlc_query(
         self,
         symbol: str,
         start_time: datetime,
         end_time: datetime,
-        interval: str = "1m",
-        limit: Optional[int] = None
-    ) -> List[Dict]:
+        interval: str,
+        limit: Optional[int] = None,
+        resample: bool = False,
+        epoch_time: bool = False,
+        after: Optional[int] = None,
+        ascending: bool = False
+    ) -> str:
         """
-        Lấy dữ liệu OHLC lịch sử từ ClickHouse
+        Tạo query lấy nến OHLC (mặc định ORDER BY time DESC)
         
-        Args:
-            symbol: Mã chứng khoán
-            start_time: Thời gian bắt đầu
-            end_time: Thời gian kết thúc
-            interval: Interval (1m, 5m, 1h, 1d)
-            limit: Giới hạn số lượng records
+        - 1m: đọc bảng ohlc
+        - 5m/1h/1d: đọc bảng rollup
+        - Interval khác (hoặc resample=True): gộp nến 1m thành bucket ngay trong ClickHouse
+        - epoch_time=True: chỉ lấy các cột giá, time là unix timestamp (giây) - dùng cho columnar
+        - after: keyset cursor (unix timestamp giây), chỉ lấy nến có time > after
         """
         # ClickHouse không hỗ trợ named parameters như PostgreSQL
         # Cần dùng string formatting, nhưng cần escape để tránh SQL injection
-        # Format datetime
         start_time_str = start_time.strftime('%Y-%m-%d %H:%M:%S')
         end_time_str = end_time.strftime('%Y-%m-%d %H:%M:%S')
         
@@ -104,25 +227,43 @@ class ClickHouseRepository:
         symbol_escaped = symbol.replace("'", "''")
         interval_escaped = interval.replace("'", "''")
         
-        # Query với subquery để tính VWAP sau khi merge
-        # ClickHouse không cho phép dùng merge functions nhiều lần trong CASE
-        query = f"""
-        SELECT
-            symbol,
-            time,
-            interval,
-            open,
-            high,
-            low,
-            close,
-            volume,
-            total_gross_trade_amount,
-            CASE 
-                WHEN volume > 0 
-                THEN total_gross_trade_amount / volume
-                ELSE 0 
-            END AS vwap
-        FROM (
+        # Keyset cursor: lọc nguồn từ đầu bucket của cursor (bucket chứa cursor bị loại ở query ngoài,
+        # các bucket sau có đủ nến 1m vì mọi nến 1m của bucket đều >= đầu bucket)
+        cursor_condition = ""
+        outer_where = ""
+        if after is not None:
+            cursor_condition = f"AND time >= toDateTime({int(after)})"
+            outer_where = f"WHERE toUnixTimestamp(time) > {int(after)}"
+        
+        if resample or (interval != "1m" and interval not in self.ROLLUP_INTERVALS):
+            if self.parse_interval(interval) is None:
+                raise ValueError(f"Invalid interval: {interval}")
+            # Merge trực tiếp state của các nến 1m trong cùng bucket
+            # (state open/close là argMin/argMax theo thời gian tick nên kết quả vẫn đúng)
+            source_query = f"""
+            SELECT
+                symbol,
+                {self._resample_bucket_expression(interval, 'source_time')} AS time,
+                '{interval_escaped}' AS interval,
+                argMinMerge(open) AS open,
+                maxMerge(high) AS high,
+                minMerge(low) AS low,
+                argMaxMerge(close) AS close,
+                sumMerge(volume) AS volume,
+                sumMerge(total_gross_trade_amount) AS total_gross_trade_amount
+            FROM (
+                SELECT *, time AS source_time
+                FROM {self.OHLC_TABLE}
+                WHERE symbol = '{symbol_escaped}'
+                    AND interval = '1m'
+                    AND time >= '{start_time_str}'
+                    AND time <= '{end_time_str}'
+                    {cursor_condition}
+            )
+            GROUP BY symbol, time, interval
+            """
+        else:
+            source_query = f"""
             SELECT
                 symbol,
                 time,
@@ -133,28 +274,94 @@ class ClickHouseRepository:
                 argMaxMerge(close) AS close,
                 sumMerge(volume) AS volume,
                 sumMerge(total_gross_trade_amount) AS total_gross_trade_amount
-            FROM stock_db.ohlc
+            FROM {self._ohlc_table(interval)}
             WHERE symbol = '{symbol_escaped}'
                 AND interval = '{interval_escaped}'
                 AND time >= '{start_time_str}'
                 AND time <= '{end_time_str}'
+                {cursor_condition}
             GROUP BY symbol, time, interval
-        )
-        ORDER BY time DESC
+            """
+        
+        # symbol/interval giống nhau ở mọi dòng nên columnar không cần lấy
+        if epoch_time:
+            key_columns = "toUnixTimestamp(time) AS time_epoch,"
+        else:
+            key_columns = """symbol,
+            time,
+            interval,"""
+        
+        # Query với subquery để tính VWAP sau khi merge
+        # ClickHouse không cho phép dùng merge functions nhiều lần trong CASE
+        query = f"""
+        SELECT
+            {key_columns}
+            open,
+            high,
+            low,
+            close,
+            volume,
+            total_gross_trade_amount,
+            CASE 
+                WHEN volume > 0 
+                THEN total_gross_trade_amount / volume
+                ELSE 0 
+            END AS vwap
+        FROM ({source_query})
+        {outer_where}
+        ORDER BY time {"ASC" if ascending else "DESC"}
         """
         
         if limit:
-            query += f" LIMIT {limit}"
+            query += f" LIMIT {int(limit)}"
+        
+        return query
+    
+    def _execute_ohlc_query(
+        self,
+        symbol: str,
+        start_time: datetime,
+        end_time: datetime,
+        interval: str,
+        limit: Optional[int] = None,
+        columnar: bool = False,
+        **query_options
+    ):
+        """
+        Chạy query nến OHLC
         
-        result = self.client.execute(query)
+        5m/1h/1d chỉ đọc bảng rollup khi start_time nằm trong khoảng rollup đã có đủ nến (rollup_covers:
+        từ lúc tạo view, hoặc từ đầu khoảng đã backfill); ngoài khoảng đó, hoặc query rollup lỗi,
+        thì resample từ nến 1m thay vì trả về kết quả rỗng / thiếu
         
-        # Convert to list of dicts
+        columnar=True: ClickHouse trả về từng cột (tuple) thay vì từng dòng
+        query_options: after / ascending của _build_ohlc_query
+        """
+        resample = interval in self.ROLLUP_INTERVALS and not self.rollup_covers(interval, start_time)
+        query = self._build_ohlc_query(
+            symbol, start_time, end_time, interval, limit,
+            resample=resample, epoch_time=columnar, **query_options
+        )
+        try:
+            return self.client.execute(query, columnar=columnar)
+        except Exception as e:
+            if interval not in self.ROLLUP_INTERVALS or resample:
+                raise
+            print(f"Rollup query failed for {symbol} {interval}, resampling from 1m: {e}")
+            query = self._build_ohlc_query(
+                symbol, start_time, end_time, interval, limit,
+                resample=True, epoch_time=columnar, **query_options
+            )
+            return self.client.execute(query, columnar=columnar)
+    
+    @staticmethod
+    def _format_ohlc_rows(result) -> List[Dict]:
+        """Convert rows thành list of dicts, time dạng ISO string (UTC+7)"""
         columns = [
             "symbol", "time", "interval", "open", "high", "low", "close",
             "volume", "total_gross_trade_amount", "vwap"
         ]
         
-        # Convert datetime objects to ISO format strings (UTC+7)
         def format_row(row):
             row_dict = dict(zip(columns, row))
             # Convert datetime to ISO string (assume UTC+7 from ClickHouse)
@@ -166,20 +373,89 @@ class ClickHouseRepository:
         
         return [format_row(row) for row in result]
     
-    def get_latest_ohlc(self, symbol: str, interval: str = "1m", limit: int = 100) -> List[Dict]:
+    @classmethod
+    def _format_ohlc_columns(cls, result) -> Dict[str, list]:
+        """
+        Convert kết quả columnar thành các mảng song song
+        time là unix timestamp (giây) của giờ Việt Nam: cột time naive UTC+7 đọc như UTC, không phải epoch UTC thật
+        Các cột giá là float (Decimal cũng được convert)
+        Dùng numpy để convert cả cột một lần thay vì từng dòng
+        """
+        if not result:
+            return {name: [] for name in cls.COLUMNAR_FIELDS}
+        
+        columns = {}
+        for name, values in zip(cls.COLUMNAR_FIELDS, result):
+            dtype = np.int64 if name == "time" else np.float64
+            columns[name] = np.asarray(values, dtype=dtype).tolist()
+        return columns
+    
+    def get_ohlc_historical(
+        self,
+        symbol: str,
+        start_time: datetime,
+        end_time: datetime,
+        interval: str = "1m",
+        limit: Optional[int] = None,
+        columnar: bool = False
+    ):
+        """
+        Lấy dữ liệu OHLC lịch sử từ ClickHouse
+        
+        Args:
+            symbol: Mã chứng khoán
+            start_time: Thời gian bắt đầu
+            end_time: Thời gian kết thúc
+            interval: Interval (1m, 5m, 1h, 1d dùng dữ liệu có sẵn; 3m, 15m, 4h, 1w... được resample từ 1m)
+            limit: Giới hạn số lượng records
+            columnar: True -> Dict {cột: mảng giá trị} (time là epoch giây), False -> List[Dict] mỗi dòng
+        """
+        result = self._execute_ohlc_query(symbol, start_time, end_time, interval, limit, columnar=columnar)
+        if columnar:
+            return self._format_ohlc_columns(result)
+        return self._format_ohlc_rows(result)
+    
+    def get_latest_ohlc(self, symbol: str, interval: str = "1m", limit: int = 100, columnar: bool = False):
         """
         Lấy OHLC data mới nhất
         Returns: List các candle mới nhất, sắp xếp theo time DESC (mới nhất trước)
+                 (columnar=True: Dict các mảng song song, xem get_ohlc_historical)
         """
         end_time = datetime.now()
         start_time = end_time - timedelta(days=7)  # 7 ngày gần nhất
         
-        symbol_escaped = symbol.replace("'", "''")
+        try:
+            result = self._execute_ohlc_query(symbol, start_time, end_time, interval, limit, columnar=columnar)
+            if columnar:
+                return self._format_ohlc_columns(result)
+            return self._format_ohlc_rows(result)
+        except Exception as e:
+            print(f"Error getting latest OHLC for {symbol}: {e}")
+            return self._format_ohlc_columns([]) if columnar else []
+    
+    def get_latest_candles(self, symbols: List[str], interval: str = "1m") -> Dict[str, Dict]:
+        """
+        Nến mới nhất của nhiều symbols trong một query (cùng cửa sổ 7 ngày và format với get_latest_ohlc)
+        
+        Subquery chỉ đọc (symbol, time) để tìm thời điểm nến cuối của từng symbol, query ngoài chỉ merge
+        state của đúng các nến đó thay vì gộp cả 7 ngày cho từng symbol. Cả hai đều lọc theo cùng khoảng time
+        để ClickHouse chỉ đọc các partition / granule của 7 ngày gần nhất.
+        
+        Returns: Dict {symbol: candle}, symbols không có dữ liệu sẽ không có trong kết quả
+        """
+        symbols = sorted(set(symbols))
+        if not symbols:
+            return {}
+        
+        end_time = datetime.now()
+        start_time = end_time - timedelta(days=7)
+        
+        table = self._ohlc_table(interval)
+        symbols_clause = self._symbols_in_clause(symbols)
         interval_escaped = interval.replace("'", "''")
         start_time_str = start_time.strftime('%Y-%m-%d %H:%M:%S')
         end_time_str = end_time.strftime('%Y-%m-%d %H:%M:%S')
         
-        # Query để lấy candle mới nhất (ORDER BY time DESC)
         query = f"""
         SELECT
             symbol,
@@ -191,10 +467,10 @@ class ClickHouseRepository:
             close,
             volume,
             total_gross_trade_amount,
-            CASE 
-                WHEN volume > 0 
+            CASE
+                WHEN volume > 0
                 THEN total_gross_trade_amount / volume
-                ELSE 0 
+                ELSE 0
             END AS vwap
         FROM (
             SELECT
@@ -207,36 +483,60 @@ class ClickHouseRepository:
                 argMaxMerge(close) AS close,
                 sumMerge(volume) AS volume,
                 sumMerge(total_gross_trade_amount) AS total_gross_trade_amount
-            FROM stock_db.ohlc
-            WHERE symbol = '{symbol_escaped}'
+            FROM {table}
+            WHERE symbol IN ({symbols_clause})
                 AND interval = '{interval_escaped}'
                 AND time >= '{start_time_str}'
                 AND time <= '{end_time_str}'
+                AND (symbol, time) IN (
+                    SELECT symbol, max(time)
+                    FROM {table}
+                    WHERE symbol IN ({symbols_clause})
+                        AND interval = '{interval_escaped}'
+                        AND time >= '{start_time_str}'
+                        AND time <= '{end_time_str}'
+                    GROUP BY symbol
+                )
             GROUP BY symbol, time, interval
         )
-        ORDER BY time DESC
-        LIMIT {limit}
         """
         
         try:
             result = self.client.execute(query)
-            
-            # Convert to list of dicts
-            columns = [
-                "symbol", "time", "interval", "open", "high", "low", "close",
-                "volume", "total_gross_trade_amount", "vwap"
-            ]
-            
-            def format_row(row):
-                row_dict = dict(zip(columns, row))
-                if isinstance(row_dict.get('time'), datetime):
-                    row_dict['time'] = row_dict['time'].isoformat()
-                return row_dict
-            
-            return [format_row(row) for row in result]
+            return {candle["symbol"]: candle for candle in self._format_ohlc_rows(result)}
         except Exception as e:
-            print(f"Error getting latest OHLC for {symbol}: {e}")
-            return []
+            print(f"Error getting latest candles for {len(symbols)} symbols: {e}")
+            return {}
+    
+    def iter_ohlc_pages(
+        self,
+        symbol: str,
+        start_time: datetime,
+        end_time: datetime,
+        interval: str = "1m",
+        page_size: int = 5000,
+        after: Optional[int] = None
+    ):
+        """
+        Duyệt toàn bộ nến trong khoảng thời gian theo từng page (time tăng dần)
+        Mỗi page là một query keyset (time > time cuối của page trước) nên bộ nhớ chỉ giữ một page
+        
+        Args:
+            after: Cursor (unix timestamp giây) để tiếp tục từ lần export trước
+        Yields: Dict các mảng song song như get_ohlc_historical(columnar=True)
+        """
+        while True:
+            result = self._execute_ohlc_query(
+                symbol, start_time, end_time, interval, page_size,
+                columnar=True, after=after, ascending=True
+            )
+            page = self._format_ohlc_columns(result)
+            if not page["time"]:
+                return
+            yield page
+            if len(page["time"]) < page_size:
+                return
+            after = page["time"][-1]
     
     def get_price_at_time(self, symbol: str, target_time: datetime, interval: str = "1m") -> Optional[float]:
         """
@@ -279,6 +579,136 @@ class ClickHouseRepository:
             print(f"Error getting price at time for {symbol} at {target_time}: {e}")
         return None
     
+    @staticmethod
+    def _symbols_in_clause(symbols: List[str]) -> str:
+        """Tạo danh sách symbols đã escape cho mệnh đề IN (...)"""
+        return ", ".join("'" + symbol.replace("'", "''") + "'" for symbol in symbols)
+    
+    def get_latest_prices(self, symbols: List[str], interval: str = "1m") -> Dict[str, Dict]:
+        """
+        Lấy giá close mới nhất cho nhiều symbols trong một query
+        
+        State close là argMax(close, thời gian tick) nên merge tất cả nến của symbol
+        cho ra giá của tick cuối cùng, không cần GROUP BY theo từng nến.
+        
+        Returns:
+            Dict {symbol: {"close": float, "time": ISO string của nến mới nhất}}
+            Symbols không có dữ liệu trong 7 ngày gần nhất sẽ không có trong kết quả
+        """
+        symbols = sorted(set(symbols))
+        if not symbols:
+            return {}
+        
+        end_time = datetime.now()
+        start_time = end_time - timedelta(days=7)  # Cùng cửa sổ với get_latest_ohlc
+        
+        interval_escaped = interval.replace("'", "''")
+        start_time_str = start_time.strftime('%Y-%m-%d %H:%M:%S')
+        end_time_str = end_time.strftime('%Y-%m-%d %H:%M:%S')
+        
+        query = f"""
+        SELECT
+            symbol,
+            argMaxMerge(close) AS close,
+            max(time) AS latest_time
+        FROM stock_db.ohlc
+        WHERE symbol IN ({self._symbols_in_clause(symbols)})
+            AND interval = '{interval_escaped}'
+            AND time >= '{start_time_str}'
+            AND time <= '{end_time_str}'
+        GROUP BY symbol
+        """
+        
+        try:
+            result = self.client.execute(query)
+            return {
+                row[0]: {
+                    "close": float(row[1]),
+                    "time": row[2].isoformat() if isinstance(row[2], datetime) else row[2]
+                }
+                for row in result
+                if row[1] is not None
+            }
+        except Exception as e:
+            print(f"Error getting latest prices for {len(symbols)} symbols: {e}")
+            return {}
+    
+    def get_prices_at_time(
+        self,
+        symbols: List[str],
+        as_of: datetime,
+        interval: str = "1m"
+    ) -> Dict[str, float]:
+        """
+        Lấy giá tại một thời điểm trong quá khứ cho nhiều symbols trong một query
+        Giống get_price_at_time: giá close gần nhất trước hoặc tại as_of (trong 1 ngày trước đó)
+        
+        Returns: Dict {symbol: close}
+        """
+        symbols = sorted(set(symbols))
+        if not symbols:
+            return {}
+        
+        start_time = as_of - timedelta(days=1)
+        
+        interval_escaped = interval.replace("'", "''")
+        start_time_str = start_time.strftime('%Y-%m-%d %H:%M:%S')
+        end_time_str = as_of.strftime('%Y-%m-%d %H:%M:%S')
+        
+        query = f"""
+        SELECT
+            symbol,
+            argMaxMerge(close) AS close
+        FROM stock_db.ohlc
+        WHERE symbol IN ({self._symbols_in_clause(symbols)})
+            AND interval = '{interval_escaped}'
+            AND time >= '{start_time_str}'
+            AND time <= '{end_time_str}'
+        GROUP BY symbol
+        """
+        
+        try:
+            result = self.client.execute(query)
+            return {row[0]: float(row[1]) for row in result if row[1] is not None}
+        except Exception as e:
+            print(f"Error getting prices at {as_of} for {len(symbols)} symbols: {e}")
+            return {}
+    
+    def get_auction_prices(
+        self,
+        symbols: List[str],
+        session: str,
+        trade_date: date
+    ) -> Dict[str, float]:
+        """
+        Giá khớp lệnh định kỳ (ATO/ATC) của nhiều symbols trong một ngày, một query
+        Giá là tick khớp cuối cùng có session tương ứng trong stock_db.ticks
+        
+        Returns: Dict {symbol: price}, thiếu symbol nếu chưa có tick phiên đó
+        """
+        symbols = sorted(set(symbols))
+        if not symbols or session not in ("ATO", "ATC"):
+            return {}
+        
+        query = f"""
+        SELECT
+            symbol,
+            argMax(price, sending_time) AS price
+        FROM {self.TICKS_TABLE}
+        WHERE symbol IN ({self._symbols_in_clause(symbols)})
+            AND session = '{session}'
+            AND toDate(timestamp) = '{trade_date.isoformat()}'
+            AND price > 0
+        GROUP BY symbol
+        """
+        
+        try:
+            result = self.client.execute(query)
+            return {row[0]: float(row[1]) for row in result if row[1] is not None}
+        except Exception as e:
+            print(f"Error getting {session} prices on {trade_date} for {len(symbols)} symbols: {e}")
+            return {}
+    
     def get_top_symbols_by_candle_count(
         self, 
         interval: str = "1m",
@@ -302,7 +732,7 @@ class ClickHouseRepository:
         SELECT 
             symbol,
             count() AS candle_count
-        FROM stock_db.ohlc
+        FROM {self._ohlc_table(interval)}
         WHERE interval = '{interval_escaped}'
         GROUP BY symbol
         HAVING candle_count >= {min_candles}
@@ -319,4 +749,120 @@ class ClickHouseRepository:
         except Exception as e:
             print(f"Error getting top symbols by candle count: {e}")
             return []
-
+    
+    # === Orders (analytics) ===
+    
+    def get_orders_watermark(self) -> Optional[Tuple[datetime, int]]:
+        """(updated_at, id) lớn nhất đã sync sang ClickHouse (None nếu bảng trống); lỗi được raise lên caller"""
+        result = self.client.execute(
+            f"SELECT updated_at, id FROM {self.ORDERS_TABLE} ORDER BY updated_at DESC, id DESC LIMIT 1"
+        )
+        return (result[0][0], int(result[0][1])) if result else None
+    
+    def insert_orders(self, columns: List[str], data: List[list], dedup_token: Optional[str] = None) -> int:
+        """
+        Ghi một batch orders dạng columnar (data[i] là giá trị của cột columns[i]) trong một block
+        dedup_token: insert lại cùng token (retry sau lỗi) bị ClickHouse bỏ qua
+        """
+        if not data or not data[0]:
+            return 0
+        query_settings = {"insert_deduplication_token": dedup_token} if dedup_token else None
+        self.client.execute(
+            f"INSERT INTO {self.ORDERS_TABLE} ({', '.join(columns)}) VALUES",
+            data,
+            columnar=True,
+            settings=query_settings
+        )
+        return len(data[0])
+    
+    def get_order_symbol_stats(self, start: datetime, end: datetime, limit: int = 10) -> List[Dict]:
+        """Symbols có nhiều orders FILLED nhất trong [start, end) theo filled_at"""
+        query = f"""
+        SELECT
+            symbol,
+            count() AS total_orders,
+            sum(filled_quantity) AS total_volume,
+            countIf(side = 'BUY') AS buy_orders,
+            countIf(side = 'SELL') AS sell_orders,
+            toFloat64(sum(filled_price * filled_quantity)) * 1000 AS trading_value
+        FROM {self.ORDERS_TABLE} FINAL
+        WHERE status = 'FILLED' AND filled_at >= %(start)s AND filled_at < %(end)s
+        GROUP BY symbol
+        ORDER BY total_orders DESC, symbol
+        LIMIT {int(limit)}
+        """
+        
+        try:
+            result = self.client.execute(query, {"start": start, "end": end})
+            return [
+                {
+                    "symbol": row[0],
+                    "total_orders": int(row[1]),
+                    "total_volume": int(row[2]),
+                    "buy_orders": int(row[3]),
+                    "sell_orders": int(row[4]),
+                    "trading_value": float(row[5])
+                }
+                for row in result
+            ]
+        except Exception as e:
+            print(f"Error getting order symbol stats from {start} to {end}: {e}")
+            return []
+    
+    def get_order_daily_value(self, start: datetime, end: datetime) -> List[Dict]:
+        """Giá trị giao dịch (VNĐ), số orders FILLED và số traders theo ngày (giờ Việt Nam) trong [start, end)"""
+        query = f"""
+        SELECT
+            toDate(filled_at, '{self.MARKET_TIMEZONE}') AS day,
+            count() AS filled_orders,
+            uniqExact(user_id) AS traders,
+            toFloat64(sum(filled_price * filled_quantity)) * 1000 AS trading_value
+        FROM {self.ORDERS_TABLE} FINAL
+        WHERE status = 'FILLED' AND filled_at >= %(start)s AND filled_at < %(end)s
+        GROUP BY day
+        ORDER BY day
+        """
+        
+        try:
+            result = self.client.execute(query, {"start": start, "end": end})
+            return [
+                {
+                    "date": row[0].isoformat(),
+                    "filled_orders": int(row[1]),
+                    "traders": int(row[2]),
+                    "trading_value": float(row[3])
+                }
+                for row in result
+            ]
+        except Exception as e:
+            print(f"Error getting daily trading value from {start} to {end}: {e}")
+            return []
+    
+    def get_order_activity_by_hour(self, start: datetime, end: datetime) -> List[Dict]:
+        """Số orders đặt / đã FILLED / đã hủy theo giờ trong ngày (giờ Việt Nam), created_at trong [start, end)"""
+        query = f"""
+        SELECT
+            toHour(created_at, '{self.MARKET_TIMEZONE}') AS hour,
+            count() AS orders,
+            countIf(status = 'FILLED') AS filled_orders,
+            countIf(status = 'CANCELLED') AS cancelled_orders
+        FROM {self.ORDERS_TABLE} FINAL
+        WHERE created_at >= %(start)s AND created_at < %(end)s
+        GROUP BY hour
+        ORDER BY hour
+        """
+        
+        try:
+            result = self.client.execute(query, {"start": start, "end": end})
+            return [
+                {
+                    "hour": int(row[0]),
+                    "orders": int(row[1]),
+                    "filled_orders": int(row[2]),
+                    "cancelled_orders": int(row[3])
+                }
+                for row in result
+            ]
+        except Exception as e:
+            print(f"Error getting order activity by hour from {start} to {end}: {e}")
+            return []
@@ -0,0 +1,64 @@
+"""
+Equity Repository - Data Access Layer cho equity curve (equity_snapshots)
+"""
+
+from datetime import datetime
+from typing import Dict, List, Optional
+from sqlalchemy import and_, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from app.models.equity import EquitySnapshot
+
+
+class EquitySnapshotRepository:
+    """Equity snapshot repository"""
+    
+    @staticmethod
+    def add_points(db: Session, rows: List[Dict]) -> int:
+        """
+        Ghi nhiều điểm trong một câu INSERT (bỏ qua điểm đã có cùng user_id + recorded_at)
+        Returns: Số dòng đã ghi
+        """
+        if not rows:
+            return 0
+        stmt = insert(EquitySnapshot).values(rows).on_conflict_do_nothing(
+            index_elements=["user_id", "recorded_at"]
+        )
+        result = db.execute(stmt)
+        db.commit()
+        return result.rowcount
+    
+    @staticmethod
+    def get_curve(
+        db: Session,
+        user_id: int,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None
+    ) -> List[EquitySnapshot]:
+        """Các điểm của user trong [start, end], theo thời gian"""
+        return db.execute(EquitySnapshotRepository.curve_query(user_id, start, end)).scalars().all()
+    
+    @staticmethod
+    def curve_query(user_id: int, start: Optional[datetime], end: Optional[datetime]):
+        conditions = [EquitySnapshot.user_id == user_id]
+        if start is not None:
+            conditions.append(EquitySnapshot.recorded_at >= start)
+        if end is not None:
+            conditions.append(EquitySnapshot.recorded_at <= end)
+        return select(EquitySnapshot).where(and_(*conditions)).order_by(EquitySnapshot.recorded_at)
+
+
+class AsyncEquitySnapshotRepository:
+    """Equity snapshot repository cho AsyncSession (các method đọc)"""
+    
+    @staticmethod
+    async def get_curve(
+        db: AsyncSession,
+        user_id: int,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None
+    ) -> List[EquitySnapshot]:
+        """Các điểm của user trong [start, end], theo thời gian"""
+        result = await db.execute(EquitySnapshotRepository.curve_query(user_id, start, end))
+        return list(result.scalars().all())
@@ -0,0 +1,137 @@
+"""
+Ledger Repository - Data Access Layer cho sổ cái portfolio và snapshots
+"""
+
+from datetime import datetime
+from decimal import Decimal
+from typing import Dict, List, Optional
+from sqlalchemy import and_, func
+from sqlalchemy.orm import Session
+from app.models.ledger import LedgerEntry, PortfolioSnapshot
+
+
+class LedgerRepository:
+    """Ledger repository (chỉ insert entries, không update/delete)"""
+    
+    @staticmethod
+    def has_entries(db: Session, user_id: int) -> bool:
+        """User đã có entry nào trong sổ cái chưa"""
+        return db.query(LedgerEntry.id).filter(LedgerEntry.user_id == user_id).first() is not None
+    
+    @staticmethod
+    def add_entries(db: Session, entries: List[LedgerEntry], commit: bool = True) -> List[LedgerEntry]:
+        """Ghi nhiều entries trong một commit (commit=False: chỉ flush)"""
+        db.add_all(entries)
+        if commit:
+            db.commit()
+        else:
+            db.flush()
+        return entries
+    
+    @staticmethod
+    def add_entry(db: Session, entry: LedgerEntry, commit: bool = True) -> LedgerEntry:
+        """Ghi một entry (commit=False: chỉ flush)"""
+        db.add(entry)
+        if commit:
+            db.commit()
+            db.refresh(entry)
+        else:
+            db.flush()
+        return entry
+    
+    @staticmethod
+    def get_entries_between(
+        db: Session,
+        user_id: int,
+        after: Optional[datetime],
+        until: Optional[datetime]
+    ) -> List[LedgerEntry]:
+        """
+        Lấy entries có after < occurred_at <= until, theo thứ tự replay (occurred_at, id)
+        after/until = None: không giới hạn đầu/cuối
+        """
+        query = db.query(LedgerEntry).filter(LedgerEntry.user_id == user_id)
+        if after is not None:
+            query = query.filter(LedgerEntry.occurred_at > after)
+        if until is not None:
+            query = query.filter(LedgerEntry.occurred_at <= until)
+        return query.order_by(LedgerEntry.occurred_at, LedgerEntry.id).all()
+    
+    @staticmethod
+    def count_entries_after(db: Session, user_id: int, after: Optional[datetime]) -> int:
+        """Đếm entries có occurred_at > after (số entries phải replay từ snapshot mới nhất)"""
+        query = db.query(func.count(LedgerEntry.id)).filter(LedgerEntry.user_id == user_id)
+        if after is not None:
+            query = query.filter(LedgerEntry.occurred_at > after)
+        return query.scalar() or 0
+    
+    @staticmethod
+    def get_last_entry_time(db: Session, user_id: int) -> Optional[datetime]:
+        """occurred_at lớn nhất của user"""
+        return db.query(func.max(LedgerEntry.occurred_at)).filter(LedgerEntry.user_id == user_id).scalar()
+    
+    @staticmethod
+    def get_user_ids_with_entries_after(db: Session, after_by_user: Dict[int, datetime]) -> List[int]:
+        """
+        Users có entry mới hơn snapshot mới nhất của họ (users chưa có snapshot cũng được tính)
+        Args:
+            after_by_user: {user_id: as_of của snapshot mới nhất}
+        """
+        rows = db.query(LedgerEntry.user_id, func.max(LedgerEntry.occurred_at)).group_by(LedgerEntry.user_id).all()
+        return [
+            user_id for user_id, last_time in rows
+            if user_id not in after_by_user or last_time > after_by_user[user_id]
+        ]
+
+
+class PortfolioSnapshotRepository:
+    """Portfolio snapshot repository"""
+    
+    @staticmethod
+    def get_latest_before(db: Session, user_id: int, as_of: Optional[datetime] = None) -> Optional[PortfolioSnapshot]:
+        """Snapshot gần nhất có as_of <= thời điểm cần tính (None: snapshot mới nhất)"""
+        query = db.query(PortfolioSnapshot).filter(PortfolioSnapshot.user_id == user_id)
+        if as_of is not None:
+            query = query.filter(PortfolioSnapshot.as_of <= as_of)
+        return query.order_by(PortfolioSnapshot.as_of.desc(), PortfolioSnapshot.id.desc()).first()
+    
+    @staticmethod
+    def get_latest_times(db: Session) -> Dict[int, datetime]:
+        """as_of của snapshot mới nhất theo từng user (một query GROUP BY)"""
+        rows = db.query(PortfolioSnapshot.user_id, func.max(PortfolioSnapshot.as_of)).group_by(
+            PortfolioSnapshot.user_id
+        ).all()
+        return {user_id: as_of for user_id, as_of in rows}
+    
+    @staticmethod
+    def create_snapshot(
+        db: Session,
+        user_id: int,
+        as_of: datetime,
+        cash_balance: Decimal,
+        positions: Dict[str, Dict]
+    ) -> PortfolioSnapshot:
+        """Lưu snapshot"""
+        snapshot = PortfolioSnapshot(
+            user_id=user_id,
+            as_of=as_of,
+            cash_balance=cash_balance,
+            positions=positions
+        )
+        db.add(snapshot)
+        db.commit()
+        db.refresh(snapshot)
+        return snapshot
+    
+    @staticmethod
+    def delete_from(db: Session, user_id: int, as_of: datetime, commit: bool = True) -> int:
+        """
+        Xóa snapshots có as_of >= thời điểm (khi ghi entry lùi ngày, các snapshots này không còn đúng)
+        Returns: Số snapshots đã xóa
+        """
+        deleted = db.query(PortfolioSnapshot).filter(
+            and_(PortfolioSnapshot.user_id == user_id, PortfolioSnapshot.as_of >= as_of)
+        ).delete(synchronize_session=False)
+        if commit and deleted:
+            db.commit()
+        return deleted
@@ -3,7 +3,8 @@ Lesson Repository - Data Access Layer
 """
 
 from sqlalchemy.orm import Session
-from sqlalchemy import and_
+from sqlalchemy import and_, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.models.lesson import Lesson, LessonProgress
 from app.schemas.lesson import LessonCreate, LessonUpdate
 from typing import List, Optional, Dict, Any
@@ -78,6 +79,24 @@ class LessonRepository:
             LessonProgress.user_id == user_id
         ).all()
     
+    @staticmethod
+    def _commit_progress(
+        db: Session,
+        progress: LessonProgress,
+        old_status: Optional[str],
+        old_quiz_score: Optional[int],
+        created: bool = False
+    ):
+        """Commit thay đổi tiến độ và báo cho thống kê admin"""
+        # Import tại chỗ để tránh import vòng (app.services import repositories)
+        from app.services.admin_stats_service import admin_stats
+        committed_at = admin_stats.commit(db)
+        db.refresh(progress)
+        admin_stats.progress_changed(
+            committed_at, progress.lesson_id, old_status, progress.status, old_quiz_score, progress.quiz_score,
+            created=created
+        )
+    
     @staticmethod
     def create_progress(db: Session, user_id: int, lesson_id: int) -> LessonProgress:
         """Tạo progress mới cho user"""
@@ -87,8 +106,7 @@ class LessonRepository:
             status="NOT_STARTED"
         )
         db.add(progress)
-        db.commit()
-        db.refresh(progress)
+        LessonRepository._commit_progress(db, progress, None, None, created=True)
         return progress
     
     @staticmethod
@@ -99,36 +117,36 @@ class LessonRepository:
         score: Optional[int] = None
     ) -> LessonProgress:
         """Cập nhật progress"""
+        old_status, old_quiz_score = progress.status, progress.quiz_score
         if status:
             progress.status = status
         if score is not None:
             progress.score = score
         
-        db.commit()
-        db.refresh(progress)
+        LessonRepository._commit_progress(db, progress, old_status, old_quiz_score)
         return progress
     
     @staticmethod
     def start_lesson(db: Session, progress: LessonProgress) -> LessonProgress:
         """Bắt đầu lesson"""
         from datetime import datetime
+        old_status, old_quiz_score = progress.status, progress.quiz_score
         progress.status = "IN_PROGRESS"
         progress.started_at = datetime.utcnow()
         progress.last_accessed_at = datetime.utcnow()
-        db.commit()
-        db.refresh(progress)
+        LessonRepository._commit_progress(db, progress, old_status, old_quiz_score)
         return progress
     
     @staticmethod
     def complete_lesson(db: Session, progress: LessonProgress, score: int) -> LessonProgress:
         """Hoàn thành lesson"""
         from datetime import datetime
+        old_status, old_quiz_score = progress.status, progress.quiz_score
         progress.status = "COMPLETED"
         progress.score = score
         progress.completed_at = datetime.utcnow()
         progress.last_accessed_at = datetime.utcnow()
-        db.commit()
-        db.refresh(progress)
+        LessonRepository._commit_progress(db, progress, old_status, old_quiz_score)
         return progress
     
     @staticmethod
@@ -141,6 +159,7 @@ class LessonRepository:
     ) -> LessonProgress:
         """Cập nhật quiz progress"""
         from datetime import datetime
+        old_status, old_quiz_score = progress.status, progress.quiz_score
         progress.quiz_score = quiz_score
         progress.quiz_attempts += 1
         progress.quiz_passed = passed
@@ -152,6 +171,58 @@ class LessonRepository:
             progress.status = "COMPLETED"
             progress.completed_at = datetime.utcnow()
         
-        db.commit()
-        db.refresh(progress)
+        LessonRepository._commit_progress(db, progress, old_status, old_quiz_score)
         return progress
+
+
+class AsyncLessonRepository:
+    """Lesson repository cho AsyncSession (các method đọc của LessonRepository)"""
+    
+    @staticmethod
+    async def get_all(db: AsyncSession, skip: int = 0, limit: int = 100, active_only: bool = True) -> List[Lesson]:
+        """Lấy danh sách lessons"""
+        query = select(Lesson)
+        if active_only:
+            query = query.where(Lesson.is_active == True)
+        query = query.order_by(Lesson.order_index, Lesson.id).offset(skip).limit(limit)
+        result = await db.execute(query)
+        return list(result.scalars().all())
+    
+    @staticmethod
+    async def get_by_id(db: AsyncSession, lesson_id: int) -> Optional[Lesson]:
+        """Lấy lesson theo ID"""
+        return await db.get(Lesson, lesson_id)
+    
+    @staticmethod
+    async def get_by_difficulty(db: AsyncSession, difficulty: str) -> List[Lesson]:
+        """Lấy tất cả lessons theo difficulty level (chỉ active)"""
+        result = await db.execute(
+            select(Lesson).where(
+                and_(
+                    Lesson.difficulty_level == difficulty,
+                    Lesson.is_active == True
+                )
+            ).order_by(Lesson.order_index, Lesson.id)
+        )
+        return list(result.scalars().all())
+    
+    @staticmethod
+    async def get_progress(db: AsyncSession, user_id: int, lesson_id: int) -> Optional[LessonProgress]:
+        """Lấy progress của user cho lesson"""
+        result = await db.execute(
+            select(LessonProgress).where(
+                and_(
+                    LessonProgress.user_id == user_id,
+                    LessonProgress.lesson_id == lesson_id
+                )
+            ).limit(1)
+        )
+        return result.scalars().first()
+    
+    @staticmethod
+    async def get_all_progress(db: AsyncSession, user_id: int) -> List[LessonProgress]:
+        """Lấy tất cả progress của user"""
+        result = await db.execute(
+            select(LessonProgress).where(LessonProgress.user_id == user_id)
+        )
+        return list(result.scalars().all())
@@ -3,10 +3,12 @@ Portfolio Repository - Data Access Layer
 """
 
 from sqlalchemy.orm import Session
-from sqlalchemy import and_, desc, func
+from sqlalchemy import and_, bindparam, case, desc, func, select, tuple_, update
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.models.portfolio import Portfolio, VirtualOrder, VirtualPosition
 from app.schemas.portfolio import VirtualOrderCreate
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
+from datetime import datetime, timedelta
 from decimal import Decimal
 
 
@@ -18,6 +20,19 @@ class PortfolioRepository:
         """Lấy portfolio của user"""
         return db.query(Portfolio).filter(Portfolio.user_id == user_id).first()
     
+    @staticmethod
+    def get_by_user_ids(db: Session, user_ids: List[int]) -> Dict[int, Portfolio]:
+        """Lấy portfolios của nhiều users trong một query"""
+        if not user_ids:
+            return {}
+        portfolios = db.query(Portfolio).filter(Portfolio.user_id.in_(user_ids)).all()
+        return {portfolio.user_id: portfolio for portfolio in portfolios}
+    
+    @staticmethod
+    def get_all(db: Session) -> List[Portfolio]:
+        """Lấy portfolios của tất cả users"""
+        return db.query(Portfolio).all()
+    
     @staticmethod
     def create_portfolio(db: Session, user_id: int, initial_balance: Decimal = Decimal("1000000.00")) -> Portfolio:
         """Tạo portfolio mới cho user"""
@@ -40,11 +55,14 @@ class PortfolioRepository:
         return portfolio
     
     @staticmethod
-    def update_cash_balance(db: Session, portfolio: Portfolio, amount: Decimal) -> Portfolio:
-        """Cập nhật cash balance"""
+    def update_cash_balance(db: Session, portfolio: Portfolio, amount: Decimal, commit: bool = True) -> Portfolio:
+        """Cập nhật cash balance (commit=False: chỉ flush, caller commit cả transaction)"""
         portfolio.cash_balance += amount
-        db.commit()
-        db.refresh(portfolio)
+        if commit:
+            db.commit()
+            db.refresh(portfolio)
+        else:
+            db.flush()
         return portfolio
     
     @staticmethod
@@ -64,6 +82,25 @@ class PortfolioRepository:
         db.refresh(portfolio)
         return portfolio
     
+    @staticmethod
+    def update_total_values(db: Session, total_values: Dict[int, Decimal]) -> int:
+        """
+        Cập nhật total_value của nhiều portfolios trong một executemany ({user_id: total_value})
+        Returns: Số portfolios đã cập nhật
+        """
+        if not total_values:
+            return 0
+        table = Portfolio.__table__
+        stmt = update(table).where(table.c.user_id == bindparam("b_user_id")).values(
+            total_value=bindparam("b_total_value")
+        )
+        db.execute(stmt, [
+            {"b_user_id": user_id, "b_total_value": total_value}
+            for user_id, total_value in total_values.items()
+        ])
+        db.commit()
+        return len(total_values)
+    
     @staticmethod
     def block_cash(db: Session, portfolio: Portfolio, amount: Decimal) -> Portfolio:
         """Block (phong tỏa) tiền cho QUEUED/PENDING orders"""
@@ -73,22 +110,73 @@ class PortfolioRepository:
         return portfolio
     
     @staticmethod
-    def unblock_cash(db: Session, portfolio: Portfolio, amount: Decimal) -> Portfolio:
-        """Unblock (giải phóng) tiền đã bị phong tỏa"""
+    def unblock_cash(db: Session, portfolio: Portfolio, amount: Decimal, commit: bool = True) -> Portfolio:
+        """Unblock (giải phóng) tiền đã bị phong tỏa (commit=False: chỉ flush)"""
         portfolio.blocked_cash -= amount
         if portfolio.blocked_cash < 0:
             portfolio.blocked_cash = Decimal("0")  # Không cho phép âm
-        db.commit()
-        db.refresh(portfolio)
+        if commit:
+            db.commit()
+            db.refresh(portfolio)
+        else:
+            db.flush()
         return portfolio
+    
+    @staticmethod
+    def adjust_cash(
+        db: Session,
+        user_id: int,
+        cash_delta: Decimal = Decimal("0"),
+        blocked_delta: Decimal = Decimal("0"),
+        min_available: Optional[Decimal] = None
+    ) -> Optional[Portfolio]:
+        """
+        Cộng cash_balance / blocked_cash bằng một câu UPDATE ... RETURNING (không đọc-sửa-ghi trong Python,
+        nên không mất cập nhật khi cùng user đặt nhiều orders đồng thời). Dòng portfolio bị khóa đến hết
+        transaction; không commit, caller commit/rollback. blocked_cash không xuống dưới 0.
+        
+        Args:
+            min_available: Chỉ cập nhật nếu tiền khả dụng (cash_balance - blocked_cash) trước khi cập nhật >= giá trị này
+        Returns: Portfolio sau khi cập nhật, None nếu không có portfolio hoặc không đủ tiền khả dụng
+        """
+        stmt = update(Portfolio).where(Portfolio.user_id == user_id).values(
+            cash_balance=Portfolio.cash_balance + cash_delta,
+            blocked_cash=func.greatest(Portfolio.blocked_cash + blocked_delta, 0)
+        )
+        if min_available is not None:
+            stmt = stmt.where(Portfolio.cash_balance - Portfolio.blocked_cash >= min_available)
+        stmt = stmt.returning(Portfolio).execution_options(synchronize_session="fetch")
+        return db.scalars(stmt).first()
+    
+    @staticmethod
+    def refresh_total_value(db: Session, user_id: int) -> Optional[Decimal]:
+        """
+        Tính lại total_value = cash_balance + giá trị positions (last_price hoặc avg_price) trong một câu UPDATE,
+        cùng công thức với TradingService.update_portfolio_value khi không có giá real-time. Không commit.
+        """
+        # Giá là nghìn VNĐ, cần nhân 1000 khi tính giá trị position
+        position_price = func.coalesce(func.nullif(VirtualPosition.last_price, 0), VirtualPosition.avg_price)
+        positions_value = select(
+            func.coalesce(func.sum(position_price * VirtualPosition.quantity), 0) * 1000
+        ).where(VirtualPosition.user_id == user_id).scalar_subquery()
+        stmt = update(Portfolio).where(Portfolio.user_id == user_id).values(
+            total_value=Portfolio.cash_balance + positions_value
+        ).returning(Portfolio.total_value).execution_options(synchronize_session="fetch")
+        return db.execute(stmt).scalar()
 
 
 class VirtualOrderRepository:
     """Virtual Order repository"""
     
     @staticmethod
-    def create(db: Session, user_id: int, order_data: VirtualOrderCreate, status: str = "PENDING") -> VirtualOrder:
-        """Tạo order mới"""
+    def create(
+        db: Session,
+        user_id: int,
+        order_data: VirtualOrderCreate,
+        status: str = "PENDING",
+        commit: bool = True
+    ) -> VirtualOrder:
+        """Tạo order mới (commit=False: chỉ add vào session, INSERT ở lần flush/commit tiếp theo)"""
         order = VirtualOrder(
             user_id=user_id,
             symbol=order_data.symbol,
@@ -101,8 +189,9 @@ class VirtualOrderRepository:
             status=status
         )
         db.add(order)
-        db.commit()
-        db.refresh(order)
+        if commit:
+            db.commit()
+            db.refresh(order)
         return order
     
     @staticmethod
@@ -111,11 +200,64 @@ class VirtualOrderRepository:
         return db.query(VirtualOrder).filter(VirtualOrder.id == order_id).first()
     
     @staticmethod
-    def get_by_user(db: Session, user_id: int, skip: int = 0, limit: int = 100) -> List[VirtualOrder]:
-        """Lấy danh sách orders của user"""
+    def history_conditions(
+        user_id: int,
+        status: Optional[str] = None,
+        trading_mode: Optional[str] = None,
+        order_type: Optional[str] = None,
+        before: Optional[Tuple[datetime, int]] = None
+    ) -> list:
+        """
+        Điều kiện WHERE cho lịch sử orders (dùng chung sync/async)
+        before: (created_at, id) của order cuối trang trước - keyset, lấy các orders cũ hơn
+        """
+        conditions = [VirtualOrder.user_id == user_id]
+        if status:
+            conditions.append(VirtualOrder.status == status)
+        if trading_mode:
+            conditions.append(VirtualOrder.trading_mode == trading_mode)
+        if order_type:
+            conditions.append(VirtualOrder.order_type == order_type)
+        if before is not None:
+            conditions.append(tuple_(VirtualOrder.created_at, VirtualOrder.id) < tuple_(*before))
+        return conditions
+    
+    @staticmethod
+    def get_by_user(
+        db: Session,
+        user_id: int,
+        skip: int = 0,
+        limit: int = 100,
+        status: Optional[str] = None,
+        trading_mode: Optional[str] = None,
+        order_type: Optional[str] = None,
+        before: Optional[Tuple[datetime, int]] = None
+    ) -> List[VirtualOrder]:
+        """Lấy danh sách orders của user, mới nhất trước (lọc và phân trang trong SQL)"""
         return db.query(VirtualOrder).filter(
-            VirtualOrder.user_id == user_id
-        ).order_by(desc(VirtualOrder.created_at)).offset(skip).limit(limit).all()
+            *VirtualOrderRepository.history_conditions(user_id, status, trading_mode, order_type, before)
+        ).order_by(desc(VirtualOrder.created_at), desc(VirtualOrder.id)).offset(skip).limit(limit).all()
+    
+    @staticmethod
+    def get_changed_since(
+        db: Session,
+        columns: List[str],
+        after: Optional[Tuple[datetime, int]],
+        settle_seconds: float,
+        limit: int
+    ) -> List[tuple]:
+        """
+        Các orders có (updated_at, id) > after, theo thứ tự (updated_at, id) - dùng cho sync sang ClickHouse
+        Bỏ qua các thay đổi trong settle_seconds gần nhất (theo đồng hồ DB): updated_at là thời điểm bắt đầu
+        transaction, transaction commit muộn vẫn có updated_at nhỏ hơn watermark nếu đọc quá sát hiện tại.
+        Chỉ lấy các cột cần.
+        """
+        query = db.query(*[getattr(VirtualOrder, name) for name in columns]).filter(
+            VirtualOrder.updated_at < func.now() - timedelta(seconds=settle_seconds)
+        )
+        if after is not None:
+            query = query.filter(tuple_(VirtualOrder.updated_at, VirtualOrder.id) > tuple_(*after))
+        return query.order_by(VirtualOrder.updated_at, VirtualOrder.id).limit(limit).all()
     
     @staticmethod
     def get_pending_orders(db: Session, user_id: int, symbol: Optional[str] = None) -> List[VirtualOrder]:
@@ -174,31 +316,86 @@ class VirtualOrderRepository:
             query = query.filter(VirtualOrder.user_id == user_id)
         return query.order_by(VirtualOrder.created_at).all()
     
+    @staticmethod
+    def get_filled_net_quantities(db: Session, user_id: int) -> Dict[str, int]:
+        """
+        Tổng quantity BUY - SELL của các orders FILLED theo symbol (một query GROUP BY)
+        Returns: Dict {symbol: quantity}
+        """
+        net_quantity = func.sum(
+            case((VirtualOrder.side == "BUY", VirtualOrder.quantity), else_=-VirtualOrder.quantity)
+        )
+        rows = db.query(VirtualOrder.symbol, net_quantity).filter(
+            VirtualOrder.user_id == user_id,
+            VirtualOrder.status == "FILLED"
+        ).group_by(VirtualOrder.symbol).all()
+        return {symbol: int(quantity or 0) for symbol, quantity in rows}
+    
+    @staticmethod
+    def get_filled_orders(db: Session, user_id: int) -> List[VirtualOrder]:
+        """Lấy tất cả orders FILLED của user theo thứ tự khớp"""
+        return db.query(VirtualOrder).filter(
+            and_(VirtualOrder.user_id == user_id, VirtualOrder.status == "FILLED")
+        ).order_by(VirtualOrder.filled_at, VirtualOrder.id).all()
+    
     @staticmethod
     def fill_order(
         db: Session,
         order: VirtualOrder,
         filled_quantity: int,
-        filled_price: Decimal
-    ) -> VirtualOrder:
-        """Fill order"""
+        filled_price: Decimal,
+        commit: bool = True
+    ) -> Optional[VirtualOrder]:
+        """
+        Fill order (commit=False: chỉ flush)
+        Order đã có trong DB được chuyển sang FILLED bằng UPDATE có điều kiện status PENDING/QUEUED, nên hai
+        nơi cùng fill một order (engine, scheduler, request) thì chỉ một nơi thành công.
+        Returns: order, None nếu order không còn PENDING/QUEUED
+        """
         from datetime import datetime
-        order.status = "FILLED"
-        order.filled_quantity = filled_quantity
-        order.filled_price = filled_price
-        order.filled_at = datetime.utcnow()
-        db.commit()
-        db.refresh(order)
+        values = {
+            "status": "FILLED",
+            "filled_quantity": filled_quantity,
+            "filled_price": filled_price,
+            "filled_at": datetime.utcnow()
+        }
+        if order.id is None:
+            # Order mới chưa INSERT: ghi thẳng trạng thái FILLED
+            for key, value in values.items():
+                setattr(order, key, value)
+            db.add(order)
+        else:
+            result = db.execute(
+                update(VirtualOrder).where(
+                    and_(VirtualOrder.id == order.id, VirtualOrder.status.in_(["PENDING", "QUEUED"]))
+                ).values(**values).execution_options(synchronize_session="fetch")
+            )
+            if result.rowcount == 0:
+                return None
+        if commit:
+            db.commit()
+            db.refresh(order)
+        else:
+            db.flush()
         return order
     
     @staticmethod
-    def cancel_order(db: Session, order: VirtualOrder) -> VirtualOrder:
-        """Cancel order"""
+    def cancel_order(db: Session, order: VirtualOrder, commit: bool = True) -> Optional[VirtualOrder]:
+        """
+        Cancel order bằng UPDATE có điều kiện status PENDING/QUEUED (commit=False: không commit)
+        Returns: order, None nếu order không còn PENDING/QUEUED
+        """
         from datetime import datetime
-        order.status = "CANCELLED"
-        order.cancelled_at = datetime.utcnow()
-        db.commit()
-        db.refresh(order)
+        result = db.execute(
+            update(VirtualOrder).where(
+                and_(VirtualOrder.id == order.id, VirtualOrder.status.in_(["PENDING", "QUEUED"]))
+            ).values(status="CANCELLED", cancelled_at=datetime.utcnow()).execution_options(synchronize_session="fetch")
+        )
+        if result.rowcount == 0:
+            return None
+        if commit:
+            db.commit()
+            db.refresh(order)
         return order
     
     @staticmethod
@@ -214,14 +411,22 @@ class VirtualPositionRepository:
     """Virtual Position repository"""
     
     @staticmethod
-    def get_by_user_and_symbol(db: Session, user_id: int, symbol: str) -> Optional[VirtualPosition]:
-        """Lấy position của user cho symbol"""
-        return db.query(VirtualPosition).filter(
+    def get_by_user_and_symbol(
+        db: Session,
+        user_id: int,
+        symbol: str,
+        for_update: bool = False
+    ) -> Optional[VirtualPosition]:
+        """Lấy position của user cho symbol (for_update=True: SELECT ... FOR UPDATE, khóa đến hết transaction)"""
+        query = db.query(VirtualPosition).filter(
             and_(
                 VirtualPosition.user_id == user_id,
                 VirtualPosition.symbol == symbol
             )
-        ).first()
+        )
+        if for_update:
+            query = query.with_for_update()
+        return query.first()
     
     @staticmethod
     def get_all_by_user(db: Session, user_id: int) -> List[VirtualPosition]:
@@ -230,23 +435,95 @@ class VirtualPositionRepository:
             VirtualPosition.user_id == user_id
         ).all()
     
+    @staticmethod
+    def get_all(db: Session) -> List[VirtualPosition]:
+        """Lấy positions của tất cả users"""
+        return db.query(VirtualPosition).all()
+    
+    @staticmethod
+    def find_quantity_mismatches(db: Session, user_id: Optional[int] = None) -> List[tuple]:
+        """
+        So sánh quantity của positions với tổng orders FILLED trong một query (FULL OUTER JOIN)
+        Chỉ trả về các cặp (user, symbol) lệch nhau, kể cả position thiếu hoặc thừa
+        Returns: List (position_id | None, user_id, symbol, actual_quantity, expected_quantity)
+        """
+        filled_orders = db.query(
+            VirtualOrder.user_id.label("user_id"),
+            VirtualOrder.symbol.label("symbol"),
+            func.sum(
+                case((VirtualOrder.side == "BUY", VirtualOrder.quantity), else_=-VirtualOrder.quantity)
+            ).label("quantity")
+        ).filter(VirtualOrder.status == "FILLED")
+        positions = db.query(VirtualPosition)
+        if user_id is not None:
+            filled_orders = filled_orders.filter(VirtualOrder.user_id == user_id)
+            positions = positions.filter(VirtualPosition.user_id == user_id)
+        expected = filled_orders.group_by(VirtualOrder.user_id, VirtualOrder.symbol).subquery()
+        actual = positions.subquery()
+        
+        actual_quantity = func.coalesce(actual.c.quantity, 0)
+        expected_quantity = func.coalesce(expected.c.quantity, 0)
+        return db.query(
+            actual.c.id,
+            func.coalesce(actual.c.user_id, expected.c.user_id),
+            func.coalesce(actual.c.symbol, expected.c.symbol),
+            actual_quantity,
+            expected_quantity
+        ).select_from(actual).join(
+            expected,
+            and_(actual.c.user_id == expected.c.user_id, actual.c.symbol == expected.c.symbol),
+            full=True
+        ).filter(actual_quantity != expected_quantity).all()
+    
+    @staticmethod
+    def delete_by_ids(db: Session, position_ids: List[int]) -> int:
+        """Xóa positions theo danh sách ID (một câu DELETE)"""
+        if not position_ids:
+            return 0
+        deleted = db.query(VirtualPosition).filter(
+            VirtualPosition.id.in_(position_ids)
+        ).delete(synchronize_session=False)
+        db.commit()
+        return deleted
+    
     @staticmethod
     def create_or_update_position(
         db: Session,
         user_id: int,
         symbol: str,
         quantity_change: int,
-        price: Decimal
+        price: Decimal,
+        commit: bool = True
     ) -> VirtualPosition:
-        """Tạo hoặc cập nhật position"""
+        """Tạo hoặc cập nhật position (commit=False: chỉ flush)"""
         position = VirtualPositionRepository.get_by_user_and_symbol(db, user_id, symbol)
-        
+        return VirtualPositionRepository.apply_quantity_change(
+            db, position, user_id, symbol, quantity_change, price, commit=commit
+        )
+    
+    @staticmethod
+    def apply_quantity_change(
+        db: Session,
+        position: Optional[VirtualPosition],
+        user_id: int,
+        symbol: str,
+        quantity_change: int,
+        price: Decimal,
+        commit: bool = True
+    ) -> Optional[VirtualPosition]:
+        """
+        Cộng quantity_change vào position đã load (None: chưa có position), tính lại avg_price
+        (commit=False: chỉ flush)
+        """
         if position:
             # Update existing position
             if position.quantity + quantity_change == 0:
                 # Position closed, delete it
                 db.delete(position)
-                db.commit()
+                if commit:
+                    db.commit()
+                else:
+                    db.flush()
                 return None
             else:
                 # Update average price và quantity
@@ -265,8 +542,11 @@ class VirtualPositionRepository:
             )
             db.add(position)
         
-        db.commit()
-        db.refresh(position)
+        if commit:
+            db.commit()
+            db.refresh(position)
+        else:
+            db.flush()
         return position
     
     @staticmethod
@@ -283,3 +563,120 @@ class VirtualPositionRepository:
         db.refresh(position)
         return position
 
+
+class AsyncPortfolioRepository:
+    """Portfolio repository cho AsyncSession"""
+    
+    @staticmethod
+    async def get_by_user_id(db: AsyncSession, user_id: int) -> Optional[Portfolio]:
+        """Lấy portfolio của user"""
+        result = await db.execute(select(Portfolio).where(Portfolio.user_id == user_id).limit(1))
+        return result.scalars().first()
+    
+    @staticmethod
+    async def create_portfolio(db: AsyncSession, user_id: int, initial_balance: Decimal = Decimal("1000000.00")) -> Portfolio:
+        """Tạo portfolio mới cho user"""
+        portfolio = Portfolio(
+            user_id=user_id,
+            cash_balance=initial_balance,
+            total_value=initial_balance
+        )
+        db.add(portfolio)
+        await db.commit()
+        await db.refresh(portfolio)
+        return portfolio
+    
+    @staticmethod
+    async def get_or_create_portfolio(db: AsyncSession, user_id: int) -> Portfolio:
+        """Lấy hoặc tạo portfolio cho user"""
+        portfolio = await AsyncPortfolioRepository.get_by_user_id(db, user_id)
+        if not portfolio:
+            portfolio = await AsyncPortfolioRepository.create_portfolio(db, user_id)
+        return portfolio
+
+
+class AsyncVirtualOrderRepository:
+    """Virtual Order repository cho AsyncSession (các method đọc)"""
+    
+    @staticmethod
+    async def get_by_id(db: AsyncSession, order_id: int) -> Optional[VirtualOrder]:
+        """Lấy order theo ID"""
+        return await db.get(VirtualOrder, order_id)
+    
+    @staticmethod
+    async def get_by_user(
+        db: AsyncSession,
+        user_id: int,
+        skip: int = 0,
+        limit: int = 100,
+        status: Optional[str] = None,
+        trading_mode: Optional[str] = None,
+        order_type: Optional[str] = None,
+        before: Optional[Tuple[datetime, int]] = None
+    ) -> List[VirtualOrder]:
+        """
+        Lấy danh sách orders của user, mới nhất trước (lọc và phân trang trong SQL)
+        before: keyset cursor (created_at, id) - dùng thay skip để mỗi trang là một index range scan
+        """
+        result = await db.execute(
+            select(VirtualOrder).where(
+                *VirtualOrderRepository.history_conditions(user_id, status, trading_mode, order_type, before)
+            ).order_by(desc(VirtualOrder.created_at), desc(VirtualOrder.id)).offset(skip).limit(limit)
+        )
+        return list(result.scalars().all())
+    
+    @staticmethod
+    async def get_pending_orders(db: AsyncSession, user_id: int, symbol: Optional[str] = None) -> List[VirtualOrder]:
+        """Lấy danh sách pending/queued orders"""
+        query = select(VirtualOrder).where(
+            and_(
+                VirtualOrder.user_id == user_id,
+                VirtualOrder.status.in_(["PENDING", "QUEUED"])
+            )
+        )
+        if symbol:
+            query = query.where(VirtualOrder.symbol == symbol)
+        result = await db.execute(query.order_by(VirtualOrder.created_at))
+        return list(result.scalars().all())
+    
+    @staticmethod
+    async def get_pending_ato_atc_orders(db: AsyncSession, user_id: Optional[int] = None, symbol: Optional[str] = None) -> List[VirtualOrder]:
+        """Lấy danh sách ATO/ATC orders đang pending"""
+        query = select(VirtualOrder).where(
+            and_(
+                VirtualOrder.order_type.in_(["ATO", "ATC"]),
+                VirtualOrder.status == "PENDING"
+            )
+        )
+        if user_id:
+            query = query.where(VirtualOrder.user_id == user_id)
+        if symbol:
+            query = query.where(VirtualOrder.symbol == symbol)
+        result = await db.execute(query.order_by(VirtualOrder.created_at))
+        return list(result.scalars().all())
+
+
+class AsyncVirtualPositionRepository:
+    """Virtual Position repository cho AsyncSession (các method đọc)"""
+    
+    @staticmethod
+    async def get_by_user_and_symbol(db: AsyncSession, user_id: int, symbol: str) -> Optional[VirtualPosition]:
+        """Lấy position của user cho symbol"""
+        result = await db.execute(
+            select(VirtualPosition).where(
+                and_(
+                    VirtualPosition.user_id == user_id,
+                    VirtualPosition.symbol == symbol
+                )
+            ).limit(1)
+        )
+        return result.scalars().first()
+    
+    @staticmethod
+    async def get_all_by_user(db: AsyncSession, user_id: int) -> List[VirtualPosition]:
+        """Lấy tất cả positions của user"""
+        result = await db.execute(
+            select(VirtualPosition).where(VirtualPosition.user_id == user_id)
+        )
+        return list(result.scalars().all())
+
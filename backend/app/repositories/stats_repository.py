@@ -0,0 +1,235 @@
+"""
+Stats Repository - Data Access Layer cho bảng tổng hợp của admin dashboard
+"""
+
+from datetime import datetime
+from decimal import Decimal
+from typing import Dict, List, Tuple
+from sqlalchemy import case, desc, func, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+from app.models.lesson import Lesson, LessonProgress
+from app.models.portfolio import VirtualOrder
+from app.models.stats import StatCounter, SymbolTradeStat, LessonStat
+from app.models.user import User
+
+SYMBOL_FIELDS = ("filled_orders", "total_volume", "buy_orders", "sell_orders")
+LESSON_FIELDS = ("total_attempts", "completions", "quiz_score_sum", "quiz_score_count")
+
+
+class StatsRepository:
+    """Stats repository (các method ghi không commit, caller commit)"""
+    
+    # Advisory locks (transaction-level): flush giữ shared, reconcile giữ exclusive
+    AGGREGATES_LOCK_KEY = 7202201
+    # Chỉ một worker reconcile tại một thời điểm
+    RECONCILE_LOCK_KEY = 7202202
+    # Counter lưu thời điểm snapshot của lần reconcile gần nhất (epoch milliseconds theo đồng hồ DB)
+    RECONCILED_AT = "reconciled_at"
+    
+    # === Lock / đồng hồ ===
+    
+    @staticmethod
+    def lock_aggregates(db: Session, shared: bool = False):
+        """Advisory lock đến hết transaction (shared: nhiều flush chạy song song, chờ reconcile xong)"""
+        key = StatsRepository.AGGREGATES_LOCK_KEY
+        lock = func.pg_advisory_xact_lock_shared(key) if shared else func.pg_advisory_xact_lock(key)
+        db.execute(select(lock))
+    
+    @staticmethod
+    def try_lock_aggregates_shared(db: Session) -> bool:
+        """Như lock_aggregates(shared=True) nhưng không chờ (False: đang reconcile)"""
+        return bool(db.execute(select(func.pg_try_advisory_xact_lock_shared(StatsRepository.AGGREGATES_LOCK_KEY))).scalar())
+    
+    @staticmethod
+    def try_lock_reconcile(db: Session) -> bool:
+        """Giành quyền reconcile đến hết transaction (False: worker khác đang reconcile)"""
+        return bool(db.execute(select(func.pg_try_advisory_xact_lock(StatsRepository.RECONCILE_LOCK_KEY))).scalar())
+    
+    @staticmethod
+    def lock_aggregate_rows(db: Session):
+        """SELECT ... FOR UPDATE mọi dòng của các bảng tổng hợp"""
+        db.query(StatCounter.name).with_for_update().all()
+        db.query(SymbolTradeStat.symbol).with_for_update().all()
+        db.query(LessonStat.lesson_id).with_for_update().all()
+    
+    @staticmethod
+    def db_time_ms(db: Session) -> Decimal:
+        """Thời điểm hiện tại theo đồng hồ DB (epoch milliseconds, clock_timestamp: không phải đầu transaction)"""
+        return Decimal(db.execute(select(func.extract("epoch", func.clock_timestamp()) * 1000)).scalar())
+    
+    @staticmethod
+    def begin_snapshot(db: Session) -> Decimal:
+        """
+        Mở transaction REPEATABLE READ: mọi query sau thấy cùng một snapshot, chụp ở câu đầu tiên
+        Returns: Thời điểm lấy trong chính câu đó (epoch milliseconds theo đồng hồ DB)
+        """
+        db.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+        return StatsRepository.db_time_ms(db)
+    
+    @staticmethod
+    def get_reconciled_at(db: Session) -> Decimal:
+        """Thời điểm reconcile gần nhất (epoch milliseconds, 0 nếu chưa reconcile)"""
+        return StatsRepository.get_counters(db, [StatsRepository.RECONCILED_AT])[StatsRepository.RECONCILED_AT]
+    
+    # === Đọc ===
+    
+    @staticmethod
+    def get_counters(db: Session, names: List[str]) -> Dict[str, Decimal]:
+        """Giá trị các counters (counter chưa có = 0)"""
+        rows = db.query(StatCounter.name, StatCounter.value).filter(StatCounter.name.in_(names)).all()
+        values = {name: Decimal("0") for name in names}
+        values.update({name: value for name, value in rows})
+        return values
+    
+    @staticmethod
+    def get_top_symbols(db: Session, limit: int) -> List[SymbolTradeStat]:
+        """Symbols có nhiều orders FILLED nhất"""
+        return db.query(SymbolTradeStat).order_by(
+            desc(SymbolTradeStat.filled_orders), SymbolTradeStat.symbol
+        ).limit(limit).all()
+    
+    @staticmethod
+    def get_lesson_stats(db: Session) -> List[tuple]:
+        """Mọi bài học kèm thống kê (bài học chưa có thống kê = 0)"""
+        return db.query(
+            Lesson.id,
+            Lesson.title,
+            Lesson.difficulty_level,
+            LessonStat.total_attempts,
+            LessonStat.completions,
+            LessonStat.quiz_score_sum,
+            LessonStat.quiz_score_count
+        ).outerjoin(LessonStat, Lesson.id == LessonStat.lesson_id).order_by(Lesson.id).all()
+    
+    # === Cộng delta (upsert cộng dồn) ===
+    
+    @staticmethod
+    def add_counters(db: Session, deltas: Dict[str, Decimal]):
+        """Cộng delta vào các counters trong một câu upsert"""
+        if not deltas:
+            return
+        stmt = insert(StatCounter).values([{"name": name, "value": value} for name, value in deltas.items()])
+        db.execute(stmt.on_conflict_do_update(
+            index_elements=[StatCounter.name],
+            set_={"value": StatCounter.value + stmt.excluded.value, "updated_at": func.now()}
+        ))
+    
+    @staticmethod
+    def add_symbol_stats(db: Session, deltas: Dict[str, Tuple[int, int, int, int]]):
+        """Cộng delta (filled_orders, total_volume, buy_orders, sell_orders) theo symbol"""
+        if not deltas:
+            return
+        stmt = insert(SymbolTradeStat).values([
+            {"symbol": symbol, **dict(zip(SYMBOL_FIELDS, values))} for symbol, values in deltas.items()
+        ])
+        db.execute(stmt.on_conflict_do_update(
+            index_elements=[SymbolTradeStat.symbol],
+            set_={field: getattr(SymbolTradeStat, field) + getattr(stmt.excluded, field) for field in SYMBOL_FIELDS}
+        ))
+    
+    @staticmethod
+    def add_lesson_stats(db: Session, deltas: Dict[int, Tuple[int, int, int, int]]):
+        """Cộng delta (total_attempts, completions, quiz_score_sum, quiz_score_count) theo bài học"""
+        if not deltas:
+            return
+        stmt = insert(LessonStat).values([
+            {"lesson_id": lesson_id, **dict(zip(LESSON_FIELDS, values))} for lesson_id, values in deltas.items()
+        ])
+        db.execute(stmt.on_conflict_do_update(
+            index_elements=[LessonStat.lesson_id],
+            set_={field: getattr(LessonStat, field) + getattr(stmt.excluded, field) for field in LESSON_FIELDS}
+        ))
+    
+    # === Reconcile: tính lại từ bảng gốc và ghi đè ===
+    
+    @staticmethod
+    def compute_counters(db: Session, month_start: datetime) -> Dict[str, Decimal]:
+        """Tính lại các counters bằng query trên users / virtual_orders / lesson_progress"""
+        filled_orders, trading_value = db.query(
+            func.count(VirtualOrder.id),
+            func.sum(VirtualOrder.filled_price * VirtualOrder.filled_quantity)
+        ).filter(VirtualOrder.status == "FILLED").one()
+        total_orders, active_traders = db.query(
+            func.count(VirtualOrder.id),
+            func.count(func.distinct(VirtualOrder.user_id))
+        ).one()
+        total_users, new_users = db.query(
+            func.count(User.id),
+            func.sum(case((User.created_at >= month_start, 1), else_=0))
+        ).one()
+        total_completions = db.query(func.count(LessonProgress.id)).filter(
+            LessonProgress.status == "COMPLETED"
+        ).scalar()
+        return {
+            "total_users": Decimal(total_users or 0),
+            "total_orders": Decimal(total_orders or 0),
+            "filled_orders": Decimal(filled_orders or 0),
+            "total_trading_value": Decimal(trading_value or 0),
+            "total_completions": Decimal(total_completions or 0),
+            "active_traders": Decimal(active_traders or 0),
+            f"new_users:{month_start.strftime('%Y-%m')}": Decimal(new_users or 0)
+        }
+    
+    @staticmethod
+    def compute_symbol_stats(db: Session) -> Dict[str, Tuple[int, int, int, int]]:
+        """Tính lại thống kê orders FILLED theo symbol (một query GROUP BY)"""
+        rows = db.query(
+            VirtualOrder.symbol,
+            func.count(VirtualOrder.id),
+            func.sum(VirtualOrder.filled_quantity),
+            func.sum(case((VirtualOrder.side == "BUY", 1), else_=0)),
+            func.sum(case((VirtualOrder.side == "SELL", 1), else_=0))
+        ).filter(VirtualOrder.status == "FILLED").group_by(VirtualOrder.symbol).all()
+        return {
+            symbol: (int(orders or 0), int(volume or 0), int(buys or 0), int(sells or 0))
+            for symbol, orders, volume, buys, sells in rows
+        }
+    
+    @staticmethod
+    def compute_lesson_stats(db: Session) -> Dict[int, Tuple[int, int, int, int]]:
+        """Tính lại thống kê tiến độ theo bài học (một query GROUP BY)"""
+        rows = db.query(
+            LessonProgress.lesson_id,
+            func.count(LessonProgress.id),
+            func.sum(case((LessonProgress.status == "COMPLETED", 1), else_=0)),
+            func.sum(LessonProgress.quiz_score),
+            func.count(LessonProgress.quiz_score)
+        ).group_by(LessonProgress.lesson_id).all()
+        return {
+            lesson_id: (int(attempts or 0), int(completions or 0), int(score_sum or 0), int(score_count or 0))
+            for lesson_id, attempts, completions, score_sum, score_count in rows
+        }
+    
+    @staticmethod
+    def replace_counters(db: Session, values: Dict[str, Decimal]):
+        """Ghi đè giá trị các counters"""
+        if not values:
+            return
+        stmt = insert(StatCounter).values([{"name": name, "value": value} for name, value in values.items()])
+        db.execute(stmt.on_conflict_do_update(
+            index_elements=[StatCounter.name],
+            set_={"value": stmt.excluded.value, "updated_at": func.now()}
+        ))
+    
+    @staticmethod
+    def set_reconciled_at(db: Session, reconciled_at_ms: Decimal):
+        StatsRepository.replace_counters(db, {StatsRepository.RECONCILED_AT: reconciled_at_ms})
+    
+    @staticmethod
+    def replace_symbol_stats(db: Session, stats: Dict[str, Tuple[int, int, int, int]]):
+        """Ghi đè toàn bộ bảng symbol_trade_stats"""
+        db.query(SymbolTradeStat).delete(synchronize_session=False)
+        if stats:
+            db.execute(insert(SymbolTradeStat).values([
+                {"symbol": symbol, **dict(zip(SYMBOL_FIELDS, values))} for symbol, values in stats.items()
+            ]))
+    
+    @staticmethod
+    def replace_lesson_stats(db: Session, stats: Dict[int, Tuple[int, int, int, int]]):
+        """Ghi đè toàn bộ bảng lesson_stats"""
+        db.query(LessonStat).delete(synchronize_session=False)
+        if stats:
+            db.execute(insert(LessonStat).values([
+                {"lesson_id": lesson_id, **dict(zip(LESSON_FIELDS, values))} for lesson_id, values in stats.items()
+            ]))
@@ -3,6 +3,9 @@ User Repository - Data Access Layer
 """
 
 import hashlib
+from typing import Dict
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from app.models.user import User
 from app.schemas.user import UserCreate
@@ -29,6 +32,11 @@ class UserRepository:
         """Lấy user theo email"""
         return db.query(User).filter(User.email == email).first()
     
+    @staticmethod
+    def get_usernames(db: Session) -> Dict[int, str]:
+        """Username của tất cả users (một query chỉ lấy 2 cột)"""
+        return {user_id: username for user_id, username in db.query(User.id, User.username).all()}
+    
     @staticmethod
     def _preprocess_password(password: str) -> str:
         """
@@ -60,8 +68,11 @@ class UserRepository:
             experience_points=0
         )
         db.add(db_user)
-        db.commit()
+        # Import tại chỗ để tránh import vòng (app.services import repositories)
+        from app.services.admin_stats_service import admin_stats
+        committed_at = admin_stats.commit(db)
         db.refresh(db_user)
+        admin_stats.user_created(committed_at)
         return db_user
     
     @staticmethod
@@ -79,5 +90,41 @@ class UserRepository:
             user.experience_points += points
             db.commit()
             db.refresh(user)
+            # Import tại chỗ để tránh import vòng (app.services import repositories)
+            from app.services.user_cache_service import user_cache
+            user_cache.invalidate(user_id=user.id)
+        return user
+
+
+class AsyncUserRepository:
+    """User repository cho AsyncSession (các method giống UserRepository)"""
+    
+    @staticmethod
+    async def get_by_id(db: AsyncSession, user_id: int) -> User | None:
+        """Lấy user theo ID"""
+        return await db.get(User, user_id)
+    
+    @staticmethod
+    async def get_by_username(db: AsyncSession, username: str) -> User | None:
+        """Lấy user theo username"""
+        result = await db.execute(select(User).where(User.username == username).limit(1))
+        return result.scalars().first()
+    
+    @staticmethod
+    async def get_by_email(db: AsyncSession, email: str) -> User | None:
+        """Lấy user theo email"""
+        result = await db.execute(select(User).where(User.email == email).limit(1))
+        return result.scalars().first()
+    
+    @staticmethod
+    async def update_experience_points(db: AsyncSession, user_id: int, points: int) -> User | None:
+        """Cập nhật experience points"""
+        user = await AsyncUserRepository.get_by_id(db, user_id)
+        if user:
+            user.experience_points += points
+            await db.commit()
+            await db.refresh(user)
+            from app.services.user_cache_service import user_cache
+            user_cache.invalidate(user_id=user.id)
         return user
 
@@ -72,6 +72,27 @@ class VirtualOrderResponse(VirtualOrderBase):
         }
 
 
+class VirtualOrderBatchCreate(BaseModel):
+    """Schema để tạo nhiều orders trong một request"""
+    orders: List[VirtualOrderCreate] = Field(..., min_length=1, description="Danh sách orders, xử lý theo thứ tự")
+    atomic: bool = Field(default=False, description="True: một order lỗi thì không tạo order nào")
+
+
+class VirtualOrderBatchResult(BaseModel):
+    """Kết quả của một order trong batch"""
+    index: int = Field(..., description="Vị trí của order trong request")
+    order: Optional[VirtualOrderResponse] = None
+    error: Optional[str] = Field(None, description="Lỗi nếu order không được tạo")
+    message: Optional[str] = Field(None, description="Thông báo nếu order được tạo với status QUEUED")
+
+
+class VirtualOrderBatchResponse(BaseModel):
+    """Schema để trả về kết quả batch"""
+    created: int
+    failed: int
+    results: List[VirtualOrderBatchResult]
+
+
 class VirtualPositionBase(BaseModel):
     """Base virtual position schema"""
     symbol: str = Field(..., max_length=10)
@@ -111,3 +132,17 @@ class OrderBookEntry(BaseModel):
     order_id: int
     created_at: datetime
 
+
+class EquityPoint(BaseModel):
+    """Một điểm của equity curve (VND)"""
+    recorded_at: datetime
+    cash_balance: Decimal
+    positions_value: Decimal
+    unrealized_pnl: Decimal
+    total_value: Decimal
+    
+    class Config:
+        from_attributes = True
+        json_encoders = {
+            Decimal: lambda v: float(v) if v is not None else None
+        }
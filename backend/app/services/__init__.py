@@ -6,10 +6,16 @@ from app.services.auth_service import AuthService
 from app.services.lesson_service import LessonService
 from app.services.trading_service import TradingService
 from app.services.trading_hours_service import TradingHoursService
+from app.services.price_cache_service import PriceCacheService, price_cache
+from app.services.user_cache_service import UserCacheService, user_cache
 
 __all__ = [
     "AuthService",
     "LessonService",
     "TradingService",
     "TradingHoursService",
+    "PriceCacheService",
+    "price_cache",
+    "UserCacheService",
+    "user_cache",
 ]
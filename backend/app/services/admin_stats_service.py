@@ -0,0 +1,356 @@
+"""
+Admin Stats Service - Thống kê admin dashboard cập nhật dần theo sự kiện, reconcile định kỳ
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from datetime import datetime
+from decimal import Decimal
+from typing import Callable, Dict, List, Optional, Tuple
+from sqlalchemy.orm import Session
+from app.config import settings
+from app.database import SessionLocal
+from app.models.portfolio import VirtualOrder
+from app.repositories.stats_repository import StatsRepository
+
+logger = logging.getLogger(__name__)
+
+
+class AdminStatsService:
+    """
+    Duy trì các bảng tổng hợp (stat_counters, symbol_trade_stats, lesson_stats) cho admin dashboard
+    
+    - Sự kiện (order tạo / FILLED, user mới, tiến độ bài học thay đổi) được ghi vào buffer trong process
+      sau khi transaction gốc commit, kèm committed_at: thời điểm theo đồng hồ DB lấy ngay trước commit
+      (commit() thay cho db.commit()), không ghi gì thêm xuống DB trên đường đặt lệnh
+    - flush(): cộng dồn buffer vào các bảng tổng hợp trong một transaction (upsert value = value + delta),
+      chạy mỗi flush_seconds và trước mỗi lần đọc của admin; lỗi thì giữ lại buffer cho lần sau
+    - reconcile(): tính lại toàn bộ từ bảng gốc (các query GROUP BY trước đây) và ghi đè, sửa mọi sai lệch
+      (process chết trước khi flush, thay đổi ngoài app). active_traders chỉ được cập nhật khi reconcile
+    
+    Nhiều worker:
+    - Mỗi reconcile_seconds chỉ một worker reconcile (advisory lock RECONCILE_LOCK_KEY + thời điểm reconcile
+      gần nhất lưu trong stat_counters), các worker khác bỏ qua
+    - Flush giữ shared advisory lock, reconcile giữ exclusive lock và khóa các dòng tổng hợp (FOR UPDATE)
+      trong cùng transaction tính lại + ghi đè: không flush nào commit xen giữa và bị ghi đè mất
+    - Reconcile tính lại trên một snapshot REPEATABLE READ (session riêng), reconciled_at lấy trong câu đầu
+      tiên của snapshot và được ghi cùng transaction ghi đè. Khi flush, mọi worker bỏ các sự kiện có
+      committed_at < reconciled_at, giữ các sự kiện còn lại:
+      - committed_at >= reconciled_at: transaction gốc commit sau khi chụp snapshot, không nằm trong kết quả
+        tính lại, nên cộng vào không bao giờ bị trùng (kể cả khi sự kiện được ghi vào buffer muộn)
+      - Còn lại một khoảng hở nhỏ (một round trip): transaction lấy committed_at ngay trước reconciled_at
+        nhưng commit sau khi chụp snapshot bị bỏ mà chưa được tính, counters thiếu đến lần reconcile sau.
+        Cả hai thời điểm đều theo đồng hồ DB, không phụ thuộc đồng hồ các máy chạy app
+    
+    Buffer là của từng process: mọi worker cần bật ADMIN_STATS_ENABLED để flush định kỳ.
+    """
+    
+    def __init__(
+        self,
+        flush_seconds: float = 5,
+        reconcile_seconds: float = 3600,
+        session_factory: Callable[[], Session] = SessionLocal
+    ):
+        self.flush_seconds = max(1.0, flush_seconds)
+        self.reconcile_seconds = reconcile_seconds
+        # Session riêng cho snapshot của reconcile và cho scheduler
+        self.session_factory = session_factory
+        # Mỗi worker kiểm tra đến hạn reconcile chưa (rẻ: một try-lock + đọc một counter)
+        self.reconcile_check_seconds = max(self.flush_seconds, min(60.0, reconcile_seconds or 60.0))
+        
+        # (committed_at epoch milliseconds, loại, key, deltas): loại "counter" / "symbol" / "lesson"
+        self._pending: List[Tuple[float, str, object, tuple]] = []
+        self._lock = threading.Lock()
+        self._running = False
+        
+        # Metrics
+        self.flushes = 0
+        self.flush_failures = 0
+        self.stale_dropped = 0
+        self.last_flush_ms = 0.0
+        self.reconciled_at: Optional[datetime] = None
+        self.last_reconcile_ms = 0.0
+    
+    @property
+    def is_running(self) -> bool:
+        return self._running
+    
+    @staticmethod
+    def month_key(now: Optional[datetime] = None) -> str:
+        """Tên counter số user mới trong tháng"""
+        return f"new_users:{(now or datetime.now()).strftime('%Y-%m')}"
+    
+    @staticmethod
+    def month_start(now: Optional[datetime] = None) -> datetime:
+        return (now or datetime.now()).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    
+    # === Sự kiện (gọi sau commit) ===
+    
+    @staticmethod
+    def commit(db: Session) -> float:
+        """
+        Commit transaction gốc thay cho db.commit()
+        Returns: committed_at cho các sự kiện của transaction (đồng hồ DB, lấy ngay trước commit)
+        """
+        committed_at = float(StatsRepository.db_time_ms(db))
+        db.commit()
+        return committed_at
+    
+    def _record(self, committed_at: float, entries: List[Tuple[str, object, tuple]]):
+        with self._lock:
+            self._pending.extend((committed_at, kind, key, deltas) for kind, key, deltas in entries)
+    
+    def order_created(self, committed_at: float, count: int = 1):
+        """Orders mới đã commit"""
+        if count:
+            self._record(committed_at, [("counter", "total_orders", (Decimal(count),))])
+    
+    def order_filled(self, committed_at: float, order: VirtualOrder):
+        """Order đã FILLED và commit"""
+        quantity = order.filled_quantity or order.quantity
+        self._record(committed_at, [
+            ("counter", "filled_orders", (Decimal(1),)),
+            ("counter", "total_trading_value", (Decimal(order.filled_price or 0) * quantity,)),
+            ("symbol", order.symbol, (1, quantity, 1 if order.side == "BUY" else 0, 1 if order.side == "SELL" else 0))
+        ])
+    
+    def orders_filled(self, committed_at: float, orders: List[VirtualOrder]):
+        for order in orders:
+            self.order_filled(committed_at, order)
+    
+    def user_created(self, committed_at: float):
+        """User mới đã commit"""
+        self._record(committed_at, [
+            ("counter", "total_users", (Decimal(1),)),
+            ("counter", self.month_key(), (Decimal(1),))
+        ])
+    
+    def progress_changed(
+        self,
+        committed_at: float,
+        lesson_id: int,
+        old_status: Optional[str],
+        new_status: Optional[str],
+        old_quiz_score: Optional[int] = None,
+        new_quiz_score: Optional[int] = None,
+        created: bool = False
+    ):
+        """Tiến độ bài học đã commit (created: bản ghi LessonProgress mới)"""
+        completed = int(new_status == "COMPLETED") - int(old_status == "COMPLETED")
+        score_sum = (new_quiz_score or 0) - (old_quiz_score or 0)
+        score_count = int(new_quiz_score is not None) - int(old_quiz_score is not None)
+        if not (created or completed or score_sum or score_count):
+            return
+        entries = [("lesson", lesson_id, (int(created), completed, score_sum, score_count))]
+        if completed:
+            entries.append(("counter", "total_completions", (Decimal(completed),)))
+        self._record(committed_at, entries)
+    
+    # === Ghi xuống DB ===
+    
+    @staticmethod
+    def _aggregate(pending: List[Tuple[float, str, object, tuple]], since_ms: float):
+        """Gộp các sự kiện commit từ since_ms trở đi. Returns: (counters, symbols, lessons, số sự kiện bị bỏ)"""
+        totals: Dict[str, Dict] = {"counter": {}, "symbol": {}, "lesson": {}}
+        stale = 0
+        for committed_at, kind, key, deltas in pending:
+            if committed_at < since_ms:
+                stale += 1
+                continue
+            rows = totals[kind]
+            row = rows.get(key)
+            rows[key] = deltas if row is None else tuple(a + b for a, b in zip(row, deltas))
+        counters = {name: row[0] for name, row in totals["counter"].items()}
+        return counters, totals["symbol"], totals["lesson"], stale
+    
+    def flush(self, db: Session, wait: bool = True) -> bool:
+        """
+        Cộng buffer vào các bảng tổng hợp (một transaction)
+        Sự kiện commit trước snapshot của lần reconcile gần nhất bị bỏ (đã nằm trong kết quả tính lại)
+        Args:
+            wait: Đang reconcile thì chờ xong; False: bỏ qua lần này, buffer giữ lại cho lần sau
+        Returns: False nếu lỗi (buffer được giữ lại cho lần sau)
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return True
+        started = time.perf_counter()
+        try:
+            if wait:
+                StatsRepository.lock_aggregates(db, shared=True)
+            elif not StatsRepository.try_lock_aggregates_shared(db):
+                db.rollback()
+                with self._lock:
+                    self._pending = pending + self._pending
+                return True
+            reconciled_at = float(StatsRepository.get_reconciled_at(db))
+            counters, symbols, lessons, stale = self._aggregate(pending, reconciled_at)
+            StatsRepository.add_counters(db, counters)
+            StatsRepository.add_symbol_stats(db, symbols)
+            StatsRepository.add_lesson_stats(db, lessons)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            with self._lock:
+                self._pending = pending + self._pending
+            self.flush_failures += 1
+            logger.error(f"Admin stats flush failed: {e}")
+            return False
+        self.flushes += 1
+        self.stale_dropped += stale
+        self.last_flush_ms = (time.perf_counter() - started) * 1000
+        return True
+    
+    def reconcile(self, db: Session, force: bool = False) -> Optional[Dict]:
+        """
+        Tính lại mọi thống kê từ bảng gốc và ghi đè, trong một transaction
+        force=False: bỏ qua nếu worker khác đã reconcile trong reconcile_seconds gần nhất
+        Returns: Báo cáo, None nếu không chạy (worker khác đang reconcile hoặc chưa đến hạn)
+        """
+        started = time.perf_counter()
+        try:
+            if not StatsRepository.try_lock_reconcile(db):
+                db.rollback()
+                return None
+            last_ms = StatsRepository.get_reconciled_at(db)
+            if not force and last_ms and (
+                self.reconcile_seconds <= 0
+                or StatsRepository.db_time_ms(db) - last_ms < Decimal(str(self.reconcile_seconds * 1000))
+            ):
+                db.rollback()
+                return None
+            
+            # Chờ các flush đang chạy commit xong, chặn flush mới đến hết transaction
+            StatsRepository.lock_aggregates(db)
+            StatsRepository.lock_aggregate_rows(db)
+            # Tính lại trên một snapshot: mọi query thấy cùng trạng thái bảng gốc, transaction gốc có
+            # committed_at >= reconciled_at chưa commit lúc chụp snapshot nên không nằm trong kết quả
+            snapshot = self.session_factory()
+            try:
+                reconciled_at = StatsRepository.begin_snapshot(snapshot)
+                counters = StatsRepository.compute_counters(snapshot, self.month_start())
+                symbols = StatsRepository.compute_symbol_stats(snapshot)
+                lessons = StatsRepository.compute_lesson_stats(snapshot)
+            finally:
+                snapshot.close()
+            StatsRepository.replace_counters(db, counters)
+            StatsRepository.replace_symbol_stats(db, symbols)
+            StatsRepository.replace_lesson_stats(db, lessons)
+            StatsRepository.set_reconciled_at(db, reconciled_at)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        self.reconciled_at = datetime.now()
+        self.last_reconcile_ms = (time.perf_counter() - started) * 1000
+        return {
+            "counters": {name: float(value) for name, value in counters.items()},
+            "symbols": len(symbols),
+            "lessons": len(lessons),
+            "duration_ms": round(self.last_reconcile_ms, 2)
+        }
+    
+    def flush_now(self) -> bool:
+        """Flush với session DB riêng (dùng cho scheduler)"""
+        db = self.session_factory()
+        try:
+            return self.flush(db)
+        finally:
+            db.close()
+    
+    def reconcile_now(self, force: bool = False) -> Optional[Dict]:
+        """Reconcile với session DB riêng (dùng cho scheduler và job)"""
+        db = self.session_factory()
+        try:
+            return self.reconcile(db, force=force)
+        finally:
+            db.close()
+    
+    # === Đọc cho admin dashboard ===
+    # Chạy blocking trên DB (route gọi qua run_in_threadpool). Flush buffer của process này trước khi đọc,
+    # trừ khi đang reconcile: không chờ, đọc luôn (SELECT không bị chặn bởi lock của reconcile)
+    
+    def overview(self, db: Session) -> Dict[str, Decimal]:
+        """Các counters"""
+        self.flush(db, wait=False)
+        return StatsRepository.get_counters(db, [
+            "total_users", "total_orders", "filled_orders", "total_trading_value",
+            "total_completions", "active_traders", self.month_key()
+        ])
+    
+    def top_symbols(self, db: Session, limit: int) -> List[Dict]:
+        self.flush(db, wait=False)
+        return [
+            {
+                "symbol": stat.symbol,
+                "total_orders": stat.filled_orders,
+                "total_volume": int(stat.total_volume or 0),
+                "buy_orders": stat.buy_orders,
+                "sell_orders": stat.sell_orders
+            }
+            for stat in StatsRepository.get_top_symbols(db, limit)
+        ]
+    
+    def lesson_stats(self, db: Session) -> List[Dict]:
+        self.flush(db, wait=False)
+        return [
+            {
+                "id": lesson_id,
+                "title": title,
+                "difficulty_level": difficulty_level,
+                "total_attempts": attempts or 0,
+                "completions": completions or 0,
+                "avg_quiz_score": round(score_sum / score_count, 2) if score_count else 0.0
+            }
+            for lesson_id, title, difficulty_level, attempts, completions, score_sum, score_count
+            in StatsRepository.get_lesson_stats(db)
+        ]
+    
+    # === Scheduler ===
+    
+    async def run(self):
+        """
+        Vòng lặp chạy nền (start trong lifespan của app)
+        Reconcile khi đến hạn (kể cả lần đầu khi bảng tổng hợp chưa có dữ liệu), chỉ một worker chạy
+        """
+        self._running = True
+        last_check: Optional[float] = None
+        try:
+            while True:
+                try:
+                    if last_check is None or time.monotonic() - last_check >= self.reconcile_check_seconds:
+                        last_check = time.monotonic()
+                        report = await asyncio.to_thread(self.reconcile_now)
+                        if report:
+                            logger.info(f"Admin stats: reconciled in {report['duration_ms']}ms")
+                    await asyncio.to_thread(self.flush_now)
+                except Exception as e:
+                    logger.error(f"Admin stats round failed: {e}")
+                await asyncio.sleep(self.flush_seconds)
+        finally:
+            self._running = False
+    
+    def stats(self) -> Dict:
+        """Trạng thái scheduler (để monitor)"""
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            "running": self._running,
+            "pending_events": pending,
+            "flushes": self.flushes,
+            "flush_failures": self.flush_failures,
+            "stale_dropped": self.stale_dropped,
+            "last_flush_ms": round(self.last_flush_ms, 2),
+            "reconciled_at": self.reconciled_at.isoformat() if self.reconciled_at else None,
+            "last_reconcile_ms": round(self.last_reconcile_ms, 2)
+        }
+
+
+# Thống kê dùng chung cho toàn process
+admin_stats = AdminStatsService(
+    flush_seconds=settings.ADMIN_STATS_FLUSH_SECONDS,
+    reconcile_seconds=settings.ADMIN_STATS_RECONCILE_SECONDS
+)
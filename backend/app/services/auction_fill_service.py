@@ -0,0 +1,175 @@
+"""
+Auction Fill Service - Fill ATO/ATC orders theo giá khớp lệnh định kỳ lấy từ stock_db.ticks
+"""
+
+import asyncio
+import logging
+import time
+from datetime import date, timedelta
+from decimal import Decimal
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy.orm import Session
+from app.config import settings
+from app.database import SessionLocal
+from app.models.portfolio import VirtualOrder
+from app.repositories.clickhouse_repository import ClickHouseRepository
+from app.repositories.portfolio_repository import VirtualOrderRepository
+from app.services.trading_hours_service import TradingHoursService
+
+logger = logging.getLogger(__name__)
+
+
+class AuctionFillService:
+    """
+    Fill ATO/ATC orders đang PENDING sau mỗi phiên khớp lệnh định kỳ
+    
+    - Order tham gia phiên ATO/ATC đầu tiên sau thời điểm đặt (execution_time cho PRACTICE, created_at
+      cho REALTIME), xem TradingHoursService.get_auction_date
+    - Giá khớp: một query cho tất cả symbols của phiên (tick cuối cùng có session ATO/ATC trong stock_db.ticks)
+    - Mỗi symbol fill tất cả orders của symbol đó trong một transaction (TradingService.fill_orders_batch)
+    - Scheduler chạy sau giờ khớp (9:15 / 14:45) settle_delay_seconds để collector kịp ghi ticks, thử lại
+      mỗi poll_seconds đến hết giờ giao dịch nếu còn symbol chưa có tick
+    - Báo cáo từng phiên: thời gian settle cả batch / từng symbol, độ trễ so với giờ khớp
+    """
+    
+    SESSIONS = ("ATO", "ATC")
+    
+    def __init__(self, settle_delay_seconds: float = 60, poll_seconds: float = 30):
+        self.settle_delay_seconds = settle_delay_seconds
+        self.poll_seconds = poll_seconds
+        
+        self._running = False
+        self._settled: set = set()  # {(ngày, session)} đã fill xong
+        self.last_reports: Dict[str, Dict] = {}  # session -> báo cáo gần nhất
+    
+    @property
+    def is_running(self) -> bool:
+        return self._running
+    
+    @staticmethod
+    def get_auction_date(order: VirtualOrder) -> date:
+        """Ngày của phiên ATO/ATC mà order tham gia"""
+        placed_at = order.execution_time or order.created_at
+        return TradingHoursService.get_auction_date(order.order_type, placed_at)
+    
+    def fill_auction(self, db: Session, ch_client, session: str, trade_date: date) -> Dict:
+        """
+        Fill tất cả orders PENDING của một phiên ATO/ATC
+        Returns: Báo cáo (số orders, symbols chưa có giá, thời gian settle)
+        """
+        # Import tại đây để tránh import vòng
+        from app.services.trading_service import TradingService
+        
+        started = time.perf_counter()
+        orders = [
+            order for order in VirtualOrderRepository.get_pending_ato_atc_orders(db)
+            if order.order_type == session and self.get_auction_date(order) == trade_date
+        ]
+        orders_by_symbol: Dict[str, List[VirtualOrder]] = {}
+        for order in orders:
+            orders_by_symbol.setdefault(order.symbol, []).append(order)
+        
+        repo = ClickHouseRepository(ch_client)
+        prices = {
+            symbol: Decimal(str(price))
+            for symbol, price in repo.get_auction_prices(list(orders_by_symbol), session, trade_date).items()
+        }
+        
+        errors: List[str] = []
+        symbol_reports = []
+        filled_count = 0
+        for symbol, symbol_orders in orders_by_symbol.items():
+            if symbol not in prices:
+                continue
+            symbol_started = time.perf_counter()
+            filled, _ = TradingService.fill_orders_batch(db, symbol_orders, prices, errors)
+            filled_count += len(filled)
+            symbol_reports.append({
+                "symbol": symbol,
+                "price": float(prices[symbol]),
+                "orders": len(symbol_orders),
+                "filled": len(filled),
+                "duration_ms": round((time.perf_counter() - symbol_started) * 1000, 2)
+            })
+        
+        settled_at = TradingHoursService.get_current_vn_time()
+        auction_time = TradingHoursService.get_auction_time(session, trade_date)
+        return {
+            "session": session,
+            "date": trade_date.isoformat(),
+            "checked": len(orders),
+            "filled": filled_count,
+            "missing_price_symbols": sorted(set(orders_by_symbol) - set(prices)),
+            "duration_seconds": round(time.perf_counter() - started, 3),
+            "settle_lag_seconds": round((settled_at - auction_time).total_seconds(), 1),
+            "settled_at": settled_at.isoformat(),
+            "symbols": symbol_reports,
+            "errors": errors
+        }
+    
+    def fill_auction_now(self, ch_client, session: str, trade_date: Optional[date] = None) -> Dict:
+        """Chạy một phiên với session DB riêng (dùng cho scheduler và job)"""
+        if trade_date is None:
+            trade_date = TradingHoursService.get_current_vn_time().date()
+        db = SessionLocal()
+        try:
+            report = self.fill_auction(db, ch_client, session, trade_date)
+        finally:
+            db.close()
+        self.last_reports[session] = report
+        return report
+    
+    def _due_sessions(self) -> List[Tuple[date, str]]:
+        """Các phiên hôm nay đã qua giờ khớp + settle_delay nhưng chưa fill xong"""
+        now = TradingHoursService.get_current_vn_time()
+        today = now.date()
+        if not TradingHoursService.is_trading_day(now):
+            return []
+        return [
+            (today, session) for session in self.SESSIONS
+            if (today, session) not in self._settled
+            and now >= TradingHoursService.get_auction_time(session, today) + timedelta(seconds=self.settle_delay_seconds)
+        ]
+    
+    def _seconds_until_next_check(self) -> float:
+        now = TradingHoursService.get_current_vn_time()
+        delays = [
+            (TradingHoursService.get_auction_time(session, now.date()) - now).total_seconds() + self.settle_delay_seconds
+            for session in self.SESSIONS
+        ]
+        upcoming = [delay for delay in delays if delay > 0]
+        return max(1.0, min(upcoming + [self.poll_seconds]))
+    
+    async def run(self, ch_client):
+        """Vòng lặp chạy nền (start trong lifespan của app)"""
+        self._running = True
+        try:
+            while True:
+                for trade_date, session in self._due_sessions():
+                    try:
+                        report = await asyncio.to_thread(self.fill_auction_now, ch_client, session, trade_date)
+                        logger.info(
+                            f"Auction fill {session} {trade_date}: filled {report['filled']}/{report['checked']} orders "
+                            f"in {report['duration_seconds']}s (lag {report['settle_lag_seconds']}s)"
+                        )
+                        # Còn symbol chưa có tick: thử lại ở vòng sau cho đến hết giờ giao dịch
+                        past_close = TradingHoursService.get_current_vn_time().time() > TradingHoursService.AFTERNOON_END
+                        if not report["missing_price_symbols"] or past_close:
+                            self._settled.add((trade_date, session))
+                    except Exception as e:
+                        logger.error(f"Auction fill {session} {trade_date} failed: {e}")
+                await asyncio.sleep(self._seconds_until_next_check())
+        finally:
+            self._running = False
+    
+    def stats(self) -> Dict:
+        """Trạng thái scheduler và báo cáo gần nhất của từng phiên"""
+        return {
+            "running": self._running,
+            "settle_delay_seconds": self.settle_delay_seconds,
+            "last_reports": self.last_reports
+        }
+
+
+# Scheduler dùng chung cho toàn process
+auction_fill_scheduler = AuctionFillService(settle_delay_seconds=settings.AUCTION_FILL_DELAY_SECONDS)
@@ -0,0 +1,150 @@
+"""
+Equity Curve Service - Ghi giá trị mark-to-market của mọi portfolio theo chu kỳ (equity curve)
+"""
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from decimal import Decimal
+from typing import Dict, List, Optional
+from sqlalchemy.orm import Session
+from app.config import settings
+from app.database import SessionLocal
+from app.repositories.equity_repository import EquitySnapshotRepository
+from app.repositories.portfolio_repository import PortfolioRepository, VirtualPositionRepository
+from app.services.price_cache_service import price_cache
+from app.services.trading_hours_service import TradingHoursService
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PortfolioValuation:
+    """Giá trị mark-to-market của một portfolio (VND)"""
+    user_id: int
+    cash_balance: Decimal
+    positions_value: Decimal
+    unrealized_pnl: Decimal
+    
+    @property
+    def total_value(self) -> Decimal:
+        return self.cash_balance + self.positions_value
+
+
+class EquityCurveService:
+    """
+    Mỗi interval_seconds trong giờ giao dịch, định giá tất cả portfolios và ghi một điểm / user vào
+    equity_snapshots (recorded_at làm tròn theo phút, nên nhiều worker cùng ghi cũng không trùng điểm)
+    
+    - Một pass = 2 query Postgres (portfolios, positions) + một lần price_cache.get_many cho mọi symbol
+      đang được nắm giữ + một câu INSERT cho tất cả users
+    - Symbol không có giá: dùng last_price hoặc avg_price (giống TradingService.update_portfolio_value)
+    """
+    
+    def __init__(self, interval_seconds: float = 60):
+        self.interval_seconds = max(1.0, interval_seconds)
+        
+        self._running = False
+        self.last_report: Optional[Dict] = None
+    
+    @property
+    def is_running(self) -> bool:
+        return self._running
+    
+    @staticmethod
+    def value_all(db: Session, ch_client) -> Dict[int, PortfolioValuation]:
+        """Định giá tất cả portfolios với một lần lấy giá cho mọi symbol"""
+        positions_by_user: Dict[int, List] = {}
+        for position in VirtualPositionRepository.get_all(db):
+            positions_by_user.setdefault(position.user_id, []).append(position)
+        symbols = sorted({position.symbol for positions in positions_by_user.values() for position in positions})
+        cached = price_cache.get_many(ch_client, symbols) if ch_client and symbols else {}
+        
+        valuations: Dict[int, PortfolioValuation] = {}
+        for portfolio in PortfolioRepository.get_all(db):
+            positions_value = Decimal("0")
+            unrealized_pnl = Decimal("0")
+            for position in positions_by_user.get(portfolio.user_id, []):
+                entry = cached.get(position.symbol)
+                price = entry.price if entry else (position.last_price or position.avg_price)
+                # Giá từ ClickHouse là nghìn VNĐ, cần nhân 1000 khi tính giá trị position
+                positions_value += price * position.quantity * Decimal("1000")
+                unrealized_pnl += (price - position.avg_price) * position.quantity * Decimal("1000")
+            valuations[portfolio.user_id] = PortfolioValuation(
+                user_id=portfolio.user_id,
+                cash_balance=portfolio.cash_balance,
+                positions_value=positions_value,
+                unrealized_pnl=unrealized_pnl
+            )
+        return valuations
+    
+    def record(self, db: Session, ch_client, recorded_at: Optional[datetime] = None) -> Dict:
+        """
+        Định giá và ghi một điểm cho mỗi user
+        Returns: Báo cáo (số users, số điểm đã ghi, thời gian)
+        """
+        started = time.perf_counter()
+        if recorded_at is None:
+            recorded_at = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+        valuations = self.value_all(db, ch_client)
+        rows = [
+            {
+                "user_id": valuation.user_id,
+                "recorded_at": recorded_at,
+                "cash_balance": valuation.cash_balance,
+                "positions_value": valuation.positions_value,
+                "unrealized_pnl": valuation.unrealized_pnl,
+                "total_value": valuation.total_value
+            }
+            for valuation in valuations.values()
+        ]
+        written = EquitySnapshotRepository.add_points(db, rows)
+        return {
+            "recorded_at": recorded_at.isoformat(),
+            "users": len(valuations),
+            "written": written,
+            "duration_seconds": round(time.perf_counter() - started, 3)
+        }
+    
+    def record_now(self, ch_client) -> Dict:
+        """Một pass với session DB riêng (dùng cho scheduler và job)"""
+        db = SessionLocal()
+        try:
+            report = self.record(db, ch_client)
+        finally:
+            db.close()
+        self.last_report = report
+        return report
+    
+    async def run(self, ch_client):
+        """Vòng lặp chạy nền (start trong lifespan của app), chỉ ghi trong giờ giao dịch"""
+        self._running = True
+        try:
+            while True:
+                if TradingHoursService.get_session(TradingHoursService.get_current_vn_time()):
+                    try:
+                        report = await asyncio.to_thread(self.record_now, ch_client)
+                        logger.info(
+                            f"Equity curve: recorded {report['written']}/{report['users']} portfolios "
+                            f"in {report['duration_seconds']}s"
+                        )
+                    except Exception as e:
+                        logger.error(f"Equity curve snapshot failed: {e}")
+                # Ngủ đến đầu chu kỳ tiếp theo (các điểm rơi đúng đầu phút)
+                await asyncio.sleep(self.interval_seconds - time.time() % self.interval_seconds)
+        finally:
+            self._running = False
+    
+    def stats(self) -> Dict:
+        """Trạng thái scheduler và báo cáo lần ghi gần nhất"""
+        return {
+            "running": self._running,
+            "interval_seconds": self.interval_seconds,
+            "last_report": self.last_report
+        }
+
+
+# Scheduler dùng chung cho toàn process
+equity_curve_recorder = EquityCurveService(interval_seconds=settings.EQUITY_SNAPSHOT_INTERVAL_SECONDS)
@@ -0,0 +1,205 @@
+"""
+Leaderboard Service - Bảng xếp hạng portfolios theo giá trị mark-to-market, định giá lại theo chu kỳ
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from bisect import bisect_left, insort
+from datetime import datetime, timezone
+from decimal import Decimal
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy.orm import Session
+from app.config import settings
+from app.database import SessionLocal
+from app.repositories.portfolio_repository import PortfolioRepository
+from app.repositories.user_repository import UserRepository
+from app.services.equity_curve_service import EquityCurveService
+
+logger = logging.getLogger(__name__)
+
+
+class LeaderboardService:
+    """
+    Xếp hạng tất cả portfolios theo total_value mark-to-market
+    
+    - Mỗi refresh_seconds: định giá lại mọi portfolio (EquityCurveService.value_all: một lần lấy giá cho mọi
+      symbol), chỉ các users có giá trị thay đổi được dời vị trí trong ranking, và total_value trong DB được
+      cập nhật cho các users này (một executemany)
+    - Ranking là list (-total_value, user_id) luôn sắp xếp: tìm vị trí / "my rank" bằng bisect (O(log n)),
+      top-N là slice; cùng giá trị thì user_id nhỏ hơn xếp trước
+    - Dời vị trí trong list tốn O(n) mỗi user, nên khi số users thay đổi vượt REBUILD_FRACTION của ranking
+      (vd giá cả thị trường biến động) thì sắp xếp lại cả list một lần bằng sorted() (O(n log n))
+    - Lợi nhuận tính so với INITIAL_BALANCE (giống admin leaderboard trước đây)
+    """
+    
+    INITIAL_BALANCE = Decimal("10000000")  # 10M VND
+    # Tỷ lệ users thay đổi trong một lần định giá mà từ đó sắp xếp lại cả ranking thay vì dời từng user
+    REBUILD_FRACTION = 0.01
+    
+    def __init__(self, refresh_seconds: float = 60):
+        self.refresh_seconds = max(1.0, refresh_seconds)
+        
+        self._ranking: List[Tuple[Decimal, int]] = []  # (-total_value, user_id), tăng dần
+        self._values: Dict[int, Decimal] = {}
+        self._usernames: Dict[int, str] = {}
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._running = False
+        
+        # Metrics
+        self.refreshed_at: Optional[datetime] = None
+        self.last_refresh_ms = 0.0
+        self.last_changed = 0
+    
+    @property
+    def is_running(self) -> bool:
+        return self._running
+    
+    @property
+    def is_loaded(self) -> bool:
+        return self.refreshed_at is not None
+    
+    def _set_value(self, user_id: int, total_value: Optional[Decimal]) -> bool:
+        """Dời user đến vị trí mới trong ranking (None: xóa khỏi ranking). Gọi khi đang giữ _lock"""
+        old = self._values.get(user_id)
+        if old == total_value:
+            return False
+        if old is not None:
+            del self._ranking[bisect_left(self._ranking, (-old, user_id))]
+            del self._values[user_id]
+        if total_value is not None:
+            insort(self._ranking, (-total_value, user_id))
+            self._values[user_id] = total_value
+        return True
+    
+    def apply_valuations(self, total_values: Dict[int, Decimal], usernames: Optional[Dict[int, str]] = None) -> List[int]:
+        """
+        Cập nhật ranking theo giá trị mới ({user_id: total_value}); users không còn trong dict bị xóa
+        Returns: Danh sách user_id có giá trị thay đổi
+        """
+        with self._lock:
+            if usernames is not None:
+                self._usernames = usernames
+            updates: Dict[int, Optional[Decimal]] = {
+                user_id: value for user_id, value in total_values.items() if self._values.get(user_id) != value
+            }
+            updates.update((user_id, None) for user_id in self._values.keys() - total_values.keys())
+            
+            if len(updates) > len(self._ranking) * self.REBUILD_FRACTION:
+                for user_id, value in updates.items():
+                    if value is None:
+                        del self._values[user_id]
+                    else:
+                        self._values[user_id] = value
+                self._ranking = sorted((-value, user_id) for user_id, value in self._values.items())
+            else:
+                for user_id, value in updates.items():
+                    self._set_value(user_id, value)
+        return [user_id for user_id, value in updates.items() if value is not None]
+    
+    def refresh(self, db: Session, ch_client) -> Dict:
+        """
+        Định giá lại tất cả portfolios và cập nhật ranking + total_value trong DB
+        Returns: Báo cáo (số users, số users thay đổi, thời gian)
+        """
+        started = time.perf_counter()
+        valuations = EquityCurveService.value_all(db, ch_client)
+        total_values = {
+            user_id: valuation.total_value.quantize(Decimal("0.01"))
+            for user_id, valuation in valuations.items()
+        }
+        changed = self.apply_valuations(total_values, UserRepository.get_usernames(db))
+        PortfolioRepository.update_total_values(db, {user_id: total_values[user_id] for user_id in changed})
+        
+        self.refreshed_at = datetime.now(timezone.utc)
+        self.last_refresh_ms = (time.perf_counter() - started) * 1000
+        self.last_changed = len(changed)
+        return {
+            "users": len(total_values),
+            "changed": len(changed),
+            "duration_ms": round(self.last_refresh_ms, 2)
+        }
+    
+    def refresh_now(self, ch_client) -> Dict:
+        """Refresh với session DB riêng (dùng cho scheduler và lần đọc đầu tiên)"""
+        db = SessionLocal()
+        try:
+            return self.refresh(db, ch_client)
+        finally:
+            db.close()
+    
+    def ensure_fresh(self, ch_client):
+        """
+        Refresh khi chưa load hoặc đã cũ hơn refresh_seconds mà scheduler không chạy ở process này
+        (LEADERBOARD_ENABLED=False); gọi trước khi đọc ranking
+        """
+        if self._running and self.is_loaded:
+            return
+        # Nhiều request cùng lúc: chỉ một request định giá lại, các request khác đợi rồi dùng kết quả
+        with self._refresh_lock:
+            age = (datetime.now(timezone.utc) - self.refreshed_at).total_seconds() if self.is_loaded else None
+            if age is None or age >= self.refresh_seconds:
+                self.refresh_now(ch_client)
+    
+    def _entry(self, rank: int, user_id: int, total_value: Decimal) -> Dict:
+        profit = total_value - self.INITIAL_BALANCE
+        return {
+            "rank": rank,
+            "user_id": user_id,
+            "username": self._usernames.get(user_id),
+            "total_value": float(total_value),
+            "profit": float(profit),
+            "profit_percent": round(float(profit / self.INITIAL_BALANCE * 100), 2)
+        }
+    
+    def top(self, limit: int = 10, offset: int = 0) -> List[Dict]:
+        """Top-N portfolios (rank bắt đầu từ 1)"""
+        with self._lock:
+            return [
+                self._entry(offset + index + 1, user_id, -negative_value)
+                for index, (negative_value, user_id) in enumerate(self._ranking[offset:offset + limit])
+            ]
+    
+    def rank_of(self, user_id: int) -> Optional[Dict]:
+        """Hạng của một user (None nếu user chưa có portfolio trong ranking)"""
+        with self._lock:
+            total_value = self._values.get(user_id)
+            if total_value is None:
+                return None
+            return self._entry(bisect_left(self._ranking, (-total_value, user_id)) + 1, user_id, total_value)
+    
+    async def run(self, ch_client):
+        """Vòng lặp chạy nền (start trong lifespan của app)"""
+        self._running = True
+        try:
+            while True:
+                try:
+                    report = await asyncio.to_thread(self.refresh_now, ch_client)
+                    logger.info(
+                        f"Leaderboard: revalued {report['users']} portfolios ({report['changed']} changed) "
+                        f"in {report['duration_ms']}ms"
+                    )
+                except Exception as e:
+                    logger.error(f"Leaderboard refresh failed: {e}")
+                await asyncio.sleep(self.refresh_seconds)
+        finally:
+            self._running = False
+    
+    def stats(self) -> Dict:
+        """Trạng thái leaderboard (để monitor)"""
+        with self._lock:
+            users = len(self._ranking)
+        return {
+            "running": self._running,
+            "users": users,
+            "refresh_seconds": self.refresh_seconds,
+            "refreshed_at": self.refreshed_at.isoformat() if self.refreshed_at else None,
+            "last_refresh_ms": round(self.last_refresh_ms, 2),
+            "last_changed": self.last_changed
+        }
+
+
+# Leaderboard dùng chung cho toàn process
+leaderboard = LeaderboardService(refresh_seconds=settings.LEADERBOARD_REFRESH_SECONDS)
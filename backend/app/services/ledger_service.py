@@ -0,0 +1,214 @@
+"""
+Ledger Service - Sổ cái append-only của portfolio, dựng trạng thái tại thời điểm bất kỳ
+"""
+
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy.orm import Session
+from app.config import settings
+from app.models.ledger import LedgerEntry, PortfolioSnapshot
+from app.models.portfolio import VirtualOrder
+from app.repositories.ledger_repository import LedgerRepository, PortfolioSnapshotRepository
+from app.repositories.portfolio_repository import PortfolioRepository, VirtualOrderRepository
+from app.repositories.user_repository import UserRepository
+
+
+@dataclass
+class LedgerState:
+    """Trạng thái portfolio dựng lại từ sổ cái"""
+    cash_balance: Decimal = Decimal("0")
+    positions: Dict[str, Tuple[int, Decimal]] = field(default_factory=dict)  # symbol -> (quantity, avg_price)
+    replayed_entries: int = 0  # Số entries đã replay sau snapshot (để monitor)
+
+
+class LedgerService:
+    """
+    Mọi thay đổi cash/position của portfolio được ghi thêm vào sổ cái (ledger_entries):
+    - FILL: order khớp, thời điểm hiệu lực là execution_time (PRACTICE) hoặc filled_at
+    - CASH: nạp tiền / reset balance
+    
+    Trạng thái tại thời điểm T = snapshot gần nhất có as_of <= T + replay các entries sau snapshot đến T.
+    Snapshot được tạo tự động mỗi LEDGER_SNAPSHOT_EVERY entries (và bằng job app.jobs.snapshot_ledgers),
+    nên số entries phải replay luôn ngắn. Entry lùi ngày (PRACTICE) xóa các snapshots từ thời điểm đó.
+    
+    User có dữ liệu từ trước khi có sổ cái được bootstrap từ các orders FILLED ở lần ghi/đọc đầu tiên.
+    Giá là nghìn VNĐ, cần nhân 1000 khi tính tiền (giống TradingService).
+    """
+    
+    PRICE_QUANT = Decimal("0.01")  # avg_price lưu Numeric(10, 2) giống VirtualPosition
+    
+    @staticmethod
+    def fill_time(order: VirtualOrder) -> datetime:
+        """Thời điểm hiệu lực của một fill"""
+        return order.execution_time or order.filled_at or datetime.utcnow()
+    
+    @staticmethod
+    def _as_utc(value: datetime) -> datetime:
+        """So sánh được datetime có/không timezone (naive coi là UTC, giống filled_at)"""
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    
+    @staticmethod
+    def _fill_entry(order: VirtualOrder) -> LedgerEntry:
+        quantity = order.filled_quantity or order.quantity
+        amount = order.filled_price * quantity * Decimal("1000")
+        return LedgerEntry(
+            user_id=order.user_id,
+            entry_type="FILL",
+            order_id=order.id,
+            symbol=order.symbol,
+            quantity=quantity if order.side == "BUY" else -quantity,
+            price=order.filled_price,
+            cash_delta=-amount if order.side == "BUY" else amount,
+            occurred_at=LedgerService.fill_time(order)
+        )
+    
+    @staticmethod
+    def bootstrap_user(db: Session, user_id: int, commit: bool = True) -> bool:
+        """
+        Tạo sổ cái cho user chưa có entry nào từ các orders FILLED
+        Cash ban đầu (entry OPENING) = cash_balance hiện tại - tổng cash của các fills,
+        nên replay toàn bộ sổ cái ra đúng cash_balance hiện tại.
+        Returns: True nếu đã bootstrap
+        """
+        if LedgerRepository.has_entries(db, user_id):
+            return False
+        portfolio = PortfolioRepository.get_by_user_id(db, user_id)
+        if not portfolio:
+            return False
+        
+        entries = [LedgerService._fill_entry(order) for order in VirtualOrderRepository.get_filled_orders(db, user_id)]
+        opening_cash = portfolio.cash_balance - sum((entry.cash_delta for entry in entries), Decimal("0"))
+        
+        opening_times = [entry.occurred_at for entry in entries]
+        user = UserRepository.get_by_id(db, user_id)
+        if user and user.created_at:
+            opening_times.append(user.created_at)
+        opening = LedgerEntry(
+            user_id=user_id,
+            entry_type="CASH",
+            cash_delta=opening_cash,
+            note="OPENING",
+            occurred_at=min(opening_times, key=LedgerService._as_utc) if opening_times else datetime.utcnow()
+        )
+        LedgerRepository.add_entries(db, [opening] + entries, commit=commit)
+        return True
+    
+    @staticmethod
+    def record_fill(db: Session, order: VirtualOrder, commit: bool = True):
+        """
+        Ghi fill của order (gọi sau khi order đã FILLED và cash/position đã cập nhật)
+        commit=False: chỉ flush, không tự snapshot (caller commit cả transaction)
+        """
+        if LedgerService.bootstrap_user(db, order.user_id, commit=commit):
+            # Bootstrap đã gồm order này
+            return
+        # Chỉ fill PRACTICE có execution_time mới có thể lùi ngày
+        LedgerService._append(
+            db, LedgerService._fill_entry(order), commit=commit, backdated=order.execution_time is not None
+        )
+    
+    @staticmethod
+    def record_cash(db: Session, user_id: int, amount: Decimal, note: str, occurred_at: Optional[datetime] = None):
+        """Ghi thay đổi cash (gọi sau khi cash_balance đã cập nhật)"""
+        if LedgerService.bootstrap_user(db, user_id):
+            # Opening cash đã gồm khoản này
+            return
+        LedgerService._append(db, LedgerEntry(
+            user_id=user_id,
+            entry_type="CASH",
+            cash_delta=amount,
+            note=note,
+            occurred_at=occurred_at or datetime.utcnow()
+        ), backdated=occurred_at is not None)
+    
+    @staticmethod
+    def _append(db: Session, entry: LedgerEntry, commit: bool = True, backdated: bool = False):
+        entry = LedgerRepository.add_entry(db, entry, commit=commit)
+        if backdated:
+            # Entry lùi ngày: các snapshots từ thời điểm này không còn đúng (thường không có dòng nào)
+            PortfolioSnapshotRepository.delete_from(db, entry.user_id, entry.occurred_at, commit=commit)
+        if not commit:
+            # Snapshot tự động để lần ghi sau hoặc job snapshot xử lý
+            return
+        
+        latest = PortfolioSnapshotRepository.get_latest_before(db, entry.user_id)
+        pending = LedgerRepository.count_entries_after(db, entry.user_id, latest.as_of if latest else None)
+        if pending >= settings.LEDGER_SNAPSHOT_EVERY:
+            LedgerService.snapshot(db, entry.user_id)
+    
+    @staticmethod
+    def apply_entry(state: LedgerState, entry: LedgerEntry):
+        """Replay một entry (cùng công thức avg_price với VirtualPositionRepository.create_or_update_position)"""
+        state.cash_balance += entry.cash_delta
+        state.replayed_entries += 1
+        if entry.entry_type != "FILL" or not entry.quantity:
+            return
+        
+        quantity, avg_price = state.positions.get(entry.symbol, (0, Decimal("0")))
+        if quantity == 0:
+            state.positions[entry.symbol] = (entry.quantity, entry.price)
+        elif quantity + entry.quantity == 0:
+            del state.positions[entry.symbol]
+        else:
+            total_cost = quantity * avg_price + entry.quantity * entry.price
+            new_quantity = quantity + entry.quantity
+            state.positions[entry.symbol] = (
+                new_quantity,
+                (total_cost / new_quantity).quantize(LedgerService.PRICE_QUANT, rounding=ROUND_HALF_UP)
+            )
+    
+    @staticmethod
+    def _state_from_snapshot(snapshot: Optional[PortfolioSnapshot]) -> LedgerState:
+        if snapshot is None:
+            return LedgerState()
+        return LedgerState(
+            cash_balance=Decimal(snapshot.cash_balance),
+            positions={
+                symbol: (int(item["quantity"]), Decimal(item["avg_price"]))
+                for symbol, item in (snapshot.positions or {}).items()
+            }
+        )
+    
+    @staticmethod
+    def state_at(db: Session, user_id: int, as_of: Optional[datetime] = None) -> LedgerState:
+        """
+        Trạng thái portfolio tại thời điểm as_of (None: hiện tại)
+        = snapshot gần nhất trước as_of + replay entries (snapshot.as_of, as_of]
+        """
+        LedgerService.bootstrap_user(db, user_id)
+        snapshot = PortfolioSnapshotRepository.get_latest_before(db, user_id, as_of)
+        state = LedgerService._state_from_snapshot(snapshot)
+        entries = LedgerRepository.get_entries_between(
+            db, user_id, snapshot.as_of if snapshot else None, as_of
+        )
+        for entry in entries:
+            LedgerService.apply_entry(state, entry)
+        return state
+    
+    @staticmethod
+    def snapshot(db: Session, user_id: int, as_of: Optional[datetime] = None) -> Optional[PortfolioSnapshot]:
+        """Tạo snapshot tại as_of (None: thời điểm của entry mới nhất)"""
+        if as_of is None:
+            as_of = LedgerRepository.get_last_entry_time(db, user_id)
+            if as_of is None:
+                return None
+        state = LedgerService.state_at(db, user_id, as_of)
+        positions = {
+            symbol: {"quantity": quantity, "avg_price": str(avg_price)}
+            for symbol, (quantity, avg_price) in state.positions.items()
+        }
+        return PortfolioSnapshotRepository.create_snapshot(db, user_id, as_of, state.cash_balance, positions)
+    
+    @staticmethod
+    def snapshot_all(db: Session) -> List[int]:
+        """
+        Snapshot mọi user có entries mới hơn snapshot mới nhất của họ
+        Returns: Danh sách user_id đã snapshot
+        """
+        latest_times = PortfolioSnapshotRepository.get_latest_times(db)
+        user_ids = LedgerRepository.get_user_ids_with_entries_after(db, latest_times)
+        for user_id in user_ids:
+            LedgerService.snapshot(db, user_id)
+        return user_ids
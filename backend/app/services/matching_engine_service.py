@@ -0,0 +1,230 @@
+"""
+Matching Engine Service - Khớp LIMIT orders của tất cả users khi giá thị trường chạm giá giới hạn
+"""
+
+import asyncio
+import heapq
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+from decimal import Decimal
+from typing import Dict, List, Tuple
+from app.config import settings
+from app.database import SessionLocal
+from app.models.portfolio import VirtualOrder
+from app.repositories.portfolio_repository import VirtualOrderRepository
+from app.services.price_cache_service import price_cache
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class BookOrder:
+    """LIMIT order đang chờ trong sổ lệnh"""
+    order_id: int
+    user_id: int
+    symbol: str
+    side: str
+    price: Decimal
+
+
+@dataclass
+class OrderBook:
+    """
+    Sổ lệnh của một symbol, sắp theo giá giới hạn
+    - bids: BUY, giá cao nhất ở đầu (khớp khi giá thị trường <= giá giới hạn)
+    - asks: SELL, giá thấp nhất ở đầu (khớp khi giá thị trường >= giá giới hạn)
+    Cùng giá thì order tạo trước (id nhỏ hơn) khớp trước.
+    Order bị hủy chỉ bị xóa khỏi index; phần tử trong heap được bỏ qua khi lên đầu (lazy delete).
+    """
+    bids: List[Tuple[Decimal, int]] = field(default_factory=list)  # (-price, order_id)
+    asks: List[Tuple[Decimal, int]] = field(default_factory=list)  # (price, order_id)
+    
+    def push(self, order: BookOrder):
+        if order.side == "BUY":
+            heapq.heappush(self.bids, (-order.price, order.order_id))
+        else:
+            heapq.heappush(self.asks, (order.price, order.order_id))
+    
+    def pop_crossing(self, market_price: Decimal, live: Dict[int, BookOrder]) -> List[BookOrder]:
+        """Lấy ra tất cả orders khớp với giá thị trường (chỉ duyệt các orders khớp)"""
+        crossing = []
+        while self.bids and (-self.bids[0][0] >= market_price or self.bids[0][1] not in live):
+            _, order_id = heapq.heappop(self.bids)
+            order = live.pop(order_id, None)
+            if order is not None:
+                crossing.append(order)
+        while self.asks and (self.asks[0][0] <= market_price or self.asks[0][1] not in live):
+            _, order_id = heapq.heappop(self.asks)
+            order = live.pop(order_id, None)
+            if order is not None:
+                crossing.append(order)
+        return crossing
+    
+    def __len__(self) -> int:
+        return len(self.bids) + len(self.asks)
+
+
+class MatchingEngineService:
+    """
+    Engine khớp lệnh chạy nền cho LIMIT orders (PENDING/QUEUED) của tất cả users
+    
+    - Orders được load vào sổ lệnh theo symbol (heap theo giá giới hạn), order mới được thêm qua add_order()
+      ngay khi tạo, order hủy được xóa qua remove_order(); sổ lệnh được load lại từ DB mỗi resync_seconds
+      để đồng bộ với thay đổi từ process khác
+    - Mỗi vòng: lấy giá mới nhất của các symbols có order trong một lần gọi price_cache, với mỗi symbol
+      chỉ pop các orders khớp, rồi fill bằng TradingService.fill_order (giá khớp = giá giới hạn)
+    - Orders PRACTICE có execution_time (giá lịch sử) không vào engine, vẫn được khớp bằng
+      TradingService.check_and_fill_limit_orders
+    
+    Chỉ nên chạy engine ở một process (MATCHING_ENGINE_ENABLED=false ở các worker còn lại).
+    """
+    
+    def __init__(self, interval_seconds: float = 1, resync_seconds: float = 30):
+        self.interval_seconds = interval_seconds
+        self.resync_seconds = resync_seconds
+        
+        self._books: Dict[str, OrderBook] = {}
+        self._live: Dict[int, BookOrder] = {}
+        self._lock = threading.Lock()
+        self._last_resync = 0.0
+        self._running = False
+        
+        # Metrics
+        self.rounds = 0
+        self.filled = 0
+        self.failed = 0
+        self.last_round_ms = 0.0
+    
+    @property
+    def is_running(self) -> bool:
+        return self._running
+    
+    @staticmethod
+    def accepts(order: VirtualOrder) -> bool:
+        """Order có do engine khớp không"""
+        return (
+            order.order_type == "LIMIT"
+            and order.status in ("PENDING", "QUEUED")
+            and order.price is not None
+            and order.execution_time is None
+        )
+    
+    def add_order(self, order: VirtualOrder):
+        """Thêm order vào sổ lệnh (gọi sau khi tạo order)"""
+        if not self.accepts(order):
+            return
+        book_order = BookOrder(order.id, order.user_id, order.symbol, order.side, Decimal(order.price))
+        with self._lock:
+            self._live[order.id] = book_order
+            self._books.setdefault(order.symbol, OrderBook()).push(book_order)
+    
+    def remove_order(self, order_id: int):
+        """Xóa order khỏi sổ lệnh (gọi khi order bị hủy / khớp ở nơi khác)"""
+        with self._lock:
+            self._live.pop(order_id, None)
+    
+    def load(self, db):
+        """Load lại toàn bộ sổ lệnh từ DB"""
+        books: Dict[str, OrderBook] = {}
+        live: Dict[int, BookOrder] = {}
+        for order in VirtualOrderRepository.get_pending_limit_orders(db):
+            if not self.accepts(order):
+                continue
+            book_order = BookOrder(order.id, order.user_id, order.symbol, order.side, Decimal(order.price))
+            live[order.id] = book_order
+            books.setdefault(order.symbol, OrderBook()).push(book_order)
+        with self._lock:
+            self._books, self._live = books, live
+        self._last_resync = time.monotonic()
+    
+    def _pop_crossing(self, prices: Dict[str, Decimal]) -> List[BookOrder]:
+        crossing = []
+        with self._lock:
+            for symbol, price in prices.items():
+                book = self._books.get(symbol)
+                if book is None:
+                    continue
+                crossing.extend(book.pop_crossing(price, self._live))
+                if not book:
+                    del self._books[symbol]
+        return crossing
+    
+    def match_once(self, ch_client) -> int:
+        """
+        Một vòng khớp lệnh cho tất cả symbols
+        Returns: Số orders đã fill
+        """
+        # Import tại đây để tránh import vòng (TradingService gọi add_order/remove_order)
+        from app.services.trading_service import TradingService
+        
+        started = time.perf_counter()
+        db = SessionLocal()
+        try:
+            if time.monotonic() - self._last_resync >= self.resync_seconds:
+                self.load(db)
+            with self._lock:
+                symbols = [symbol for symbol, book in self._books.items() if book]
+            if not symbols:
+                return 0
+            
+            cached = price_cache.get_many(ch_client, symbols)
+            crossing = self._pop_crossing({symbol: entry.price for symbol, entry in cached.items()})
+            
+            filled = 0
+            for order in crossing:
+                try:
+                    _, error = TradingService.fill_order(db, order.order_id, order.price, ch_client)
+                except Exception as e:
+                    db.rollback()
+                    error = str(e)
+                if error:
+                    # Không đưa lại vào sổ lệnh: lần resync sau sẽ load lại nếu order vẫn chờ
+                    self.failed += 1
+                    logger.warning(f"Matching engine: could not fill order {order.order_id}: {error}")
+                else:
+                    filled += 1
+                    logger.info(
+                        f"Matching engine: filled order {order.order_id} {order.side} {order.symbol} @ {order.price}"
+                    )
+            self.filled += filled
+            return filled
+        finally:
+            db.close()
+            self.rounds += 1
+            self.last_round_ms = (time.perf_counter() - started) * 1000
+    
+    async def run(self, ch_client):
+        """Vòng lặp chạy nền (start trong lifespan của app)"""
+        self._running = True
+        self._last_resync = 0.0
+        try:
+            while True:
+                try:
+                    await asyncio.to_thread(self.match_once, ch_client)
+                except Exception as e:
+                    logger.error(f"Matching engine round failed: {e}")
+                await asyncio.sleep(self.interval_seconds)
+        finally:
+            self._running = False
+    
+    def stats(self) -> Dict:
+        """Thống kê engine (để monitor)"""
+        with self._lock:
+            return {
+                "running": self._running,
+                "symbols": len(self._books),
+                "orders": len(self._live),
+                "rounds": self.rounds,
+                "filled": self.filled,
+                "failed": self.failed,
+                "last_round_ms": round(self.last_round_ms, 2)
+            }
+
+
+# Engine dùng chung cho toàn process
+matching_engine = MatchingEngineService(
+    interval_seconds=settings.MATCHING_ENGINE_INTERVAL_SECONDS,
+    resync_seconds=settings.MATCHING_ENGINE_RESYNC_SECONDS
+)
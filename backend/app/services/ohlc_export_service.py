@@ -0,0 +1,113 @@
+"""
+OHLC Export Service - Stream nến OHLC của khoảng thời gian dài (NDJSON / Arrow IPC)
+"""
+
+import io
+import json
+from datetime import datetime
+from typing import Dict, Iterator, Optional
+from app.repositories.clickhouse_repository import ClickHouseRepository
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+
+class OhlcExportService:
+    """
+    Export nến OHLC theo từng page keyset của ClickHouseRepository.iter_ohlc_pages
+    
+    Mỗi page được encode và gửi đi ngay nên bộ nhớ chỉ giữ một page dù khoảng thời gian dài bao nhiêu.
+    time trong dữ liệu export là unix timestamp (giây); time của dòng cuối cùng dùng làm cursor
+    (tham số after) để tiếp tục nếu kết nối bị ngắt giữa chừng.
+    
+    Quy ước thời gian: time là giờ Việt Nam (wall clock UTC+7) như collector lưu trong ClickHouse, không phải UTC.
+    NDJSON là epoch giây của giờ đó (đọc như UTC sẽ ra đúng giờ Việt Nam), Arrow là timestamp("s")
+    không timezone cùng giá trị; muốn ra thời điểm UTC thật thì trừ 7 giờ.
+    """
+    
+    @staticmethod
+    def _iter_pages(
+        ch_client,
+        symbol: str,
+        start_time: datetime,
+        end_time: datetime,
+        interval: str,
+        page_size: int,
+        after: Optional[int]
+    ) -> Iterator[Dict[str, list]]:
+        repo = ClickHouseRepository(ch_client)
+        return repo.iter_ohlc_pages(
+            symbol=symbol,
+            start_time=start_time,
+            end_time=end_time,
+            interval=interval,
+            page_size=page_size,
+            after=after
+        )
+    
+    @staticmethod
+    def stream_ndjson(
+        ch_client,
+        symbol: str,
+        start_time: datetime,
+        end_time: datetime,
+        interval: str = "1m",
+        page_size: int = 5000,
+        after: Optional[int] = None
+    ) -> Iterator[bytes]:
+        """Mỗi nến một dòng JSON: {"time": epoch, "open": ..., ..., "vwap": ...}"""
+        fields = ClickHouseRepository.COLUMNAR_FIELDS
+        for page in OhlcExportService._iter_pages(
+            ch_client, symbol, start_time, end_time, interval, page_size, after
+        ):
+            lines = [
+                json.dumps(dict(zip(fields, row)), separators=(",", ":"))
+                for row in zip(*(page[name] for name in fields))
+            ]
+            yield ("\n".join(lines) + "\n").encode("utf-8")
+    
+    @staticmethod
+    def arrow_schema(symbol: str, interval: str):
+        """Schema Arrow của file export (time là timestamp giây giờ Việt Nam không timezone, các cột còn lại float64)"""
+        fields = [pa.field("time", pa.timestamp("s"))]
+        fields += [pa.field(name, pa.float64()) for name in ClickHouseRepository.COLUMNAR_FIELDS[1:]]
+        return pa.schema(fields, metadata={"symbol": symbol, "interval": interval})
+    
+    @staticmethod
+    def stream_arrow(
+        ch_client,
+        symbol: str,
+        start_time: datetime,
+        end_time: datetime,
+        interval: str = "1m",
+        page_size: int = 5000,
+        after: Optional[int] = None
+    ) -> Iterator[bytes]:
+        """Arrow IPC stream: schema trước, sau đó mỗi page một record batch"""
+        schema = OhlcExportService.arrow_schema(symbol, interval)
+        sink = io.BytesIO()
+        
+        def drain() -> bytes:
+            chunk = sink.getvalue()
+            sink.seek(0)
+            sink.truncate()
+            return chunk
+        
+        writer = pa.ipc.new_stream(sink, schema)
+        try:
+            yield drain()
+            for page in OhlcExportService._iter_pages(
+                ch_client, symbol, start_time, end_time, interval, page_size, after
+            ):
+                arrays = [pa.array(page["time"], type=pa.int64()).cast(schema.field("time").type)]
+                arrays += [
+                    pa.array(page[name], type=pa.float64())
+                    for name in ClickHouseRepository.COLUMNAR_FIELDS[1:]
+                ]
+                writer.write_batch(pa.record_batch(arrays, schema=schema))
+                yield drain()
+        finally:
+            # Ghi end-of-stream marker
+            writer.close()
+        yield drain()
@@ -0,0 +1,216 @@
+"""
+OHLC Rollup Service - Tổng hợp sẵn nến 5m / 1h / 1d từ nến 1m
+"""
+
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+from app.repositories.clickhouse_repository import ClickHouseRepository
+
+
+class OhlcRollupService:
+    """
+    Quản lý bảng stock_db.ohlc_rollup và các materialized view cập nhật nó
+    
+    - Bảng rollup có cùng cấu trúc với stock_db.ohlc (các cột AggregateFunction),
+      partition theo (interval, tháng) để backfill có thể thay từng partition
+    - Mỗi interval có một materialized view đọc các block nến 1m vừa insert vào ohlc
+      và ghi state đã gộp theo bucket vào bảng rollup; AggregatingMergeTree tự merge
+      các state của cùng (symbol, interval, time) sau đó
+    - Dữ liệu có trước khi tạo view được nạp bằng backfill()
+    - Bảng ohlc_rollup_coverage lưu thời điểm từ đó rollup có đủ nến của từng interval: đầu bucket sau lúc
+      tạo view, lùi về đầu khoảng đã backfill khi backfill nối liền tới thời điểm đó. Query có start_time
+      sớm hơn được resample từ nến 1m (ClickHouseRepository._execute_ohlc_query)
+    """
+    
+    @staticmethod
+    def _view_name(interval: str) -> str:
+        return f"stock_db.ohlc_rollup_{interval}_mv"
+    
+    @staticmethod
+    def _get_ohlc_columns(ch_client) -> List[Tuple[str, str]]:
+        """Lấy danh sách (tên cột, kiểu) của bảng ohlc theo đúng thứ tự"""
+        result = ch_client.execute(
+            """
+            SELECT name, type
+            FROM system.columns
+            WHERE database = 'stock_db' AND table = 'ohlc'
+            ORDER BY position
+            """
+        )
+        if not result:
+            raise RuntimeError("Cannot find table stock_db.ohlc")
+        return [(row[0], row[1]) for row in result]
+    
+    @staticmethod
+    def _merge_expression(name: str, column_type: str) -> str:
+        """
+        Biểu thức gộp một cột value của ohlc sang bucket lớn hơn
+        - AggregateFunction(argMin, ...) -> argMinMergeState(col): gộp state, vẫn giữ state
+        - SimpleAggregateFunction(sum, ...) -> sum(col)
+        - Cột thường -> any(col)
+        """
+        if column_type.startswith("AggregateFunction("):
+            function_name = column_type[len("AggregateFunction("):].split(",")[0].split(")")[0].strip()
+            return f"{function_name}MergeState({name}) AS {name}"
+        if column_type.startswith("SimpleAggregateFunction("):
+            function_name = column_type[len("SimpleAggregateFunction("):].split(",")[0].strip()
+            return f"{function_name}({name}) AS {name}"
+        return f"any({name}) AS {name}"
+    
+    @staticmethod
+    def build_rollup_select(ch_client, interval: str, where: Optional[str] = None) -> str:
+        """
+        Tạo câu SELECT gộp nến 1m của bảng ohlc thành nến của interval
+        (dùng chung cho materialized view và backfill để hai đường ghi giống hệt nhau)
+        """
+        bucket_function = ClickHouseRepository.ROLLUP_INTERVALS[interval]
+        columns = OhlcRollupService._get_ohlc_columns(ch_client)
+        
+        select_parts = []
+        for name, column_type in columns:
+            if name == "symbol":
+                select_parts.append("symbol")
+            elif name == "time":
+                select_parts.append(f"{bucket_function}(source_time) AS time")
+            elif name == "interval":
+                select_parts.append(f"'{interval}' AS interval")
+            else:
+                select_parts.append(OhlcRollupService._merge_expression(name, column_type))
+        
+        conditions = ["interval = '1m'"]
+        if where:
+            conditions.append(where)
+        
+        # Lọc trong subquery: alias time/interval ở SELECT ngoài trùng tên cột gốc,
+        # nếu đặt WHERE cùng cấp thì ClickHouse sẽ thay cột bằng alias
+        return (
+            "SELECT " + ", ".join(select_parts)
+            + f" FROM (SELECT *, time AS source_time FROM {ClickHouseRepository.OHLC_TABLE}"
+            + " WHERE " + " AND ".join(conditions) + ")"
+            + " GROUP BY symbol, time, interval"
+        )
+    
+    @staticmethod
+    def _next_bucket_start(interval: str, now: datetime) -> datetime:
+        """Đầu bucket kế tiếp sau now (bucket đang chạy có thể thiếu nến 1m insert trước khi có view)"""
+        amount, unit = ClickHouseRepository.parse_interval(interval)
+        step = amount * {"m": 60, "h": 3600, "d": 86400}[unit]
+        midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        elapsed = int((now - midnight).total_seconds())
+        return midnight + timedelta(seconds=(elapsed // step + 1) * step)
+    
+    @staticmethod
+    def ensure_schema(ch_client) -> List[str]:
+        """
+        Tạo bảng rollup và materialized view cho từng interval (nếu chưa có)
+        Returns: Danh sách intervals đã có view
+        """
+        ch_client.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {ClickHouseRepository.ROLLUP_TABLE}
+            AS {ClickHouseRepository.OHLC_TABLE}
+            ENGINE = AggregatingMergeTree()
+            PARTITION BY (interval, toYYYYMM(time))
+            ORDER BY (symbol, interval, time)
+            """
+        )
+        
+        ch_client.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {ClickHouseRepository.ROLLUP_COVERAGE_TABLE} (
+                interval String,
+                covered_from DateTime,
+                updated_at DateTime64(3)
+            )
+            ENGINE = ReplacingMergeTree(updated_at)
+            ORDER BY interval
+            """
+        )
+        
+        repo = ClickHouseRepository(ch_client)
+        coverage = repo.get_rollup_coverage(refresh=True)
+        for interval in ClickHouseRepository.ROLLUP_INTERVALS:
+            select_query = OhlcRollupService.build_rollup_select(ch_client, interval)
+            ch_client.execute(
+                f"CREATE MATERIALIZED VIEW IF NOT EXISTS {OhlcRollupService._view_name(interval)} "
+                f"TO {ClickHouseRepository.ROLLUP_TABLE} AS {select_query}"
+            )
+            if interval not in coverage:
+                # Không biết view có từ khi nào (view mới, hoặc tạo trước khi có bảng coverage):
+                # chỉ tin rollup từ bucket kế tiếp, phần trước resample cho đến khi backfill
+                repo.set_rollup_coverage(interval, OhlcRollupService._next_bucket_start(interval, datetime.now()))
+        
+        return list(ClickHouseRepository.ROLLUP_INTERVALS.keys())
+    
+    @staticmethod
+    def _iter_months(start_date: date, end_date: date):
+        """Duyệt các tháng (năm, tháng) từ start_date đến end_date"""
+        year, month = start_date.year, start_date.month
+        while (year, month) <= (end_date.year, end_date.month):
+            yield year, month
+            month += 1
+            if month > 12:
+                year, month = year + 1, 1
+    
+    @staticmethod
+    def backfill(
+        ch_client,
+        start_date: date,
+        end_date: date,
+        intervals: Optional[List[str]] = None
+    ) -> Dict[str, int]:
+        """
+        Nạp lại rollup từ nến 1m đã có, theo từng partition (interval, tháng)
+        
+        Mỗi partition được DROP rồi INSERT ... SELECT lại toàn bộ tháng đó, nên chạy nhiều
+        lần vẫn không bị cộng trùng volume. Nến 1m được insert vào đúng tháng đang backfill
+        trong lúc chạy có thể bị mất khỏi rollup, vì vậy nên chạy ngoài giờ giao dịch.
+        
+        Khoảng đã backfill nối liền tới covered_from hiện tại thì covered_from lùi về đầu tháng start_date
+        (query từ đó đọc rollup thay vì resample); còn khoảng trống thì giữ nguyên.
+        
+        Returns: Dict {interval: số partition đã nạp}
+        """
+        intervals = intervals or list(ClickHouseRepository.ROLLUP_INTERVALS.keys())
+        processed = {interval: 0 for interval in intervals}
+        repo = ClickHouseRepository(ch_client)
+        backfilled_from = datetime(start_date.year, start_date.month, 1)
+        
+        for interval in intervals:
+            if interval not in ClickHouseRepository.ROLLUP_INTERVALS:
+                raise ValueError(f"Unsupported rollup interval: {interval}")
+            
+            for year, month in OhlcRollupService._iter_months(start_date, end_date):
+                month_start = datetime(year, month, 1)
+                month_end = datetime(year + 1, 1, 1) if month == 12 else datetime(year, month + 1, 1)
+                partition_id = year * 100 + month
+                
+                ch_client.execute(
+                    f"ALTER TABLE {ClickHouseRepository.ROLLUP_TABLE} "
+                    f"DROP PARTITION ('{interval}', {partition_id})"
+                )
+                select_query = OhlcRollupService.build_rollup_select(
+                    ch_client,
+                    interval,
+                    where=(
+                        f"time >= '{month_start.strftime('%Y-%m-%d %H:%M:%S')}' "
+                        f"AND time < '{month_end.strftime('%Y-%m-%d %H:%M:%S')}'"
+                    )
+                )
+                ch_client.execute(f"INSERT INTO {ClickHouseRepository.ROLLUP_TABLE} {select_query}")
+                processed[interval] += 1
+                print(f"✅ Backfilled {interval} rollup for {year}-{month:02d}")
+            
+            if not processed[interval]:
+                continue
+            covered_from = repo.get_rollup_coverage(refresh=True).get(interval)
+            if covered_from is not None and month_end >= covered_from:
+                if backfilled_from < covered_from:
+                    repo.set_rollup_coverage(interval, backfilled_from)
+            else:
+                print(
+                    f"⚠️  {interval} rollup has a gap between {month_end:%Y-%m-%d} and {covered_from}, "
+                    f"queries before {covered_from} are still resampled from 1m"
+                )
+        
+        return processed
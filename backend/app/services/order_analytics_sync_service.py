@@ -0,0 +1,215 @@
+"""
+Order Analytics Sync Service - Sync virtual_orders từ Postgres sang ClickHouse theo watermark cho analytics
+"""
+
+import asyncio
+import logging
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy.orm import Session
+from app.config import settings
+from app.database import SessionLocal
+from app.repositories.clickhouse_repository import ClickHouseRepository
+from app.repositories.portfolio_repository import VirtualOrderRepository
+
+logger = logging.getLogger(__name__)
+
+
+class OrderAnalyticsSyncService:
+    """
+    Copy các orders mới / thay đổi của virtual_orders sang stock_db.virtual_orders (ClickHouse)
+    
+    - Watermark (updated_at, id): orders được đọc theo thứ tự này, mỗi batch batch_size dòng, chỉ các cột cần,
+      ghi sang ClickHouse bằng một INSERT columnar (một block); watermark chỉ tiến sau khi INSERT thành công
+    - Watermark lấy từ chính bảng đích khi khởi động (dòng lớn nhất đã sync), không có bookkeeping riêng
+      có thể lệch với dữ liệu đã ghi
+    - Exactly-once: bảng đích là ReplacingMergeTree(updated_at) theo id, query đọc với FINAL nên một order
+      được sync lại (retry, resync toàn bộ) chỉ còn phiên bản mới nhất; mỗi batch có insert_deduplication_token
+      nên retry cùng batch không ghi thêm block
+    - Thay đổi trong settle_seconds gần nhất chờ vòng sau (transaction commit muộn hơn updated_at của nó)
+    
+    Orders bị xóa ở Postgres (xóa user) không được xóa ở ClickHouse.
+    """
+    
+    # (cột, kiểu ClickHouse) theo thứ tự INSERT
+    COLUMNS: List[Tuple[str, str]] = [
+        ("id", "UInt64"),
+        ("user_id", "UInt64"),
+        ("symbol", "LowCardinality(String)"),
+        ("side", "LowCardinality(String)"),
+        ("order_type", "LowCardinality(String)"),
+        ("quantity", "Int64"),
+        ("price", "Nullable(Decimal(10, 2))"),
+        ("status", "LowCardinality(String)"),
+        ("trading_mode", "LowCardinality(String)"),
+        ("execution_time", "Nullable(DateTime64(6, 'UTC'))"),
+        ("filled_quantity", "Int64"),
+        ("filled_price", "Nullable(Decimal(10, 2))"),
+        ("created_at", "DateTime64(6, 'UTC')"),
+        ("filled_at", "Nullable(DateTime64(6, 'UTC'))"),
+        ("cancelled_at", "Nullable(DateTime64(6, 'UTC'))"),
+        ("updated_at", "DateTime64(6, 'UTC')"),
+    ]
+    
+    def __init__(self, interval_seconds: float = 10, batch_size: int = 5000, settle_seconds: float = 30):
+        self.interval_seconds = max(1.0, interval_seconds)
+        self.batch_size = max(1, batch_size)
+        self.settle_seconds = settle_seconds
+        
+        self._watermark: Optional[Tuple[datetime, int]] = None
+        self._watermark_loaded = False
+        self._running = False
+        
+        # Metrics
+        self.total_synced = 0
+        self.failures = 0
+        self.last_synced = 0
+        self.last_sync_ms = 0.0
+        self.last_synced_at: Optional[datetime] = None
+    
+    @property
+    def is_running(self) -> bool:
+        return self._running
+    
+    @staticmethod
+    def ensure_schema(ch_client):
+        """Tạo bảng stock_db.virtual_orders (nếu chưa có)"""
+        columns = ",\n                ".join(f"{name} {column_type}" for name, column_type in OrderAnalyticsSyncService.COLUMNS)
+        # Partition theo created_at (không đổi) để mọi phiên bản của một order nằm cùng partition khi replace
+        ch_client.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {ClickHouseRepository.ORDERS_TABLE} (
+                {columns}
+            )
+            ENGINE = ReplacingMergeTree(updated_at)
+            PARTITION BY toYYYYMM(created_at)
+            ORDER BY id
+            SETTINGS non_replicated_deduplication_window = 1000
+            """
+        )
+    
+    @staticmethod
+    def _as_utc(value: datetime) -> datetime:
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    
+    @staticmethod
+    def _to_columns(rows: List[tuple]) -> List[list]:
+        """Chuyển các dòng sang dạng columnar theo thứ tự COLUMNS"""
+        data = [list(column) for column in zip(*rows)]
+        names = [name for name, _ in OrderAnalyticsSyncService.COLUMNS]
+        created_at, updated_at = data[names.index("created_at")], data[names.index("updated_at")]
+        for i, value in enumerate(created_at):
+            if value is None:
+                created_at[i] = updated_at[i]
+        return data
+    
+    def reset(self):
+        """Sync lại từ đầu ở vòng sau (các dòng đã có được ReplacingMergeTree thay thế)"""
+        self._watermark = None
+        self._watermark_loaded = True
+    
+    def sync_once(self, db: Session, ch_client) -> Dict:
+        """
+        Sync mọi thay đổi sau watermark
+        Returns: Báo cáo (số dòng, số batch, watermark mới)
+        """
+        started = time.perf_counter()
+        repo = ClickHouseRepository(ch_client)
+        if not self._watermark_loaded:
+            watermark = repo.get_orders_watermark()
+            self._watermark = (self._as_utc(watermark[0]), watermark[1]) if watermark else None
+            self._watermark_loaded = True
+        
+        names = [name for name, _ in self.COLUMNS]
+        id_index, updated_index = names.index("id"), names.index("updated_at")
+        synced = 0
+        batches = 0
+        try:
+            while True:
+                rows = VirtualOrderRepository.get_changed_since(
+                    db, names, self._watermark, self.settle_seconds, self.batch_size
+                )
+                if not rows:
+                    break
+                first, last = rows[0], rows[-1]
+                token = (
+                    f"virtual_orders:{first[updated_index].isoformat()}:{first[id_index]}:"
+                    f"{last[updated_index].isoformat()}:{last[id_index]}:{len(rows)}"
+                )
+                repo.insert_orders(names, self._to_columns(rows), dedup_token=token)
+                self._watermark = (last[updated_index], last[id_index])
+                synced += len(rows)
+                batches += 1
+                if len(rows) < self.batch_size:
+                    break
+        finally:
+            # Kết thúc transaction đọc (không giữ snapshot giữa các vòng)
+            db.rollback()
+            self.total_synced += synced
+        
+        self.last_synced = synced
+        self.last_sync_ms = (time.perf_counter() - started) * 1000
+        self.last_synced_at = datetime.now(timezone.utc)
+        return {
+            "synced": synced,
+            "batches": batches,
+            "watermark": self._watermark_str(),
+            "duration_ms": round(self.last_sync_ms, 2)
+        }
+    
+    def sync_now(self, ch_client) -> Dict:
+        """Sync với session DB riêng (dùng cho scheduler và job)"""
+        db = SessionLocal()
+        try:
+            return self.sync_once(db, ch_client)
+        finally:
+            db.close()
+    
+    def _watermark_str(self) -> Optional[str]:
+        if self._watermark is None:
+            return None
+        return f"{self._watermark[0].isoformat()}#{self._watermark[1]}"
+    
+    async def run(self, ch_client):
+        """Vòng lặp chạy nền (start trong lifespan của app)"""
+        self._running = True
+        try:
+            while True:
+                try:
+                    report = await asyncio.to_thread(self.sync_now, ch_client)
+                    if report["synced"]:
+                        logger.info(
+                            f"Order analytics sync: {report['synced']} orders in {report['batches']} batches "
+                            f"({report['duration_ms']}ms), watermark {report['watermark']}"
+                        )
+                except Exception as e:
+                    self.failures += 1
+                    logger.error(f"Order analytics sync failed: {e}")
+                await asyncio.sleep(self.interval_seconds)
+        finally:
+            self._running = False
+    
+    def stats(self) -> Dict:
+        """Trạng thái sync (để monitor): watermark và thời gian từ thay đổi cuối cùng đã sync đến hiện tại"""
+        age = None
+        if self._watermark is not None:
+            age = round((datetime.now(timezone.utc) - self._as_utc(self._watermark[0])).total_seconds(), 1)
+        return {
+            "running": self._running,
+            "watermark": self._watermark_str(),
+            "watermark_age_seconds": age,
+            "total_synced": self.total_synced,
+            "last_synced": self.last_synced,
+            "last_sync_ms": round(self.last_sync_ms, 2),
+            "last_synced_at": self.last_synced_at.isoformat() if self.last_synced_at else None,
+            "failures": self.failures
+        }
+
+
+# Sync dùng chung cho toàn process
+order_analytics_sync = OrderAnalyticsSyncService(
+    interval_seconds=settings.ORDER_ANALYTICS_SYNC_INTERVAL_SECONDS,
+    batch_size=settings.ORDER_ANALYTICS_SYNC_BATCH_SIZE,
+    settle_seconds=settings.ORDER_ANALYTICS_SYNC_SETTLE_SECONDS
+)
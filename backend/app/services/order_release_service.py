@@ -0,0 +1,151 @@
+"""
+Order Release Service - Fill hàng loạt QUEUED MARKET orders lúc mở phiên giao dịch
+"""
+
+import asyncio
+import logging
+import time
+from decimal import Decimal
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy.orm import Session
+from app.config import settings
+from app.database import SessionLocal
+from app.repositories.portfolio_repository import VirtualOrderRepository
+from app.services.trading_hours_service import TradingHoursService
+
+logger = logging.getLogger(__name__)
+
+
+class OrderReleaseService:
+    """
+    Scheduler fill mọi QUEUED REALTIME MARKET orders (đặt ngoài giờ) khi phiên sáng/chiều mở
+    
+    - Chạy một lần cho mỗi phiên, thời điểm lấy từ TradingHoursService (kể cả khi app start giữa phiên)
+    - Còn order fill lỗi (thiếu giá khi ClickHouse lỗi, exception) thì chạy lại ở lần poll sau với các orders
+      còn QUEUED, tối đa max_attempts lần mỗi phiên
+    - Giá: một lần lấy cho tất cả symbols khác nhau của các orders
+    - Ghi theo chunk: mỗi chunk chunk_size orders là một transaction (fill, unblock tiền, cash, position,
+      sổ cái, total_value) qua TradingService.fill_orders_batch
+    - Báo cáo throughput (orders/giây) của lần chạy gần nhất qua stats()
+    
+    Khi scheduler chạy, các request không còn tự fill QUEUED orders của user nữa.
+    """
+    
+    def __init__(self, chunk_size: int = 500, poll_seconds: float = 30, max_attempts: int = 10):
+        self.chunk_size = max(1, chunk_size)
+        self.poll_seconds = poll_seconds
+        self.max_attempts = max(1, max_attempts)
+        
+        self._running = False
+        self._released_session: Optional[Tuple] = None  # (ngày, "MORNING"/"AFTERNOON") đã fill
+        self._attempted_session: Optional[Tuple] = None
+        self.attempts = 0  # Số lần đã chạy cho _attempted_session
+        self.last_report: Optional[Dict] = None
+    
+    @property
+    def is_running(self) -> bool:
+        return self._running
+    
+    def release_queued_market_orders(self, db: Session, ch_client) -> Dict:
+        """
+        Fill tất cả QUEUED REALTIME MARKET orders với giá hiện tại
+        Returns: Báo cáo (số orders, thời gian, orders/giây, tiền đã unblock, lỗi)
+        """
+        # Import tại đây để tránh import vòng (TradingService dùng scheduler)
+        from app.services.trading_service import TradingService
+        
+        started = time.perf_counter()
+        orders = VirtualOrderRepository.get_queued_market_orders(db)
+        symbols = sorted({order.symbol for order in orders})
+        prices = TradingService.get_current_prices(ch_client, symbols)
+        
+        errors: List[str] = []
+        filled_count = 0
+        unblocked_cash = Decimal("0")
+        chunks = 0
+        for start in range(0, len(orders), self.chunk_size):
+            filled, unblocked = TradingService.fill_orders_batch(db, orders[start:start + self.chunk_size], prices, errors)
+            chunks += 1
+            filled_count += len(filled)
+            unblocked_cash += unblocked
+        
+        duration = time.perf_counter() - started
+        return {
+            "checked": len(orders),
+            "filled": filled_count,
+            "failed": len(orders) - filled_count,
+            "symbols": len(symbols),
+            "chunks": chunks,
+            "unblocked_cash": float(unblocked_cash),
+            "duration_seconds": round(duration, 3),
+            "orders_per_second": round(filled_count / duration, 1) if duration > 0 else None,
+            "errors": errors
+        }
+    
+    def release_now(self, ch_client) -> Dict:
+        """Chạy một lần với session riêng (dùng cho scheduler và job)"""
+        db = SessionLocal()
+        try:
+            report = self.release_queued_market_orders(db, ch_client)
+        finally:
+            db.close()
+        report["released_at"] = TradingHoursService.get_current_vn_time().isoformat()
+        self.last_report = report
+        return report
+    
+    def _seconds_until_next_check(self) -> float:
+        next_session = TradingHoursService.get_next_trading_session()
+        if next_session is None:
+            return self.poll_seconds
+        delay = (next_session - TradingHoursService.get_current_vn_time()).total_seconds()
+        return max(1.0, min(delay, self.poll_seconds))
+    
+    async def run(self, ch_client):
+        """Vòng lặp chạy nền (start trong lifespan của app)"""
+        self._running = True
+        try:
+            while True:
+                now = TradingHoursService.get_current_vn_time()
+                session = TradingHoursService.get_session(now)
+                key = (now.date(), session)
+                if session and self._released_session != key:
+                    if self._attempted_session != key:
+                        self._attempted_session, self.attempts = key, 0
+                    self.attempts += 1
+                    try:
+                        report = await asyncio.to_thread(self.release_now, ch_client)
+                        logger.info(
+                            f"Order release ({session}, attempt {self.attempts}): filled {report['filled']}/{report['checked']} "
+                            f"QUEUED orders in {report['duration_seconds']}s ({report['orders_per_second']} orders/s)"
+                        )
+                        # Chỉ đánh dấu đã fill khi không còn order lỗi, nếu không thì thử lại ở lần poll sau
+                        if report["failed"] == 0:
+                            self._released_session = key
+                    except Exception as e:
+                        logger.error(f"Order release failed: {e}")
+                    if self._released_session != key and self.attempts >= self.max_attempts:
+                        logger.warning(
+                            f"Order release ({session}): giving up after {self.attempts} attempts, "
+                            f"remaining QUEUED orders need POST /api/portfolio/check-queued-orders"
+                        )
+                        self._released_session = key
+                await asyncio.sleep(self._seconds_until_next_check())
+        finally:
+            self._running = False
+    
+    def stats(self) -> Dict:
+        """Trạng thái scheduler và báo cáo lần chạy gần nhất"""
+        released = self._released_session
+        return {
+            "running": self._running,
+            "last_session": f"{released[0].isoformat()} {released[1]}" if released else None,
+            "attempts": self.attempts,
+            "last_report": self.last_report
+        }
+
+
+# Scheduler dùng chung cho toàn process
+order_release_scheduler = OrderReleaseService(
+    chunk_size=settings.ORDER_RELEASE_CHUNK_SIZE,
+    max_attempts=settings.ORDER_RELEASE_MAX_ATTEMPTS
+)
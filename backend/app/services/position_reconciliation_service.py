@@ -0,0 +1,108 @@
+"""
+Position Reconciliation Service - Đối chiếu positions với các orders FILLED
+"""
+
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy.orm import Session
+from app.models.portfolio import VirtualPosition
+from app.repositories.portfolio_repository import VirtualOrderRepository, VirtualPositionRepository
+
+
+@dataclass
+class PositionDiscrepancy:
+    """Một position lệch với tổng quantity của các orders FILLED"""
+    user_id: int
+    symbol: str
+    actual_quantity: int  # Quantity của position (0 nếu không có position)
+    expected_quantity: int  # Tổng BUY - SELL của các orders FILLED
+    position_id: Optional[int] = None  # None: thiếu position cho orders đã FILLED
+    
+    def to_dict(self) -> Dict:
+        return {
+            "user_id": self.user_id,
+            "symbol": self.symbol,
+            "actual_quantity": self.actual_quantity,
+            "expected_quantity": self.expected_quantity,
+            "position_id": self.position_id
+        }
+
+
+class PositionReconciliationService:
+    """
+    Positions chỉ được tạo/cập nhật khi orders FILLED, nên quantity của position phải bằng
+    tổng BUY - SELL của các orders FILLED cùng symbol. Số lệch thường do dữ liệu cũ.
+    
+    Tổng theo symbol được tính bằng một query GROUP BY cho mỗi lần đối chiếu (không query từng symbol).
+    """
+    
+    @staticmethod
+    def reconcile_user(
+        db: Session,
+        user_id: int,
+        positions: Optional[List[VirtualPosition]] = None
+    ) -> Tuple[List[VirtualPosition], List[PositionDiscrepancy]]:
+        """
+        Đối chiếu positions của một user
+        
+        Args:
+            positions: Positions đã load sẵn (None: load tất cả positions của user)
+        Returns: (positions hợp lệ, danh sách lệch)
+            - Hợp lệ: quantity bằng expected và > 0
+            - Lệch: quantity khác expected, hoặc orders FILLED còn quantity nhưng không có position
+        """
+        if positions is None:
+            positions = VirtualPositionRepository.get_all_by_user(db, user_id)
+        expected_quantities = VirtualOrderRepository.get_filled_net_quantities(db, user_id)
+        
+        valid_positions: List[VirtualPosition] = []
+        discrepancies: List[PositionDiscrepancy] = []
+        seen_symbols = set()
+        for position in positions:
+            seen_symbols.add(position.symbol)
+            expected = expected_quantities.get(position.symbol, 0)
+            if position.quantity != expected:
+                discrepancies.append(PositionDiscrepancy(
+                    user_id=user_id,
+                    symbol=position.symbol,
+                    actual_quantity=position.quantity,
+                    expected_quantity=expected,
+                    position_id=position.id
+                ))
+            elif expected > 0:
+                valid_positions.append(position)
+        
+        for symbol, expected in expected_quantities.items():
+            if symbol not in seen_symbols and expected != 0:
+                discrepancies.append(PositionDiscrepancy(
+                    user_id=user_id,
+                    symbol=symbol,
+                    actual_quantity=0,
+                    expected_quantity=expected
+                ))
+        
+        return valid_positions, discrepancies
+    
+    @staticmethod
+    def find_all_discrepancies(db: Session, user_id: Optional[int] = None) -> List[PositionDiscrepancy]:
+        """Tìm mọi position lệch của tất cả users (hoặc một user) trong một query"""
+        return [
+            PositionDiscrepancy(
+                user_id=row_user_id,
+                symbol=symbol,
+                actual_quantity=int(actual),
+                expected_quantity=int(expected),
+                position_id=position_id
+            )
+            for position_id, row_user_id, symbol, actual, expected
+            in VirtualPositionRepository.find_quantity_mismatches(db, user_id)
+        ]
+    
+    @staticmethod
+    def delete_invalid_positions(db: Session, discrepancies: List[PositionDiscrepancy]) -> int:
+        """
+        Xóa các positions lệch (chỉ những discrepancy có position)
+        Returns: Số positions đã xóa
+        """
+        position_ids = [item.position_id for item in discrepancies if item.position_id is not None]
+        return VirtualPositionRepository.delete_by_ids(db, position_ids)
@@ -0,0 +1,218 @@
+"""
+Price Cache Service - Cache giá mới nhất dùng chung cho toàn process
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from decimal import Decimal
+from typing import Dict, List, Optional, Set
+from app.config import settings
+from app.repositories.clickhouse_repository import ClickHouseRepository
+
+
+@dataclass(frozen=True)
+class CachedPrice:
+    """Giá đã cache kèm thông tin để caller biết giá cũ bao nhiêu"""
+    symbol: str
+    price: Decimal
+    candle_time: Optional[str]  # Thời gian của nến 1m chứa giá (ISO string)
+    fetched_at: float  # time.monotonic() lúc lấy từ ClickHouse
+    
+    @property
+    def age_seconds(self) -> float:
+        """Số giây kể từ lúc giá được lấy từ ClickHouse"""
+        return time.monotonic() - self.fetched_at
+
+
+class PriceCacheService:
+    """
+    Cache giá close mới nhất theo symbol, dùng chung cho mọi request trong process
+    
+    - Giá còn mới (age < refresh_ahead): trả về ngay
+    - Giá sắp hết hạn (refresh_ahead <= age < ttl): trả về ngay và đưa symbol vào hàng đợi
+      refresh nền. Một thread refresh duy nhất phục vụ tất cả request.
+    - Giá hết hạn hoặc chưa có: query đồng bộ (mỗi symbol chỉ một request query, các request
+      khác chờ kết quả đó)
+    """
+    
+    def __init__(
+        self,
+        ttl_seconds: float = 15,
+        refresh_ahead_seconds: float = 5,
+        max_symbols: int = 2000
+    ):
+        self.ttl_seconds = ttl_seconds
+        self.refresh_ahead_seconds = min(refresh_ahead_seconds, ttl_seconds)
+        self.max_symbols = max_symbols
+        
+        self._entries: "OrderedDict[str, CachedPrice]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._symbol_locks: Dict[str, threading.Lock] = {}
+        
+        # Refresh nền
+        self._pending: Set[str] = set()
+        self._wakeup = threading.Event()
+        self._refresher: Optional[threading.Thread] = None
+        
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+        self.background_refreshes = 0
+    
+    def get(self, ch_client, symbol: str) -> Optional[CachedPrice]:
+        """
+        Lấy giá mới nhất của symbol (có thể từ cache)
+        Returns: CachedPrice hoặc None nếu ClickHouse không có dữ liệu
+        """
+        entry = self._get_fresh(symbol)
+        if entry is not None:
+            self.hits += 1
+            if entry.age_seconds >= self.refresh_ahead_seconds:
+                self._schedule_refresh(symbol)
+            return entry
+        
+        # Miss: chỉ một caller query cho mỗi symbol, các caller khác chờ và dùng lại kết quả
+        with self._get_symbol_lock(symbol):
+            entry = self._get_fresh(symbol)
+            if entry is not None:
+                self.hits += 1
+                return entry
+            self.misses += 1
+            return self._load_many(ch_client, [symbol]).get(symbol)
+    
+    def get_many(self, ch_client, symbols: List[str]) -> Dict[str, CachedPrice]:
+        """
+        Lấy giá mới nhất cho nhiều symbols
+        Các symbols chưa có/hết hạn được query chung trong một lần gọi ClickHouse
+        Returns: Dict {symbol: CachedPrice} (thiếu symbol nếu ClickHouse không có dữ liệu)
+        """
+        result: Dict[str, CachedPrice] = {}
+        missing: List[str] = []
+        for symbol in set(symbols):
+            entry = self._get_fresh(symbol)
+            if entry is None:
+                missing.append(symbol)
+                continue
+            self.hits += 1
+            if entry.age_seconds >= self.refresh_ahead_seconds:
+                self._schedule_refresh(symbol)
+            result[symbol] = entry
+        
+        if missing:
+            self.misses += len(missing)
+            result.update(self._load_many(ch_client, missing))
+        return result
+    
+    def invalidate(self, symbol: Optional[str] = None):
+        """Xóa giá đã cache (symbol=None: xóa toàn bộ)"""
+        with self._lock:
+            if symbol is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(symbol, None)
+    
+    def stats(self) -> Dict:
+        """Thống kê cache (để monitor)"""
+        with self._lock:
+            size = len(self._entries)
+            pending = len(self._pending)
+        return {
+            "size": size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "background_refreshes": self.background_refreshes,
+            "pending_refreshes": pending,
+            "ttl_seconds": self.ttl_seconds,
+            "refresh_ahead_seconds": self.refresh_ahead_seconds
+        }
+    
+    def _get_fresh(self, symbol: str) -> Optional[CachedPrice]:
+        """Lấy entry còn trong TTL (None nếu chưa có hoặc đã hết hạn)"""
+        with self._lock:
+            entry = self._entries.get(symbol)
+        if entry is not None and entry.age_seconds < self.ttl_seconds:
+            return entry
+        return None
+    
+    def _get_symbol_lock(self, symbol: str) -> threading.Lock:
+        with self._lock:
+            lock = self._symbol_locks.get(symbol)
+            if lock is None:
+                lock = threading.Lock()
+                self._symbol_locks[symbol] = lock
+            return lock
+    
+    def _load_many(self, ch_client, symbols: List[str]) -> Dict[str, CachedPrice]:
+        """Query giá mới nhất của nhiều symbols trong một round-trip và lưu vào cache"""
+        latest_prices = ClickHouseRepository(ch_client).get_latest_prices(symbols, interval="1m")
+        fetched_at = time.monotonic()
+        
+        entries: Dict[str, CachedPrice] = {}
+        for symbol, latest in latest_prices.items():
+            entry = CachedPrice(
+                symbol=symbol,
+                price=Decimal(str(latest["close"])),
+                candle_time=latest.get("time"),
+                fetched_at=fetched_at
+            )
+            self._store(entry)
+            entries[symbol] = entry
+        return entries
+    
+    def _store(self, entry: CachedPrice):
+        with self._lock:
+            self._entries[entry.symbol] = entry
+            self._entries.move_to_end(entry.symbol)
+            # Giới hạn số symbols: bỏ entry được refresh lâu nhất
+            while len(self._entries) > self.max_symbols:
+                evicted, _ = self._entries.popitem(last=False)
+                self._symbol_locks.pop(evicted, None)
+    
+    def _schedule_refresh(self, symbol: str):
+        """Đưa symbol vào hàng đợi refresh nền (bỏ qua nếu đã có trong hàng đợi)"""
+        with self._lock:
+            if symbol in self._pending:
+                return
+            self._pending.add(symbol)
+            if self._refresher is None or not self._refresher.is_alive():
+                self._refresher = threading.Thread(
+                    target=self._refresh_loop, name="price-cache-refresher", daemon=True
+                )
+                self._refresher.start()
+        self._wakeup.set()
+    
+    def _refresh_loop(self):
+        """Thread refresh nền: lấy các symbol đang chờ và refresh cùng lúc"""
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            
+            with self._lock:
+                symbols = list(self._pending)
+            if not symbols:
+                continue
+            
+            # Refresh tất cả symbols đang chờ trong một query
+            try:
+                self._load_many(self._get_refresh_client(), symbols)
+                self.background_refreshes += 1
+            except Exception as e:
+                print(f"Error refreshing cached prices for {len(symbols)} symbols: {e}")
+            finally:
+                with self._lock:
+                    self._pending.difference_update(symbols)
+    
+    def _get_refresh_client(self):
+        """ClickHouse executor dùng chung (mỗi query checkout connection riêng từ pool)"""
+        from app.database import ch_client
+        return ch_client
+
+
+# Cache dùng chung cho toàn process
+price_cache = PriceCacheService(
+    ttl_seconds=settings.PRICE_CACHE_TTL_SECONDS,
+    refresh_ahead_seconds=settings.PRICE_CACHE_REFRESH_AHEAD_SECONDS,
+    max_symbols=settings.PRICE_CACHE_MAX_SYMBOLS
+)
@@ -0,0 +1,184 @@
+"""
+Response Format Service - Chọn định dạng response (JSON / MessagePack / Arrow IPC) theo header Accept
+"""
+
+import json
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Any, Dict, List, Optional
+from fastapi import Request
+from fastapi.responses import JSONResponse, Response
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+
+def _encode_default(value: Any):
+    """Convert các kiểu JSON/MessagePack không hỗ trợ sẵn"""
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, tuple):
+        return list(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not serializable")
+
+
+class MarketDataJSONResponse(JSONResponse):
+    """
+    JSONResponse encode thẳng bằng json.dumps (không qua jsonable_encoder duyệt từng phần tử)
+    Decimal/datetime được convert bằng _encode_default
+    """
+    
+    def render(self, content: Any) -> bytes:
+        return json.dumps(
+            content,
+            ensure_ascii=False,
+            allow_nan=False,
+            indent=None,
+            separators=(",", ":"),
+            default=_encode_default
+        ).encode("utf-8")
+
+
+class ResponseFormatService:
+    """
+    Content negotiation cho các endpoint market data
+    
+    - application/json (mặc định)
+    - application/msgpack (cần package msgpack): cùng cấu trúc với JSON nhưng nhị phân
+    - application/vnd.apache.arrow.stream (cần package pyarrow): chỉ cho endpoint trả về bảng,
+      phần bảng thành Arrow table, các field còn lại nằm trong schema metadata
+    
+    Format chưa cài package sẽ không được chọn (fallback JSON)
+    Mọi response đã negotiate đều có header Vary: Accept để cache/CDN không trả nhầm format
+    
+    Cột time của bảng là giờ Việt Nam (wall clock UTC+7, naive như trong ClickHouse), không phải UTC:
+    JSON/MessagePack là epoch giây của giờ đó, Arrow là timestamp("s") không timezone cùng giá trị
+    """
+    
+    JSON = "application/json"
+    MSGPACK = "application/msgpack"
+    ARROW = "application/vnd.apache.arrow.stream"
+    
+    # Alias media type mà client hay gửi
+    _ALIASES = {
+        "application/x-msgpack": MSGPACK,
+        "application/vnd.msgpack": MSGPACK,
+        "application/vnd.apache.arrow.file": ARROW,
+    }
+    
+    # Header cho response phụ thuộc Accept
+    VARY_HEADERS = {"Vary": "Accept"}
+    
+    @staticmethod
+    def available_formats(tabular: bool = True) -> List[str]:
+        """Các media type server có thể trả về"""
+        formats = [ResponseFormatService.JSON]
+        if msgpack is not None:
+            formats.append(ResponseFormatService.MSGPACK)
+        if tabular and pa is not None:
+            formats.append(ResponseFormatService.ARROW)
+        return formats
+    
+    @staticmethod
+    def negotiate(request: Request, tabular: bool = True) -> str:
+        """
+        Chọn media type theo header Accept (có xét q-value)
+        Args:
+            tabular: Endpoint có trả về bảng không (Arrow chỉ dùng cho bảng)
+        Returns: Media type, mặc định JSON
+        """
+        accept = request.headers.get("accept")
+        if not accept:
+            return ResponseFormatService.JSON
+        
+        available = ResponseFormatService.available_formats(tabular)
+        best_type, best_q = ResponseFormatService.JSON, 0.0
+        for part in accept.split(","):
+            params = part.strip().split(";")
+            media_type = params[0].strip().lower()
+            media_type = ResponseFormatService._ALIASES.get(media_type, media_type)
+            
+            q = 1.0
+            for param in params[1:]:
+                key, _, value = param.strip().partition("=")
+                if key.strip() == "q":
+                    try:
+                        q = float(value)
+                    except ValueError:
+                        q = 0.0
+            
+            # */* và application/* -> JSON; cùng q thì giữ type đứng trước
+            if media_type in ("*/*", "application/*"):
+                media_type = ResponseFormatService.JSON
+            if media_type in available and q > best_q:
+                best_type, best_q = media_type, q
+        
+        return best_type
+    
+    @staticmethod
+    def render(media_type: str, payload: Dict, table_key: Optional[str] = None) -> Response:
+        """
+        Encode payload theo media type đã chọn
+        
+        Args:
+            media_type: Kết quả của negotiate()
+            payload: Dict response (giống response JSON)
+            table_key: Key của phần bảng trong payload (list of dicts, dict các mảng song song
+                       hoặc list giá trị) - bắt buộc với Arrow
+        """
+        if media_type == ResponseFormatService.MSGPACK:
+            return Response(
+                content=msgpack.packb(payload, default=_encode_default, use_bin_type=True),
+                media_type=ResponseFormatService.MSGPACK,
+                headers=ResponseFormatService.VARY_HEADERS
+            )
+        if media_type == ResponseFormatService.ARROW and table_key is not None:
+            return Response(
+                content=ResponseFormatService._to_arrow_ipc(payload, table_key),
+                media_type=ResponseFormatService.ARROW,
+                headers=ResponseFormatService.VARY_HEADERS
+            )
+        return MarketDataJSONResponse(content=payload, headers=ResponseFormatService.VARY_HEADERS)
+    
+    @staticmethod
+    def to_arrow_table(data: Any, column_name: str = "value"):
+        """
+        Convert phần bảng thành pyarrow.Table
+        - Dict {cột: mảng}: mỗi key một cột (cột time dạng epoch giây giờ Việt Nam -> timestamp không timezone)
+        - List of dicts: mỗi key một cột
+        - List giá trị: một cột tên column_name
+        """
+        if isinstance(data, dict):
+            columns = {}
+            for name, values in data.items():
+                if name == "time":
+                    columns[name] = pa.array(values, type=pa.int64()).cast(pa.timestamp("s"))
+                else:
+                    columns[name] = pa.array(values)
+            return pa.table(columns)
+        if data and isinstance(data[0], dict):
+            return pa.Table.from_pylist(data)
+        return pa.table({column_name: pa.array(data)})
+    
+    @staticmethod
+    def _to_arrow_ipc(payload: Dict, table_key: str) -> bytes:
+        """Encode payload thành Arrow IPC stream, các field ngoài bảng lưu trong schema metadata"""
+        table = ResponseFormatService.to_arrow_table(payload.get(table_key) or [], column_name=table_key)
+        metadata = {
+            key: json.dumps(value, default=_encode_default)
+            for key, value in payload.items()
+            if key != table_key
+        }
+        table = table.replace_schema_metadata(metadata)
+        
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes()
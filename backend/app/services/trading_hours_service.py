@@ -2,7 +2,7 @@
 Trading Hours Service - Kiểm tra giờ giao dịch
 """
 
-from datetime import datetime, time, timedelta
+from datetime import date, datetime, time, timedelta
 from typing import Tuple, Optional
 try:
     import pytz
@@ -18,6 +18,11 @@ class TradingHoursService:
     MORNING_END = time(11, 30)
     AFTERNOON_START = time(13, 0)
     AFTERNOON_END = time(15, 0)
+    # Giờ khớp lệnh định kỳ (collector dnse gắn timestamp tick ATO/ATC theo giờ này)
+    AUCTION_TIMES = {
+        "ATO": time(9, 15),
+        "ATC": time(14, 45),
+    }
     
     @staticmethod
     def _get_vn_timezone():
@@ -58,6 +63,55 @@ class TradingHoursService:
         
         return False
     
+    @staticmethod
+    def get_session(dt: datetime) -> Optional[str]:
+        """
+        Phiên giao dịch chứa thời điểm dt
+        Returns: "MORNING", "AFTERNOON" hoặc None nếu ngoài giờ giao dịch
+        """
+        if not TradingHoursService.is_trading_hours(dt):
+            return None
+        if dt.time() <= TradingHoursService.MORNING_END:
+            return "MORNING"
+        return "AFTERNOON"
+    
+    @staticmethod
+    def get_auction_time(session: str, trade_date: date) -> datetime:
+        """Thời điểm khớp lệnh định kỳ ATO/ATC của một ngày (giờ Việt Nam)"""
+        vn_tz = TradingHoursService._get_vn_timezone()
+        return TradingHoursService._localize(
+            datetime.combine(trade_date, TradingHoursService.AUCTION_TIMES[session]), vn_tz
+        )
+    
+    @staticmethod
+    def get_auction_date(session: str, placed_at: datetime) -> date:
+        """
+        Ngày của phiên ATO/ATC mà order đặt lúc placed_at sẽ tham gia:
+        ngày giao dịch đầu tiên có giờ khớp định kỳ >= placed_at (placed_at không có timezone coi là giờ Việt Nam)
+        """
+        vn_tz = TradingHoursService._get_vn_timezone()
+        if placed_at.tzinfo is None:
+            placed_at = TradingHoursService._localize(placed_at, vn_tz)
+        else:
+            placed_at = placed_at.astimezone(vn_tz)
+        
+        trade_date = placed_at.date()
+        for _ in range(8):  # Tối đa qua một cuối tuần
+            if (
+                TradingHoursService.is_trading_day(datetime.combine(trade_date, time()))
+                and placed_at <= TradingHoursService.get_auction_time(session, trade_date)
+            ):
+                return trade_date
+            trade_date += timedelta(days=1)
+        return trade_date
+    
+    @staticmethod
+    def _localize(dt: datetime, tz) -> datetime:
+        """Gắn timezone cho datetime không có timezone (pytz cần localize)"""
+        if hasattr(tz, "localize"):
+            return tz.localize(dt)
+        return dt.replace(tzinfo=tz)
+    
     @staticmethod
     def get_current_vn_time() -> datetime:
         """Lấy thời gian hiện tại theo múi giờ Việt Nam (GMT+7)"""
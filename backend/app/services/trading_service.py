@@ -4,11 +4,16 @@ Trading Service - Business Logic cho Virtual Trading
 
 from sqlalchemy.orm import Session
 from decimal import Decimal
-from typing import Optional, Tuple, Dict
+from typing import Optional, Tuple, Dict, List
 from datetime import datetime
 from app.repositories.portfolio_repository import PortfolioRepository, VirtualOrderRepository, VirtualPositionRepository
 from app.repositories.clickhouse_repository import ClickHouseRepository
 from app.services.trading_hours_service import TradingHoursService
+from app.services.price_cache_service import price_cache
+from app.services.ledger_service import LedgerService
+from app.services.matching_engine_service import matching_engine
+from app.services.order_release_service import order_release_scheduler
+from app.services.admin_stats_service import admin_stats
 from app.models.portfolio import VirtualOrder
 from app.schemas.portfolio import VirtualOrderCreate
 
@@ -69,33 +74,55 @@ class TradingService:
     ) -> Optional[Decimal]:
         """
         Lấy giá từ ClickHouse
-        - Nếu as_of_date=None: Lấy giá hiện tại (real-time) - candle mới nhất
+        - Nếu as_of_date=None: Lấy giá hiện tại (real-time) - candle mới nhất, qua price_cache
         - Nếu as_of_date có giá trị: Lấy giá tại thời điểm đó (simulation)
         """
         try:
-            repo = ClickHouseRepository(ch_client)
             if as_of_date:
                 # Lấy giá tại thời điểm cụ thể (simulation mode)
+                repo = ClickHouseRepository(ch_client)
                 price = repo.get_price_at_time(symbol, as_of_date, interval="1m")
                 if price is not None:
                     return Decimal(str(price))
             else:
-                # Lấy giá hiện tại (real-time) - candle mới nhất
-                latest_data = repo.get_latest_ohlc(symbol, interval="1m", limit=1)
-                if latest_data and len(latest_data) > 0:
-                    latest_candle = latest_data[0]  # Candle đầu tiên là mới nhất (ORDER BY time DESC)
-                    price = latest_candle.get("close")
-                    if price is not None:
-                        print(f"DEBUG get_current_price: symbol={symbol}, time={latest_candle.get('time')}, close={price}")
-                        return Decimal(str(price))
-                    else:
-                        print(f"WARNING get_current_price: symbol={symbol}, latest candle has no close price")
+                # Lấy giá hiện tại (real-time) qua cache dùng chung của process
+                # (dùng price_cache.get trực tiếp nếu cần biết giá cũ bao nhiêu giây)
+                cached = price_cache.get(ch_client, symbol)
+                if cached is not None:
+                    return cached.price
         except Exception as e:
             print(f"Error getting price for {symbol}: {e}")
             import traceback
             traceback.print_exc()
         return None
     
+    @staticmethod
+    def get_current_prices(
+        ch_client,
+        symbols: List[str],
+        as_of_date: Optional[datetime] = None
+    ) -> Dict[str, Decimal]:
+        """
+        Lấy giá cho nhiều symbols trong một lần gọi ClickHouse
+        - as_of_date=None: giá hiện tại (qua price_cache, chỉ query các symbols chưa có trong cache)
+        - as_of_date có giá trị: giá tại thời điểm đó (simulation)
+        Returns: Dict {symbol: price}, thiếu symbol nếu không lấy được giá
+        """
+        if not ch_client or not symbols:
+            return {}
+        try:
+            if as_of_date:
+                repo = ClickHouseRepository(ch_client)
+                prices = repo.get_prices_at_time(symbols, as_of_date, interval="1m")
+                return {symbol: Decimal(str(price)) for symbol, price in prices.items()}
+            cached = price_cache.get_many(ch_client, symbols)
+            return {symbol: entry.price for symbol, entry in cached.items()}
+        except Exception as e:
+            print(f"Error getting prices for {len(symbols)} symbols: {e}")
+            import traceback
+            traceback.print_exc()
+        return {}
+    
     @staticmethod
     def create_order(
         db: Session,
@@ -157,6 +184,46 @@ class TradingService:
         if not is_valid:
             return None, error
         
+        order, error = TradingService._write_order(db, user_id, order_data, can_trade, current_price)
+        if error:
+            db.rollback()
+            return None, error
+        committed_at = admin_stats.commit(db)
+        
+        admin_stats.order_created(committed_at)
+        if order.status == "FILLED":
+            admin_stats.order_filled(committed_at, order)
+        
+        # LIMIT order chờ khớp: đưa vào sổ lệnh của engine khớp lệnh chạy nền
+        matching_engine.add_order(order)
+        
+        # Nếu không thể trade ngay (chỉ cho REALTIME mode), trả về thông báo
+        if not can_trade and not is_practice_mode:
+            return order, TradingService._queued_message(trade_error)
+        
+        return order, None
+    
+    @staticmethod
+    def _queued_message(trade_error: Optional[str]) -> str:
+        next_session = TradingHoursService.get_next_trading_session()
+        next_session_str = next_session.strftime("%Y-%m-%d %H:%M:%S") if next_session else "N/A"
+        return f"Order đã được tạo với status QUEUED. {trade_error}. Phiên giao dịch tiếp theo: {next_session_str}"
+    
+    @staticmethod
+    def _write_order(
+        db: Session,
+        user_id: int,
+        order_data: VirtualOrderCreate,
+        can_trade: bool,
+        current_price: Optional[Decimal]
+    ) -> Tuple[Optional[VirtualOrder], Optional[str]]:
+        """
+        Ghi order đã validate trong transaction hiện tại: INSERT order + fill ngay (MARKET) hoặc block tiền.
+        Không commit; có lỗi thì caller rollback (hoặc rollback savepoint).
+        Returns: (order, error_message)
+        """
+        is_practice_mode = order_data.trading_mode == "PRACTICE"
+        
         # Với MARKET orders, nếu không có price từ order_data, lưu current_price vào order.price
         # Điều này đảm bảo order có price trong DB để tính blocked cash và fill order sau này
         # ATO/ATC: price = NULL (sẽ fill sau)
@@ -191,9 +258,6 @@ class TradingService:
             # Trong giờ giao dịch và MARKET order → sẽ fill ngay
             initial_status = "PENDING"  # Sẽ được fill ngay sau
         
-        # Create order với price đã được set
-        order = VirtualOrderRepository.create(db, user_id, order_data_with_price, status=initial_status)
-        
         # Auto-fill MARKET orders (không fill ATO/ATC):
         # - PRACTICE mode: LUÔN fill ngay (bỏ qua can_trade hoàn toàn)
         # - REALTIME mode: chỉ fill nếu trong giờ giao dịch (can_trade = True)
@@ -206,34 +270,174 @@ class TradingService:
                 # REALTIME mode: chỉ fill nếu trong giờ giao dịch
                 should_fill = True
         
+        # INSERT order ở lần flush/commit tiếp theo, cùng transaction với fill hoặc block tiền
+        order = VirtualOrderRepository.create(db, user_id, order_data_with_price, status=initial_status, commit=False)
+        
         if should_fill:
-            # Fill ngay, không cần block tiền
-            fill_price = current_price
-            order, fill_error = TradingService.fill_order(db, order.id, fill_price, ch_client)
+            # Fill ngay (order được INSERT thẳng với status FILLED), chưa từng block tiền nên không unblock
+            fill_error = TradingService.apply_fill(db, order, current_price, blocked_amount=Decimal("0"))
             if fill_error:
                 return None, fill_error
         else:
             # Không fill ngay → Block tiền cho BUY orders ở trạng thái QUEUED/PENDING (chỉ REALTIME mode)
             # ATO/ATC: Không block tiền ngay vì giá chưa biết, sẽ validate khi fill
             # PRACTICE mode không block vì là số dư ảo
-            if order.side == "BUY" and order.status in ["QUEUED", "PENDING"] and order.trading_mode == "REALTIME" and order_data.order_type not in ["ATO", "ATC"]:
-                portfolio = PortfolioRepository.get_or_create_portfolio(db, user_id)
+            if order.side == "BUY" and order.trading_mode == "REALTIME" and order_data.order_type not in ["ATO", "ATC"]:
                 # Xác định giá để tính toán blocked amount
                 block_price = order.price if order.price else current_price
                 if block_price:
                     # Giá từ ClickHouse là nghìn VNĐ, cần nhân 1000 khi tính tiền
                     blocked_amount = block_price * order.quantity * Decimal("1000")
-                    PortfolioRepository.block_cash(db, portfolio, blocked_amount)
-                    print(f"✅ Blocked {blocked_amount} VNĐ for order {order.id} (status: {order.status})")
-        
-        # Nếu không thể trade ngay (chỉ cho REALTIME mode), trả về thông báo
-        if not can_trade and not is_practice_mode:
-            next_session = TradingHoursService.get_next_trading_session()
-            next_session_str = next_session.strftime("%Y-%m-%d %H:%M:%S") if next_session else "N/A"
-            return order, f"Order đã được tạo với status QUEUED. {trade_error}. Phiên giao dịch tiếp theo: {next_session_str}"
+                    # Block có điều kiện tiền khả dụng: hai orders đặt đồng thời không dùng chung một khoản tiền
+                    portfolio = PortfolioRepository.adjust_cash(
+                        db, user_id, blocked_delta=blocked_amount, min_available=blocked_amount
+                    )
+                    if portfolio is None:
+                        return None, f"Insufficient balance. Required: {blocked_amount}"
+                    print(f"✅ Blocked {blocked_amount} VNĐ for {order.side} {order.quantity} {order.symbol} (status: {order.status})")
         
         return order, None
     
+    @staticmethod
+    def create_orders_batch(
+        db: Session,
+        user_id: int,
+        orders_data: List[VirtualOrderCreate],
+        ch_client,
+        atomic: bool = False
+    ) -> List[Tuple[Optional[VirtualOrder], Optional[str]]]:
+        """
+        Tạo nhiều orders trong một request (rebalance portfolio, đặt thang LIMIT orders)
+        
+        - Giá: một lần gọi price_cache cho mọi symbol của MARKET orders không có current_price từ frontend
+          (và một lần cho mỗi execution_time khác nhau của PRACTICE orders)
+        - Validate một lượt trên portfolio/positions đọc một lần: các orders trong batch lần lượt trừ vào
+          cùng tiền khả dụng/số cổ phiếu (SELL khớp ngay cộng tiền cho các BUY sau, BUY khớp ngay cộng cổ phiếu)
+        - Ghi trong một transaction, mỗi order một SAVEPOINT; atomic=True: một order lỗi thì không tạo order nào
+        
+        Returns: [(order, message)] theo thứ tự orders_data, cùng ý nghĩa với create_order
+                 (order None: message là lỗi; order có giá trị: message là thông báo QUEUED nếu có)
+        """
+        results: List[Tuple[Optional[VirtualOrder], Optional[str]]] = [(None, None)] * len(orders_data)
+        
+        # Giá cho MARKET orders: một lần cho giá hiện tại, một lần cho mỗi execution_time
+        market_orders = [
+            order_data for order_data in orders_data
+            if order_data.order_type == "MARKET" and not order_data.current_price
+        ]
+        latest_prices = TradingService.get_current_prices(
+            ch_client, sorted({order_data.symbol for order_data in market_orders})
+        )
+        historical_prices: Dict[datetime, Dict[str, Decimal]] = {}
+        for execution_time in {order_data.execution_time for order_data in market_orders if order_data.execution_time}:
+            symbols = sorted({order_data.symbol for order_data in market_orders if order_data.execution_time == execution_time})
+            historical_prices[execution_time] = TradingService.get_current_prices(ch_client, symbols, as_of_date=execution_time)
+        
+        # Giờ giao dịch: một lần cho mỗi trading_mode
+        trade_status: Dict[str, Tuple[bool, Optional[str]]] = {}
+        
+        # Trạng thái dùng chung cho lượt validate
+        portfolio = PortfolioRepository.get_or_create_portfolio(db, user_id)
+        available_cash = portfolio.cash_balance - portfolio.blocked_cash
+        shares = {position.symbol: position.quantity for position in VirtualPositionRepository.get_all_by_user(db, user_id)}
+        
+        # (index, order_data, can_trade, current_price, thông báo QUEUED)
+        planned: List[Tuple[int, VirtualOrderCreate, bool, Optional[Decimal], Optional[str]]] = []
+        for index, order_data in enumerate(orders_data):
+            if order_data.execution_time and order_data.trading_mode != "PRACTICE":
+                results[index] = (None, "execution_time chỉ được dùng với PRACTICE mode")
+                continue
+            
+            can_trade, trade_error = True, None
+            if not order_data.execution_time:
+                if order_data.trading_mode not in trade_status:
+                    trade_status[order_data.trading_mode] = TradingHoursService.can_trade_now(order_data.trading_mode)
+                can_trade, trade_error = trade_status[order_data.trading_mode]
+            is_practice_mode = order_data.trading_mode == "PRACTICE"
+            
+            current_price = None
+            if order_data.order_type == "MARKET":
+                if order_data.current_price:
+                    current_price = Decimal(str(order_data.current_price))
+                else:
+                    current_price = (
+                        historical_prices.get(order_data.execution_time, {}).get(order_data.symbol)
+                        or latest_prices.get(order_data.symbol)
+                    )
+                if not current_price:
+                    price_time = order_data.execution_time
+                    time_str = price_time.strftime("%Y-%m-%d %H:%M:%S") if price_time else "hiện tại"
+                    results[index] = (None, f"Could not get price for {order_data.symbol} at {time_str}")
+                    continue
+            
+            # Cùng điều kiện với validate_order, trên trạng thái đã trừ các orders trước trong batch
+            if order_data.order_type == "LIMIT" and not order_data.price:
+                results[index] = (None, "LIMIT order requires price")
+                continue
+            should_fill = order_data.order_type == "MARKET" and (is_practice_mode or can_trade)
+            price_to_use = order_data.price if order_data.price else current_price
+            if order_data.side == "BUY":
+                if order_data.trading_mode != "PRACTICE" and order_data.order_type not in ["ATO", "ATC"]:
+                    if not price_to_use:
+                        results[index] = (None, "Cannot determine price for order validation")
+                        continue
+                    # Giá từ ClickHouse là nghìn VNĐ, cần nhân 1000 khi tính tiền
+                    total_cost = price_to_use * order_data.quantity * Decimal("1000")
+                    if available_cash < total_cost:
+                        results[index] = (None, f"Insufficient balance. Required: {total_cost}, Available: {available_cash}")
+                        continue
+                    available_cash -= total_cost
+                if should_fill:
+                    shares[order_data.symbol] = shares.get(order_data.symbol, 0) + order_data.quantity
+            else:
+                available = shares.get(order_data.symbol, 0)
+                if available < order_data.quantity:
+                    results[index] = (None, f"Insufficient shares. Required: {order_data.quantity}, Available: {available}")
+                    continue
+                shares[order_data.symbol] = available - order_data.quantity
+                if should_fill and order_data.trading_mode != "PRACTICE":
+                    available_cash += current_price * order_data.quantity * Decimal("1000")
+            
+            queued_message = TradingService._queued_message(trade_error) if not can_trade and not is_practice_mode else None
+            planned.append((index, order_data, can_trade, current_price, queued_message))
+        
+        if atomic and len(planned) < len(orders_data):
+            return [
+                (None, error or "Batch cancelled: another order in the batch is invalid")
+                for _, error in results
+            ]
+        
+        # Ghi: một transaction, mỗi order một SAVEPOINT (lỗi chỉ hoàn tác order đó)
+        created: List[Tuple[int, VirtualOrder, Optional[str]]] = []
+        for index, order_data, can_trade, current_price, queued_message in planned:
+            savepoint = db.begin_nested()
+            try:
+                order, error = TradingService._write_order(db, user_id, order_data, can_trade, current_price)
+            except Exception as e:
+                order, error = None, str(e)
+            if error:
+                savepoint.rollback()
+                results[index] = (None, error)
+                if atomic:
+                    db.rollback()
+                    return [
+                        (None, message or "Batch cancelled: another order in the batch failed")
+                        for _, message in results
+                    ]
+                continue
+            savepoint.commit()
+            created.append((index, order, queued_message))
+        committed_at = admin_stats.commit(db)
+        
+        admin_stats.order_created(committed_at, len(created))
+        for index, order, queued_message in created:
+            if order.status == "FILLED":
+                admin_stats.order_filled(committed_at, order)
+            # LIMIT order chờ khớp: đưa vào sổ lệnh của engine khớp lệnh chạy nền
+            matching_engine.add_order(order)
+            results[index] = (order, queued_message)
+        return results
+    
     @staticmethod
     def fill_order(
         db: Session,
@@ -242,7 +446,7 @@ class TradingService:
         ch_client = None
     ) -> Tuple[Optional[VirtualOrder], Optional[str]]:
         """
-        Fill order với giá cụ thể
+        Fill order với giá cụ thể (một transaction)
         Returns: (order, error_message)
         """
         order = VirtualOrderRepository.get_by_id(db, order_id)
@@ -252,71 +456,155 @@ class TradingService:
         if order.status not in ["PENDING", "QUEUED"]:
             return None, f"Cannot fill order with status {order.status}"
         
-        portfolio = PortfolioRepository.get_or_create_portfolio(db, order.user_id)
+        # Validate lại khi fill (tình trạng có thể đã thay đổi từ khi tạo order), trong cùng transaction
+        error = TradingService.apply_fill(db, order, fill_price)
+        if error:
+            db.rollback()
+            return None, error
         
-        # Validate lại TRƯỚC KHI fill (vì có thể tình trạng đã thay đổi từ khi tạo order)
-        if order.side == "BUY":
-            # Validate BUY: Check available cash (sau khi unblock)
-            # Giá từ ClickHouse là nghìn VNĐ, cần nhân 1000 khi tính tiền
-            total_cost = fill_price * order.quantity * Decimal("1000")
-            if order.trading_mode == "REALTIME":
-                # Tính blocked amount sẽ được unblock
-                blocked_amount = (order.price if order.price else fill_price) * order.quantity * Decimal("1000")
-                # Available cash sau khi unblock = cash_balance - (blocked_cash - blocked_amount)
-                available_after_unblock = portfolio.cash_balance - (portfolio.blocked_cash - blocked_amount)
-                if available_after_unblock < total_cost:
-                    return None, f"Insufficient balance to fill order. Required: {total_cost}, Available after unblock: {available_after_unblock}"
-        else:  # SELL
-            # Validate SELL: Check position có đủ shares không
-            position = VirtualPositionRepository.get_by_user_and_symbol(
-                db, order.user_id, order.symbol
-            )
-            if not position or position.quantity < order.quantity:
-                available = position.quantity if position else 0
-                return None, f"Insufficient shares to fill order. Required: {order.quantity}, Available: {available}"
+        committed_at = admin_stats.commit(db)
+        admin_stats.order_filled(committed_at, order)
+        return order, None
+    
+    @staticmethod
+    def apply_fill(
+        db: Session,
+        order: VirtualOrder,
+        fill_price: Decimal,
+        blocked_amount: Optional[Decimal] = None
+    ) -> Optional[str]:
+        """
+        Ghi fill trong transaction hiện tại: order FILLED, unblock tiền + cập nhật cash, position,
+        sổ cái và total_value. Không commit; có lỗi thì caller rollback (hoặc rollback savepoint).
+        
+        Kiểm tra nằm trong chính các câu lệnh ghi nên đúng cả khi nhiều orders của một user fill đồng thời:
+        - order chỉ chuyển sang FILLED nếu còn PENDING/QUEUED (UPDATE có điều kiện)
+        - cash/blocked_cash cập nhật bằng một UPDATE ... RETURNING có điều kiện tiền khả dụng (REALTIME BUY)
+        - position được khóa FOR UPDATE trước khi kiểm tra số cổ phiếu (SELL)
+        Thứ tự khóa luôn là order -> portfolio -> position (giống cancel_order).
+        
+        Args:
+            blocked_amount: Tiền đã block lúc đặt order (None: tính bằng get_blocked_amount;
+                            0 cho order fill ngay lúc tạo vì chưa từng block)
+        Returns: error_message (None nếu thành công)
+        """
+        if blocked_amount is None:
+            blocked_amount = TradingService.get_blocked_amount(order, fill_price)
         
-        # Fill order
-        order = VirtualOrderRepository.fill_order(db, order, order.quantity, fill_price)
+        if VirtualOrderRepository.fill_order(db, order, order.quantity, fill_price, commit=False) is None:
+            return "Cannot fill order: order is no longer PENDING/QUEUED"
         
-        # Update portfolio và positions
+        # Giá từ ClickHouse là nghìn VNĐ, cần nhân 1000 khi tính tiền
+        amount = fill_price * order.quantity * Decimal("1000")
         if order.side == "BUY":
-            # Unblock tiền (nếu đã block) và trừ tiền, thêm position
-            # Giá từ ClickHouse là nghìn VNĐ, cần nhân 1000 khi tính tiền
-            total_cost = fill_price * order.quantity * Decimal("1000")
-            
-            # Unblock tiền nếu order đã bị block (QUEUED/PENDING)
-            if order.trading_mode == "REALTIME":
-                # Tính blocked amount: 
-                # - LIMIT order: dùng order.price (giá giới hạn)
-                # - MARKET order: dùng fill_price (giá khớp thực tế)
-                # Lưu ý: Nếu order.price có giá trị, đó là giá đã block ban đầu
-                # Giá từ ClickHouse là nghìn VNĐ, cần nhân 1000 khi tính tiền
-                blocked_amount = (order.price if order.price else fill_price) * order.quantity * Decimal("1000")
-                PortfolioRepository.unblock_cash(db, portfolio, blocked_amount)
-                print(f"✅ Unblocked {blocked_amount} VNĐ for order {order.id} (price used: {order.price if order.price else fill_price})")
-            
-            # Trừ tiền thực tế
+            # Unblock tiền đã block (nếu có) và trừ tiền thực tế
             # Trong PRACTICE mode, cho phép balance âm (số dư ảo)
-            # Trong REALTIME mode, đã validate ở validate_order rồi
-            PortfolioRepository.update_cash_balance(db, portfolio, -total_cost)
-            
-            # Thêm position (CHỈ khi FILLED)
-            VirtualPositionRepository.create_or_update_position(
-                db, order.user_id, order.symbol, order.quantity, fill_price
+            # Trong REALTIME mode, tiền khả dụng sau khi unblock phải đủ
+            min_available = amount - blocked_amount if order.trading_mode == "REALTIME" else None
+            portfolio = PortfolioRepository.adjust_cash(
+                db, order.user_id, cash_delta=-amount, blocked_delta=-blocked_amount, min_available=min_available
             )
+            if portfolio is None:
+                return f"Insufficient balance to fill order. Required: {amount}, Unblocked: {blocked_amount}"
+            if blocked_amount > 0:
+                print(f"✅ Unblocked {blocked_amount} VNĐ for order {order.id} (price used: {order.price if order.price else fill_price})")
+            quantity_change = order.quantity
         else:  # SELL
             # Cộng tiền, trừ position
-            # Giá từ ClickHouse là nghìn VNĐ, cần nhân 1000 khi tính tiền
-            total_revenue = fill_price * order.quantity * Decimal("1000")
-            PortfolioRepository.update_cash_balance(db, portfolio, total_revenue)
-            VirtualPositionRepository.create_or_update_position(
-                db, order.user_id, order.symbol, -order.quantity, fill_price
-            )
+            if PortfolioRepository.adjust_cash(db, order.user_id, cash_delta=amount) is None:
+                return "Portfolio not found"
+            quantity_change = -order.quantity
+        
+        position = VirtualPositionRepository.get_by_user_and_symbol(db, order.user_id, order.symbol, for_update=True)
+        if order.side == "SELL" and (not position or position.quantity < order.quantity):
+            available = position.quantity if position else 0
+            return f"Insufficient shares to fill order. Required: {order.quantity}, Available: {available}"
+        
+        # Position chỉ thay đổi khi FILLED
+        VirtualPositionRepository.apply_quantity_change(
+            db, position, order.user_id, order.symbol, quantity_change, fill_price, commit=False
+        )
         
-        # Update portfolio total value
-        TradingService.update_portfolio_value(db, order.user_id, ch_client=None)
+        # Ghi fill vào sổ cái (dùng cho portfolio tại thời điểm bất kỳ)
+        LedgerService.record_fill(db, order, commit=False)
         
-        return order, None
+        # total_value theo last_price/avg_price, cùng transaction
+        PortfolioRepository.refresh_total_value(db, order.user_id)
+        return None
+    
+    @staticmethod
+    def fill_orders_batch(
+        db: Session,
+        orders: List[VirtualOrder],
+        prices: Dict[str, Decimal],
+        errors: List[str]
+    ) -> Tuple[List[VirtualOrder], Decimal]:
+        """
+        Fill nhiều orders trong một transaction, mỗi order với giá prices[order.symbol]
+        Mỗi order nằm trong một SAVEPOINT: order không hợp lệ (thiếu giá, không đủ tiền/cổ phiếu, đã fill ở
+        nơi khác) chỉ hoàn tác phần của nó và được ghi vào errors.
+        Transaction lỗi được rollback rồi fill lại từng order bằng fill_order.
+        
+        Returns: (orders đã fill, tổng tiền đã unblock)
+        """
+        filled: List[VirtualOrder] = []
+        unblocked = Decimal("0")
+        batch_errors: List[str] = []
+        try:
+            for order in orders:
+                price = prices.get(order.symbol)
+                if not price:
+                    batch_errors.append(f"Order {order.id}: Could not get price for {order.symbol}")
+                    continue
+                blocked_amount = TradingService.get_blocked_amount(order, price)
+                savepoint = db.begin_nested()
+                error = TradingService.apply_fill(db, order, price, blocked_amount)
+                if error:
+                    savepoint.rollback()
+                    batch_errors.append(f"Order {order.id}: {error}")
+                    continue
+                savepoint.commit()
+                unblocked += blocked_amount
+                filled.append(order)
+            committed_at = admin_stats.commit(db)
+            admin_stats.orders_filled(committed_at, filled)
+            errors.extend(batch_errors)
+            return filled, unblocked
+        except Exception as e:
+            db.rollback()
+            print(f"⚠️  Batch fill of {len(orders)} orders failed ({e}), retrying one by one")
+        
+        # Fallback: fill từng order (mỗi order một transaction)
+        filled, unblocked = [], Decimal("0")
+        for order in orders:
+            price = prices.get(order.symbol)
+            if not price:
+                errors.append(f"Order {order.id}: Could not get price for {order.symbol}")
+                continue
+            try:
+                result, error = TradingService.fill_order(db, order.id, price)
+            except Exception as e:
+                db.rollback()
+                result, error = None, str(e)
+            if error:
+                errors.append(f"Order {order.id}: {error}")
+                continue
+            filled.append(result)
+            unblocked += TradingService.get_blocked_amount(result, price)
+        return filled, unblocked
+    
+    @staticmethod
+    def get_blocked_amount(order: VirtualOrder, fill_price: Decimal) -> Decimal:
+        """
+        Tiền đã block khi order chờ khớp (sẽ được unblock khi fill)
+        Chỉ REALTIME BUY; ATO/ATC không block vì lúc đặt chưa biết giá
+        - LIMIT order: dùng order.price (giá giới hạn)
+        - MARKET order: order.price là giá lúc đặt, nếu không có thì dùng fill_price
+        Giá từ ClickHouse là nghìn VNĐ, cần nhân 1000 khi tính tiền
+        """
+        if order.side != "BUY" or order.trading_mode != "REALTIME" or order.order_type in ["ATO", "ATC"]:
+            return Decimal("0")
+        return (order.price if order.price else fill_price) * order.quantity * Decimal("1000")
     
     @staticmethod
     def cancel_order(
@@ -338,17 +626,20 @@ class TradingService:
         if order.status not in ["PENDING", "QUEUED"]:
             return None, f"Cannot cancel {order.status} order"
         
-        # Unblock tiền nếu là BUY order đã bị block (chỉ REALTIME mode)
-        if order.side == "BUY" and order.trading_mode == "REALTIME":
-            portfolio = PortfolioRepository.get_or_create_portfolio(db, user_id)
-            # Tính blocked amount (có thể là price ban đầu nếu là LIMIT order)
-            # Giá từ ClickHouse là nghìn VNĐ, cần nhân 1000 khi tính tiền
-            blocked_amount = (order.price if order.price else Decimal("0")) * order.quantity * Decimal("1000")
-            if blocked_amount > 0:
-                PortfolioRepository.unblock_cash(db, portfolio, blocked_amount)
-                print(f"✅ Unblocked {blocked_amount} VNĐ for cancelled order {order.id}")
+        # Chuyển sang CANCELLED có điều kiện trước: order vừa được fill ở nơi khác thì không unblock
+        if VirtualOrderRepository.cancel_order(db, order, commit=False) is None:
+            db.rollback()
+            return None, "Cannot cancel order: order is no longer PENDING/QUEUED"
         
-        order = VirtualOrderRepository.cancel_order(db, order)
+        # Unblock tiền nếu là BUY order đã bị block (chỉ REALTIME mode, không gồm ATO/ATC), cùng transaction
+        blocked_amount = TradingService.get_blocked_amount(order, Decimal("0"))
+        if blocked_amount > 0:
+            PortfolioRepository.adjust_cash(db, user_id, blocked_delta=-blocked_amount)
+        
+        db.commit()
+        if blocked_amount > 0:
+            print(f"✅ Unblocked {blocked_amount} VNĐ for cancelled order {order.id}")
+        matching_engine.remove_order(order.id)
         return order, None
     
     @staticmethod
@@ -366,7 +657,8 @@ class TradingService:
             db: Database session
             user_id: User ID
             ch_client: ClickHouse client (None nếu không có giá real-time)
-            as_of_date: Thời điểm tính toán (None = real-time, có giá trị = simulation)
+            as_of_date: Thời điểm tính toán (None = real-time, có giá trị = cash/positions tại thời điểm đó
+                        dựng từ sổ cái và giá tại thời điểm đó, không cập nhật DB)
             update_db: Có cập nhật vào database không (False cho simulation)
         
         Returns: total_value
@@ -375,15 +667,22 @@ class TradingService:
         if not portfolio:
             return None
         
+        if as_of_date is not None:
+            return TradingService.get_portfolio_value_at(db, user_id, ch_client, as_of_date)
+        
         positions = VirtualPositionRepository.get_all_by_user(db, user_id)
         total_positions_value = Decimal("0")
         total_unrealized_pnl = Decimal("0")
         
+        # Lấy giá cho tất cả positions trong một query (real-time hoặc tại thời điểm cụ thể)
+        prices = TradingService.get_current_prices(
+            ch_client, [position.symbol for position in positions], as_of_date
+        )
+        
         # Tính giá trị positions
         for position in positions:
             if ch_client:
-                # Lấy giá từ ClickHouse (real-time hoặc tại thời điểm cụ thể)
-                current_price = TradingService.get_current_price(ch_client, position.symbol, as_of_date)
+                current_price = prices.get(position.symbol)
                 if current_price:
                     if update_db:
                         # Cập nhật vào database
@@ -422,6 +721,38 @@ class TradingService:
             "total_unrealized_pnl": total_unrealized_pnl
         }
     
+    @staticmethod
+    def get_portfolio_value_at(
+        db: Session,
+        user_id: int,
+        ch_client,
+        as_of_date: datetime
+    ) -> Dict:
+        """
+        Giá trị portfolio tại một thời điểm trong quá khứ
+        
+        Cash và positions lấy từ sổ cái (snapshot gần nhất + replay), không phải positions hiện tại,
+        nên P&L lịch sử đúng cả khi user đã mua/bán sau thời điểm đó. Giá lấy tại as_of_date.
+        """
+        state = LedgerService.state_at(db, user_id, as_of_date)
+        prices = TradingService.get_current_prices(ch_client, list(state.positions), as_of_date)
+        
+        total_positions_value = Decimal("0")
+        total_unrealized_pnl = Decimal("0")
+        for symbol, (quantity, avg_price) in state.positions.items():
+            # Không có giá tại thời điểm đó: dùng avg_price
+            # Giá từ ClickHouse là nghìn VNĐ, cần nhân 1000 khi tính tiền
+            price = prices.get(symbol) or avg_price
+            total_positions_value += price * quantity * Decimal("1000")
+            total_unrealized_pnl += (price - avg_price) * quantity * Decimal("1000")
+        
+        return {
+            "total_value": state.cash_balance + total_positions_value,
+            "cash_balance": state.cash_balance,
+            "total_positions_value": total_positions_value,
+            "total_unrealized_pnl": total_unrealized_pnl
+        }
+    
     @staticmethod
     def check_and_fill_queued_market_orders(
         db: Session,
@@ -464,10 +795,12 @@ class TradingService:
         checked_count = len(queued_orders)
         errors = []
         
+        # Lấy giá hiện tại cho tất cả symbols trong một query (chỉ có giá khi trong giờ giao dịch)
+        prices = TradingService.get_current_prices(ch_client, [order.symbol for order in queued_orders])
+        
         for order in queued_orders:
             try:
-                # Lấy giá hiện tại (chỉ có giá khi trong giờ giao dịch)
-                current_price = TradingService.get_current_price(ch_client, order.symbol)
+                current_price = prices.get(order.symbol)
                 
                 if not current_price:
                     errors.append(f"Order {order.id}: Could not get price for {order.symbol} (có thể ngoài giờ giao dịch)")
@@ -482,7 +815,7 @@ class TradingService:
                 else:
                     filled_count += 1
                     print(f"✅ Filled QUEUED order {order.id}: {order.symbol} {order.side} {order.quantity} @ {current_price}")
-                    
+            
             except Exception as e:
                 errors.append(f"Order {order.id}: {str(e)}")
                 import traceback
@@ -505,7 +838,8 @@ class TradingService:
         # Tự động check và fill QUEUED MARKET orders nếu đang trong giờ giao dịch
         # (Ngoài giờ giao dịch không có giá real-time, nên không fill được)
         if ch_client:
-            TradingService.check_and_fill_queued_market_orders(db, user_id=user_id, ch_client=ch_client)
+            if not order_release_scheduler.is_running:
+                TradingService.check_and_fill_queued_market_orders(db, user_id=user_id, ch_client=ch_client)
             # Tự động check và fill LIMIT orders khi giá đạt mức giới hạn
             TradingService.check_and_fill_limit_orders(db, user_id=user_id, ch_client=ch_client)
         
@@ -516,9 +850,11 @@ class TradingService:
         total_positions_value = Decimal("0")
         total_unrealized_pnl = Decimal("0")
         
+        prices = TradingService.get_current_prices(ch_client, [position.symbol for position in positions])
+        
         for position in positions:
             if ch_client:
-                current_price = TradingService.get_current_price(ch_client, position.symbol)
+                current_price = prices.get(position.symbol)
                 if current_price:
                     position = VirtualPositionRepository.update_position_price(
                         db, position, current_price
@@ -560,20 +896,32 @@ class TradingService:
         
         # Lấy tất cả LIMIT orders đang pending/queued
         pending_orders = VirtualOrderRepository.get_pending_limit_orders(db, user_id=user_id)
+        if matching_engine.is_running and as_of_date is None:
+            # Orders theo giá real-time do engine khớp lệnh chạy nền xử lý, ở đây chỉ còn orders có execution_time
+            pending_orders = [order for order in pending_orders if not matching_engine.accepts(order)]
         
         filled_count = 0
         checked_count = len(pending_orders)
         errors = []
         
+        # Gom orders theo thời điểm lấy giá (execution_time hoặc as_of_date/real-time),
+        # mỗi thời điểm chỉ một query cho tất cả symbols
+        symbols_by_time: Dict[Optional[datetime], set] = {}
+        for order in pending_orders:
+            price_time = order.execution_time if order.execution_time else as_of_date
+            symbols_by_time.setdefault(price_time, set()).add(order.symbol)
+        prices_by_time = {
+            price_time: TradingService.get_current_prices(ch_client, list(symbols), as_of_date=price_time)
+            for price_time, symbols in symbols_by_time.items()
+        }
+        
         for order in pending_orders:
             try:
                 # Xác định thời điểm lấy giá
                 price_time = order.execution_time if order.execution_time else as_of_date
                 
                 # Lấy giá hiện tại hoặc tại thời điểm cụ thể
-                current_price = TradingService.get_current_price(
-                    ch_client, order.symbol, as_of_date=price_time
-                )
+                current_price = prices_by_time[price_time].get(order.symbol)
                 
                 if not current_price:
                     errors.append(f"Order {order.id}: Could not get price for {order.symbol}")
@@ -610,7 +958,7 @@ class TradingService:
                 else:
                     # Log lý do chưa fill (để debug)
                     errors.append(f"Order {order.id} ({order.side} {order.symbol}): {reason}")
-                        
+            
             except Exception as e:
                 errors.append(f"Order {order.id}: {str(e)}")
         
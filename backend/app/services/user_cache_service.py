@@ -0,0 +1,87 @@
+"""
+User Cache Service - Cache user đã xác thực (principal) theo username trong JWT
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+from app.config import settings
+from app.models.user import User
+
+
+class UserCacheService:
+    """
+    Cache thông tin user cho get_current_user, tránh query Postgres ở mọi request đã đăng nhập
+    
+    - Key: username (subject của JWT), TTL ngắn, tối đa max_entries users (bỏ entry cũ nhất)
+    - Chỉ lưu giá trị các cột; mỗi lần get trả về một User mới không gắn với session nào,
+      nên không request nào sửa được object của request khác. Route cần sửa user phải load
+      lại user từ db rồi gọi invalidate() sau khi commit.
+    - invalidate() chỉ có hiệu lực trong process hiện tại: worker khác có thể trả user cũ đến hết TTL,
+      nên quyền admin luôn được kiểm tra lại từ DB (get_admin_user), không dựa vào role trong cache.
+    """
+    
+    def __init__(self, ttl_seconds: float = 30, max_entries: int = 10000):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        
+        self._entries: "OrderedDict[str, tuple[Dict, float]]" = OrderedDict()
+        self._usernames_by_id: Dict[int, str] = {}
+        self._lock = threading.Lock()
+        
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, username: str) -> Optional[User]:
+        """Lấy user từ cache (None nếu chưa có hoặc đã hết hạn)"""
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None or time.monotonic() - entry[1] >= self.ttl_seconds:
+                self.misses += 1
+                return None
+            self.hits += 1
+            values = entry[0]
+        return User(**values)
+    
+    def put(self, user: User):
+        """Lưu giá trị các cột của user vào cache"""
+        values = {column.key: getattr(user, column.key) for column in User.__table__.columns}
+        with self._lock:
+            self._entries[user.username] = (values, time.monotonic())
+            self._entries.move_to_end(user.username)
+            self._usernames_by_id[user.id] = user.username
+            while len(self._entries) > self.max_entries:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._usernames_by_id.pop(evicted["id"], None)
+    
+    def invalidate(self, user_id: Optional[int] = None, username: Optional[str] = None):
+        """Xóa user khỏi cache theo id hoặc username (không truyền gì: xóa toàn bộ)"""
+        with self._lock:
+            if user_id is None and username is None:
+                self._entries.clear()
+                self._usernames_by_id.clear()
+                return
+            if username is None:
+                username = self._usernames_by_id.get(user_id)
+            entry = self._entries.pop(username, None) if username else None
+            if entry is not None:
+                self._usernames_by_id.pop(entry[0]["id"], None)
+    
+    def stats(self) -> Dict:
+        """Thống kê cache (để monitor)"""
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "ttl_seconds": self.ttl_seconds
+            }
+
+
+# Cache dùng chung cho toàn process
+user_cache = UserCacheService(
+    ttl_seconds=settings.USER_CACHE_TTL_SECONDS,
+    max_entries=settings.USER_CACHE_MAX_ENTRIES
+)
@@ -0,0 +1,25 @@
+-- Migration: Thêm các bảng tổng hợp cho admin dashboard (cập nhật theo sự kiện, reconcile định kỳ)
+-- App cũng tự tạo bảng khi start (Base.metadata.create_all) và tự tính lần đầu khi bảng còn trống
+-- (hoặc chạy: python -m app.jobs.reconcile_admin_stats)
+
+CREATE TABLE IF NOT EXISTS stat_counters (
+    name VARCHAR(64) PRIMARY KEY,
+    value NUMERIC(20, 2) NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS symbol_trade_stats (
+    symbol VARCHAR(10) PRIMARY KEY,
+    filled_orders INTEGER NOT NULL DEFAULT 0,
+    total_volume BIGINT NOT NULL DEFAULT 0,
+    buy_orders INTEGER NOT NULL DEFAULT 0,
+    sell_orders INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS lesson_stats (
+    lesson_id INTEGER PRIMARY KEY REFERENCES lessons(id) ON DELETE CASCADE,
+    total_attempts INTEGER NOT NULL DEFAULT 0,
+    completions INTEGER NOT NULL DEFAULT 0,
+    quiz_score_sum BIGINT NOT NULL DEFAULT 0,
+    quiz_score_count INTEGER NOT NULL DEFAULT 0
+);
@@ -0,0 +1,13 @@
+-- Migration: Thêm bảng equity_snapshots (equity curve của portfolio, một điểm / user / phút trong giờ giao dịch)
+-- App cũng tự tạo bảng khi start (Base.metadata.create_all)
+
+CREATE TABLE IF NOT EXISTS equity_snapshots (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    recorded_at TIMESTAMP WITH TIME ZONE NOT NULL,
+    cash_balance NUMERIC(15, 2) NOT NULL,
+    positions_value NUMERIC(15, 2) NOT NULL,
+    unrealized_pnl NUMERIC(15, 2) NOT NULL,
+    total_value NUMERIC(15, 2) NOT NULL,
+    CONSTRAINT uq_equity_snapshots_user_recorded UNIQUE (user_id, recorded_at)
+);
@@ -0,0 +1,14 @@
+-- Migration: Index cho lịch sử orders (GET /api/portfolio/orders lọc trong SQL + phân trang keyset)
+-- CONCURRENTLY không khóa ghi bảng virtual_orders; chạy từng lệnh ngoài transaction (psql -f là được)
+
+-- Lọc theo status, sắp theo (created_at, id)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_virtual_orders_user_status_created
+    ON virtual_orders (user_id, status, created_at, id);
+
+-- Không lọc status: trang theo (created_at, id) của user
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_virtual_orders_user_created
+    ON virtual_orders (user_id, created_at, id);
+
+-- Engine / scheduler: orders chờ khớp theo loại (LIMIT, MARKET QUEUED, ATO/ATC)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_virtual_orders_type_status
+    ON virtual_orders (order_type, status);
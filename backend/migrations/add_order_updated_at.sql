@@ -0,0 +1,15 @@
+-- Migration: Thêm virtual_orders.updated_at (watermark sync orders sang ClickHouse cho analytics)
+-- Orders cũ lấy thời điểm thay đổi cuối đã biết (tạo / fill / hủy)
+
+ALTER TABLE virtual_orders ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP WITH TIME ZONE;
+
+UPDATE virtual_orders
+SET updated_at = COALESCE(GREATEST(created_at, filled_at, cancelled_at), NOW())
+WHERE updated_at IS NULL;
+
+ALTER TABLE virtual_orders ALTER COLUMN updated_at SET DEFAULT NOW();
+ALTER TABLE virtual_orders ALTER COLUMN updated_at SET NOT NULL;
+
+-- Sync đọc theo (updated_at, id); CONCURRENTLY không khóa ghi (chạy ngoài transaction)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_virtual_orders_updated
+    ON virtual_orders (updated_at, id);
@@ -0,0 +1,38 @@
+-- Migration: Thêm sổ cái portfolio (ledger_entries) và snapshots (portfolio_snapshots)
+-- Dùng để dựng cash/positions của portfolio tại thời điểm bất kỳ (snapshot gần nhất + replay)
+-- Users đã có orders FILLED được bootstrap tự động ở lần ghi/đọc sổ cái đầu tiên
+
+CREATE TABLE IF NOT EXISTS ledger_entries (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    entry_type VARCHAR(10) NOT NULL,
+    order_id INTEGER REFERENCES virtual_orders(id) ON DELETE SET NULL,
+    symbol VARCHAR(10),
+    quantity INTEGER DEFAULT 0 NOT NULL,
+    price NUMERIC(10, 2),
+    cash_delta NUMERIC(15, 2) DEFAULT 0.00 NOT NULL,
+    note VARCHAR(50),
+    occurred_at TIMESTAMP WITH TIME ZONE NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT now(),
+    CONSTRAINT check_ledger_entry_type CHECK (entry_type IN ('FILL', 'CASH'))
+);
+
+CREATE INDEX IF NOT EXISTS ix_ledger_entries_id ON ledger_entries (id);
+CREATE INDEX IF NOT EXISTS ix_ledger_entries_user_occurred ON ledger_entries (user_id, occurred_at);
+
+CREATE TABLE IF NOT EXISTS portfolio_snapshots (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    as_of TIMESTAMP WITH TIME ZONE NOT NULL,
+    cash_balance NUMERIC(15, 2) NOT NULL,
+    positions JSON NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS ix_portfolio_snapshots_id ON portfolio_snapshots (id);
+CREATE INDEX IF NOT EXISTS ix_portfolio_snapshots_user_as_of ON portfolio_snapshots (user_id, as_of);
+
+-- Comment
+COMMENT ON TABLE ledger_entries IS 'Sổ cái append-only: FILL (order khớp) và CASH (nạp/reset tiền)';
+COMMENT ON COLUMN ledger_entries.occurred_at IS 'Thời điểm hiệu lực (execution_time cho PRACTICE, filled_at cho REALTIME)';
+COMMENT ON TABLE portfolio_snapshots IS 'Trạng thái portfolio tại as_of, tính từ mọi ledger entry có occurred_at <= as_of';
@@ -0,0 +1,300 @@
+"""
+AdminStatsService với nhiều worker: flush / reconcile xen kẽ không cộng trùng và không mất sự kiện
+
+StatsRepository được thay bằng bản giả lập trong bộ nhớ có cùng ngữ nghĩa của Postgres: advisory lock
+shared / exclusive và try-lock đến hết transaction, ghi chỉ có hiệu lực khi commit, snapshot REPEATABLE READ
+chỉ thấy các transaction gốc đã commit lúc chụp.
+"""
+
+import threading
+import time
+from decimal import Decimal
+
+import pytest
+
+from app.services import admin_stats_service
+from app.services.admin_stats_service import AdminStatsService
+
+
+class FakeDatabase:
+    """Bảng gốc (source) và bảng tổng hợp (aggregates) dùng chung cho mọi worker"""
+    
+    def __init__(self):
+        self.source = {"total_orders": Decimal("0")}
+        self.aggregates = {}
+        self.reconcile_lock = threading.Lock()
+        self._condition = threading.Condition()
+        self._shared = 0
+        self._exclusive = False
+        # Đặt để dừng reconcile giữa bước tính lại và bước ghi đè
+        self.computed = threading.Event()
+        self.resume_reconcile = None
+    
+    def acquire(self, shared: bool):
+        with self._condition:
+            if shared:
+                self._condition.wait_for(lambda: not self._exclusive)
+                self._shared += 1
+            else:
+                self._condition.wait_for(lambda: not self._exclusive and self._shared == 0)
+                self._exclusive = True
+    
+    def try_acquire_shared(self) -> bool:
+        with self._condition:
+            if self._exclusive:
+                return False
+            self._shared += 1
+            return True
+    
+    def release(self, shared: bool):
+        with self._condition:
+            if shared:
+                self._shared -= 1
+            else:
+                self._exclusive = False
+            self._condition.notify_all()
+    
+    def commit_order(self, worker: AdminStatsService) -> float:
+        """Transaction gốc tạo một order và commit. Returns: committed_at"""
+        session = FakeSession(self)
+        session.writes.append(lambda aggregates: self.source.update(total_orders=self.source["total_orders"] + 1))
+        return worker.commit(session)
+    
+    def add_order(self, worker: AdminStatsService):
+        """Order commit ở bảng gốc rồi worker ghi sự kiện (giống TradingService)"""
+        worker.order_created(self.commit_order(worker))
+
+
+class FakeSession:
+    """Một transaction: lock và ghi được giải phóng / áp dụng khi commit hoặc rollback"""
+    
+    def __init__(self, database: FakeDatabase):
+        self.database = database
+        self.releases = []
+        self.writes = []
+        self.snapshot = None
+    
+    def _end(self):
+        for release in reversed(self.releases):
+            release()
+        self.releases, self.writes = [], []
+    
+    def commit(self):
+        for write in self.writes:
+            write(self.database.aggregates)
+        self._end()
+    
+    def rollback(self):
+        self._end()
+    
+    def close(self):
+        self._end()
+
+
+class FakeStatsRepository:
+    RECONCILED_AT = "reconciled_at"
+    
+    @staticmethod
+    def lock_aggregates(db, shared=False):
+        db.database.acquire(shared)
+        db.releases.append(lambda: db.database.release(shared))
+    
+    @staticmethod
+    def try_lock_aggregates_shared(db):
+        if not db.database.try_acquire_shared():
+            return False
+        db.releases.append(lambda: db.database.release(True))
+        return True
+    
+    @staticmethod
+    def try_lock_reconcile(db):
+        if not db.database.reconcile_lock.acquire(blocking=False):
+            return False
+        db.releases.append(db.database.reconcile_lock.release)
+        return True
+    
+    @staticmethod
+    def lock_aggregate_rows(db):
+        pass
+    
+    @staticmethod
+    def db_time_ms(db):
+        return Decimal(str(round(time.time() * 1000, 2)))
+    
+    @staticmethod
+    def begin_snapshot(db):
+        db.snapshot = dict(db.database.source)
+        return FakeStatsRepository.db_time_ms(db)
+    
+    @staticmethod
+    def get_counters(db, names):
+        return {name: db.database.aggregates.get(name, Decimal("0")) for name in names}
+    
+    @staticmethod
+    def get_reconciled_at(db):
+        return db.database.aggregates.get("reconciled_at", Decimal("0"))
+    
+    @staticmethod
+    def add_counters(db, deltas):
+        def write(aggregates):
+            for name, delta in deltas.items():
+                aggregates[name] = aggregates.get(name, Decimal("0")) + delta
+        db.writes.append(write)
+    
+    @staticmethod
+    def add_symbol_stats(db, deltas):
+        pass
+    
+    @staticmethod
+    def add_lesson_stats(db, deltas):
+        pass
+    
+    @staticmethod
+    def compute_counters(db, month_start):
+        counters = dict(db.snapshot)
+        db.database.computed.set()
+        if db.database.resume_reconcile is not None:
+            db.database.resume_reconcile.wait(5)
+        return counters
+    
+    @staticmethod
+    def compute_symbol_stats(db):
+        return {}
+    
+    @staticmethod
+    def compute_lesson_stats(db):
+        return {}
+    
+    @staticmethod
+    def replace_counters(db, values):
+        db.writes.append(lambda aggregates: aggregates.update(values))
+    
+    @staticmethod
+    def replace_symbol_stats(db, stats):
+        pass
+    
+    @staticmethod
+    def replace_lesson_stats(db, stats):
+        pass
+    
+    @staticmethod
+    def set_reconciled_at(db, reconciled_at_ms):
+        db.writes.append(lambda aggregates: aggregates.update({"reconciled_at": reconciled_at_ms}))
+
+
+@pytest.fixture
+def database(monkeypatch):
+    monkeypatch.setattr(admin_stats_service, "StatsRepository", FakeStatsRepository)
+    return FakeDatabase()
+
+
+@pytest.fixture
+def make_worker(database):
+    def make(**kwargs):
+        return AdminStatsService(session_factory=lambda: FakeSession(database), **kwargs)
+    return make
+
+
+def total_orders(database: FakeDatabase) -> Decimal:
+    return database.aggregates.get("total_orders", Decimal("0"))
+
+
+def test_reconcile_drops_deltas_other_workers_buffered_before_it(database, make_worker):
+    worker_a, worker_b = make_worker(), make_worker()
+    database.add_order(worker_a)
+    database.add_order(worker_b)
+    time.sleep(0.01)
+    
+    assert worker_a.reconcile(FakeSession(database), force=True) is not None
+    assert total_orders(database) == 2
+    
+    # Sự kiện của cả hai worker đã nằm trong kết quả tính lại: flush không cộng lần nữa
+    assert worker_b.flush(FakeSession(database))
+    assert worker_a.flush(FakeSession(database))
+    assert total_orders(database) == 2
+    assert worker_a.stale_dropped == 1 and worker_b.stale_dropped == 1
+    
+    # Sự kiện sau reconcile vẫn được cộng
+    time.sleep(0.01)
+    database.add_order(worker_b)
+    assert worker_b.flush(FakeSession(database))
+    assert total_orders(database) == database.source["total_orders"] == 3
+
+
+def test_flush_during_reconcile_waits_and_is_not_overwritten(database, make_worker):
+    worker_a, worker_b = make_worker(), make_worker()
+    database.add_order(worker_a)
+    assert worker_a.flush(FakeSession(database))
+    database.resume_reconcile = threading.Event()
+    
+    reconcile = threading.Thread(target=worker_a.reconcile, args=(FakeSession(database),), kwargs={"force": True})
+    reconcile.start()
+    assert database.computed.wait(5)
+    
+    # Order commit sau khi reconcile đã tính lại: flush phải chờ và được cộng sau khi ghi đè
+    time.sleep(0.01)
+    database.add_order(worker_b)
+    flush = threading.Thread(target=worker_b.flush, args=(FakeSession(database),))
+    flush.start()
+    flush.join(0.2)
+    assert flush.is_alive()
+    
+    database.resume_reconcile.set()
+    reconcile.join(5)
+    flush.join(5)
+    assert total_orders(database) == database.source["total_orders"] == 2
+    assert worker_b.stale_dropped == 0
+
+
+def test_read_does_not_wait_for_running_reconcile(database, make_worker):
+    worker_a, worker_b = make_worker(), make_worker()
+    database.resume_reconcile = threading.Event()
+    reconcile = threading.Thread(target=worker_a.reconcile, args=(FakeSession(database),), kwargs={"force": True})
+    reconcile.start()
+    assert database.computed.wait(5)
+    
+    # Trang admin đọc trong lúc reconcile: không chờ lock, buffer giữ lại cho lần flush sau
+    time.sleep(0.01)
+    database.add_order(worker_b)
+    started = time.monotonic()
+    assert worker_b.flush(FakeSession(database), wait=False)
+    assert time.monotonic() - started < 0.1
+    assert worker_b.stats()["pending_events"] == 1
+    
+    database.resume_reconcile.set()
+    reconcile.join(5)
+    assert worker_b.flush(FakeSession(database), wait=False)
+    assert total_orders(database) == database.source["total_orders"] == 1
+
+
+def test_event_recorded_after_reconcile_is_not_counted_twice(database, make_worker):
+    worker_a, worker_b = make_worker(), make_worker()
+    # Order commit trước reconcile nhưng sự kiện được ghi vào buffer sau khi reconcile xong
+    committed_at = database.commit_order(worker_a)
+    time.sleep(0.01)
+    assert worker_b.reconcile(FakeSession(database), force=True) is not None
+    assert total_orders(database) == 1
+    
+    worker_a.order_created(committed_at)
+    assert worker_a.flush(FakeSession(database))
+    assert total_orders(database) == database.source["total_orders"] == 1
+    assert worker_a.stale_dropped == 1
+
+
+def test_only_one_worker_reconciles(database, make_worker):
+    worker_a = make_worker(reconcile_seconds=3600)
+    worker_b = make_worker(reconcile_seconds=3600)
+    database.resume_reconcile = threading.Event()
+    
+    reconcile = threading.Thread(target=worker_a.reconcile, args=(FakeSession(database),))
+    reconcile.start()
+    assert database.computed.wait(5)
+    # Đang có worker reconcile
+    assert worker_b.reconcile(FakeSession(database)) is None
+    
+    database.resume_reconcile.set()
+    reconcile.join(5)
+    database.resume_reconcile = None
+    # Chưa đến hạn
+    assert worker_b.reconcile(FakeSession(database)) is None
+    assert worker_b.reconcile(FakeSession(database), force=True) is not None